@@ -0,0 +1,256 @@
+"""
+Measure the latency and memory use of the actions
+
+With `ActionProfiler` in the plugin list, every action registered with
+`actions.add` (by the plugins, the views or phy itself) is measured.
+The wall time of each call is broken down into
+
+- load: loading data (spike selection, features, waveforms, amplitudes)
+- update: nested actions such as split, merge, label or select, which
+  update the clustering and the views
+- compute: the remaining time
+
+together with the peak memory used during the call and the number of
+spikes processed. The memory is the resident memory of the process
+(RSS), sampled in a thread every `sample_interval` seconds while the
+action runs, relative to its value at the start of the action, such
+that the memory used by each action can be compared (e.g. before and
+after an optimization). Each call is appended to a rolling log
+in the Phy configuration directory (`action_profile.jsonl`, the previous
+log is kept as `action_profile.jsonl.1`). The action 'Show action
+profile' in the menu Help writes a summary table per action, including
+a histogram of the latencies, to the log.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from phy.gui.actions import Actions
+from phy.utils import phy_config_dir
+
+logger = logging.getLogger('phy')
+
+# Upper edges of the latency histogram bins (seconds)
+BINS = (.01, .03, .1, .3, 1, 3, 10, 30, np.inf)
+
+
+def _rss():
+    """Current resident memory of the process in bytes (None if unknown)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass  # Not Linux
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class PeakMemory(object):
+    """Peak resident memory above its initial value, sampled in a thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = self.peak = _rss()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def stop(self):
+        """Peak increase in bytes (None if unknown)"""
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+        return self.peak - self.start
+
+
+def _n_spikes(obj):
+    """Number of spikes in a result or an argument (0 if unknown)"""
+    if isinstance(obj, (list, tuple)):
+        return sum(_n_spikes(o) for o in obj)
+    for name in ('spike_ids', 'data'):
+        obj = getattr(obj, name, obj)
+    shape = getattr(obj, 'shape', ())
+    return int(shape[0]) if shape else 0
+
+
+class ActionProfiler(IPlugin):
+    # Size of the log file before it is rolled over (bytes)
+    max_size = 1e6
+
+    # Interval of the memory measurements during an action (seconds)
+    sample_interval = .005
+
+    def __init__(self):
+        self.call = None  # Measurements of the running action
+        self.in_phase = False
+        self.path = Path(phy_config_dir()) / 'action_profile.jsonl'
+        self.dataset = ''
+
+        if getattr(Actions.add, '_profiled', False):
+            return
+        add = Actions.add
+
+        @functools.wraps(add)
+        def add_profiled(actions, callback=None, *args, **kwargs):
+            if callback is not None:
+                name = kwargs.get('name') or callback.__name__
+                callback = self.profile(callback, name)
+            return add(actions, callback, *args, **kwargs)
+
+        add_profiled._profiled = True
+        Actions.add = add_profiled
+
+    def profile(self, func, name):
+        """Measured version of an action callback"""
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            if self.call is not None:
+                # Nested action, counts as update of the outer action
+                self.call['spikes'] = max(self.call['spikes'],
+                                          _n_spikes(args[:1]))
+                with self.phase('update'):
+                    return func(*args, **kwargs)
+
+            self.call = dict(load=0., update=0., spikes=0)
+            memory = PeakMemory(self.sample_interval)
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                call, self.call = self.call, None
+                call['time'] = time.perf_counter() - t
+                call['compute'] = max(
+                    0., call['time'] - call['load'] - call['update'])
+                call['peak'] = memory.stop()
+                logger.debug('Action %s: %.3f s, peak memory +%s MB.', name,
+                             call['time'], '-' if call['peak'] is None
+                             else '%.1f' % (call['peak'] / 1e6))
+                self.record(name, call)
+        return profiled
+
+    @contextmanager
+    def phase(self, name):
+        """Measure a part of the running action (outermost part only)"""
+        if self.call is None or self.in_phase:
+            yield
+            return
+        self.in_phase = True
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.in_phase = False
+            self.call[name] += time.perf_counter() - t
+
+    def loading(self, func):
+        """Measured version of a data loading method"""
+        @functools.wraps(func)
+        def load(*args, **kwargs):
+            if self.call is None:
+                return func(*args, **kwargs)
+            with self.phase('load'):
+                out = func(*args, **kwargs)
+                self.call['spikes'] = max(self.call['spikes'],
+                                          _n_spikes(out))
+            return out
+        return load
+
+    def record(self, name, call):
+        """Append the measurements of a call to the log"""
+        call = dict(call, action=name, dataset=self.dataset,
+                    date=time.strftime('%Y-%m-%d %H:%M:%S'))
+        try:
+            if self.path.exists() and self.path.stat().st_size > \
+                    self.max_size:
+                self.path.replace(self.path.with_name(self.path.name + '.1'))
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(call) + '\n')
+        except OSError as e:
+            logger.debug('Could not write the action profile: %s', e)
+
+    def read(self):
+        """All records of the log, previous log first"""
+        records = []
+        for path in (self.path.with_name(self.path.name + '.1'), self.path):
+            if not path.exists():
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # Incomplete line
+        return records
+
+    def summary(self):
+        actions = dict()
+        for r in self.read():
+            actions.setdefault(r['action'], []).append(r)
+
+        lines = ['Action profile (%s):' % self.path,
+                 '    %-28s %5s %8s %8s %8s %8s %9s %8s  %s' % (
+                     'Action', 'n', 'median', 'max', 'load', 'update',
+                     'spikes', 'peak MB', 'histogram (s) ' + ' '.join(
+                         '<%g' % b for b in BINS[:-1]) + ' more')]
+        for name, records in sorted(actions.items(),
+                                    key=lambda x: -sum(r['time']
+                                                       for r in x[1])):
+            t = np.array([r['time'] for r in records])
+            total = t.sum() or 1.
+            peak = [r['peak'] for r in records if r.get('peak') is not None]
+            hist = np.bincount(np.searchsorted(BINS, t), minlength=len(BINS))
+            lines.append(
+                '    %-28s %5i %8.3f %8.3f %7.0f%% %7.0f%% %9i %8s  %s' % (
+                    name[:28], len(t), np.median(t), t.max(),
+                    100 * sum(r['load'] for r in records) / total,
+                    100 * sum(r['update'] for r in records) / total,
+                    max(r['spikes'] for r in records),
+                    '%.1f' % (max(peak) / 1e6) if peak else '-',
+                    ' '.join(map(str, hist))))
+        logger.info('\n'.join(lines))
+
+    def attach_to_controller(self, controller):
+        self.dataset = str(controller.dir_path)
+
+        # Data loading methods, only measured while an action is running
+        model = controller.model
+        for obj, names in ((model, ('get_features', 'get_waveforms',
+                                    'get_template_features',
+                                    '_load_features')),
+                           (controller, ('_amplitude_getter',
+                                         'get_amplitudes')),
+                           (controller.selector, ('select_spikes',))):
+            for name in names:
+                if hasattr(obj, name):
+                    setattr(obj, name, self.loading(getattr(obj, name)))
+
+        @connect
+        def on_controller_ready(sender):
+            clustering = controller.supervisor.clustering
+            clustering.spikes_in_clusters = self.loading(
+                clustering.spikes_in_clusters)
+
+        @connect
+        def on_gui_ready(sender, gui):
+            @controller.supervisor.actions.add(menu='&Help')
+            def Show_action_profile():
+                """Write a summary of the action latencies to the log"""
+                self.summary()
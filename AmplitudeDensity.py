@@ -0,0 +1,386 @@
+"""
+Density mode of the amplitude view for clusters with many spikes
+
+In density mode (toggled from the amplitude view menu or by keyboard
+shortcut), all spikes of the selected clusters are loaded in a
+background thread, as for splitting, and the amplitudes are binned vs.
+time into a 2-D histogram of the visible range (one bin per
+`pixel_size` pixels), drawn as an image in the colors of the clusters
+(logarithmic scale). The spikes are sorted by time, such that zooming in
+only bins the spikes within the visible time range again (binary
+search). The amplitude range of the view is set to the range of all
+loaded spikes, not only of the subset shown by the view.
+
+The loaded spikes are cached per cluster (up to `max_cached_spikes` in
+total) until the cluster changes, such that replotting the view (e.g.
+selecting a similar cluster) only loads the clusters not seen before.
+
+Once at most `max_points` spikes are visible, they are drawn as
+individual points instead. The background spikes of other clusters are
+not shown in density mode.
+"""
+
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from phy.cluster.views import AmplitudeView
+from phy.plot.visuals import ImageVisual, ScatterVisual
+from phy.utils.color import selected_cluster_color
+from phylib.utils import Bunch
+from PyQt5.QtCore import QTimer
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_generation import ClusterCache, get_state  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+def load_spikes(get_amplitudes, cluster_ids):
+    """Times and amplitudes of all spikes of each cluster, sorted by time"""
+    out = []
+    for bunch in get_amplitudes(list(cluster_ids), load_all=True) or ():
+        times = np.asarray(bunch.spike_times, dtype=np.float64)
+        amplitudes = np.asarray(bunch.amplitudes)
+        if np.any(np.diff(times) < 0):  # Reordered spike times
+            order = np.argsort(times, kind='stable')
+            times, amplitudes = times[order], amplitudes[order]
+        out.append(Bunch(times=times, amplitudes=amplitudes))
+    return out
+
+
+def amplitude_bounds(data, x0, x1):
+    """Data bounds `(x0, a0, x1, a1)` of all loaded spikes"""
+    amplitudes = [d.amplitudes for d in data if len(d.amplitudes)]
+    if not amplitudes:
+        return None
+    a0 = min(0, min(float(a.min()) for a in amplitudes))  # As in the view
+    a1 = max(float(a.max()) for a in amplitudes)
+    return (x0, a0, x1, a1 if a1 > a0 else a0 + 1)
+
+
+def density(times, amplitudes, window, shape):
+    """
+    2-D histogram (amplitude bins x time bins) of the spikes within a
+    window `(t0, a0, t1, a1)`, and the indices of these spikes
+    """
+    t0, a0, t1, a1 = window
+    ny, nx = shape
+    i, j = np.searchsorted(times, (t0, t1))
+    x = ((times[i:j] - t0) * (nx / (t1 - t0))).astype(np.intp)
+    np.minimum(x, nx - 1, out=x)
+    y = (amplitudes[i:j] - a0) * (ny / (a1 - a0))
+    keep = np.flatnonzero((y >= 0) & (y < ny))
+    bins = y[keep].astype(np.intp) * nx + x[keep]
+    hist = np.bincount(bins, minlength=nx * ny).reshape(shape)
+    return hist, keep + i
+
+
+def density_image(hists, colors):
+    """RGBA image of the histograms of several clusters (top row first)"""
+    scale = np.log1p(max(h.max() for h in hists)) or 1.
+    image = np.zeros(hists[0].shape + (4,), dtype=np.float32)
+    total = np.zeros(hists[0].shape, dtype=np.float32)
+    for hist, color in zip(hists, colors):
+        level = np.log1p(hist, dtype=np.float32)
+        level /= scale
+        image[..., :3] += level[..., np.newaxis] * np.asarray(color[:3])
+        total += level
+        np.maximum(image[..., 3], level, out=image[..., 3])
+    # Mean color of the clusters in each bin, opacity by density
+    image[..., :3] /= np.maximum(total, 1e-6)[..., np.newaxis]
+    image[..., 3] = np.where(total > 0, .25 + .75 * image[..., 3], 0)
+    return image[::-1]
+
+
+class DensityVisual(ImageVisual):
+    """Image drawn within a rectangle (normalized coordinates)"""
+
+    def set_data(self, image=None, rect=(-1, -1, 1, 1)):
+        data = super(DensityVisual, self).set_data(image=image)
+        x0, y0, x1, y1 = rect
+        self.program['a_position'] = np.array(
+            [[x0, y0], [x0, y1], [x1, y0], [x0, y1], [x1, y1], [x1, y0]],
+            dtype=np.float32)
+        return data
+
+
+class AmplitudeDensity(IPlugin):
+    # Maximum number of visible spikes drawn as individual points
+    max_points = 20000
+
+    # Size of the bins of the density image (pixels)
+    pixel_size = 2
+
+    # Maximum number of spikes whose amplitudes are kept in memory
+    max_cached_spikes = 10 ** 7
+
+    # Interval to check for loaded spikes and changes of the visible range
+    # (milliseconds)
+    refresh_interval = 100
+
+    def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        entries = []  # Registered views and their visuals
+        caches = dict()  # Loaded spikes per cluster, per amplitude source
+        requests = count(1)  # Numbers of the reload requests
+        timer = QTimer()
+
+        def source(view):
+            """
+            What the amplitudes of a cluster depend on, besides the cluster
+
+            Except for template amplitudes, they are computed on the best
+            channels of the first selected cluster, or on the channel and
+            PC selected in the other views.
+            """
+            name = view.amplitudes_type
+            if name == 'template':
+                return (name,)
+            selection = getattr(controller, 'selection', {})
+            return (name, int(view.cluster_ids[0]),
+                    selection.get('channel_id'), selection.get('feature_pc'))
+
+        def get_cache(key):
+            # Most recently used last
+            cache = caches.pop(key, None) or ClusterCache(
+                get_state(controller), labels=False)
+            caches[key] = cache
+            return cache
+
+        def trim(keep):
+            """Remove the least recently used clusters over the maximum"""
+            total = sum(len(d.times) for cache in caches.values()
+                        for d in cache.values.values())
+            for key, cache in list(caches.items()):
+                for cluster_id in list(cache.values):
+                    if total <= self.max_cached_spikes:
+                        return
+                    if (key, cluster_id) not in keep:
+                        total -= len(cache.values.pop(cluster_id).times)
+                if not cache.values:
+                    caches.pop(key)
+
+        def visible_window(view):
+            """Visible range `(t0, a0, t1, a1)` and its normalized rect"""
+            pan = np.asarray(view.canvas.panzoom.pan)
+            zoom = np.asarray(view.canvas.panzoom.zoom)
+            lo = np.clip(-1 / zoom - pan, -1, 1)
+            hi = np.clip(1 / zoom - pan, -1, 1)
+            x0, y0, x1, y1 = view.data_bounds
+            t0, t1 = x0 + (np.r_[lo[0], hi[0]] + 1) / 2 * (x1 - x0)
+            a0, a1 = y0 + (np.r_[lo[1], hi[1]] + 1) / 2 * (y1 - y0)
+            return (t0, a0, t1, a1), (lo[0], lo[1], hi[0], hi[1])
+
+        def show_scatter(entry, on):
+            """Show the view's own scatter plot, or the density mode"""
+            if on:
+                entry['view'].visual.show()
+                entry['view'].hist_visual.show()
+                entry['image'].hide()
+                entry['points'].hide()
+            entry['key'] = None
+
+        def set_data(entry, data):
+            """Use the loaded spikes, and the range of their amplitudes"""
+            view = entry['view']
+            entry['data'] = data
+            entry['loaded'] += 1
+            bounds = amplitude_bounds(data, view.data_bounds[0],
+                                      view.data_bounds[2])
+            if bounds is not None:
+                # Restored by replotting the view when leaving density mode
+                view.data_bounds = bounds
+                view._update_axes()
+
+        def plot(entry):
+            """Draw the density image or the points of the visible range"""
+            view = entry['view']
+            if not view.density_mode or not entry['data']:
+                return
+            window, rect = visible_window(view)
+            if window[2] <= window[0] or window[3] <= window[1]:
+                return
+            width, height = view.canvas.get_size()
+            # Size of the visible part of the view (pixels)
+            nx = max(1, int((rect[2] - rect[0]) / 2 * width / self.pixel_size
+                            * view.canvas.panzoom.zoom[0]))
+            ny = max(1, int((rect[3] - rect[1]) / 2 * height
+                            / self.pixel_size * view.canvas.panzoom.zoom[1]))
+
+            # Skip redrawing if the same range would be drawn
+            key = (entry['loaded'], window, nx, ny, view._marker_size)
+            if key == entry['key']:
+                return
+            entry['key'] = key
+
+            data = entry['data']
+            colors = [selected_cluster_color(i, view.marker_alpha)
+                      for i in range(len(data))]
+            hists, spikes = zip(*(density(d.times, d.amplitudes, window,
+                                          (ny, nx)) for d in data))
+            n_visible = sum(len(s) for s in spikes)
+
+            view.visual.hide()
+            view.hist_visual.hide()  # Histograms of the subset
+            if n_visible == 0:
+                entry['image'].hide()
+                entry['points'].hide()
+            elif n_visible <= self.max_points:
+                entry['image'].hide()
+                entry['points'].reset_batch()
+                for d, s, color in zip(data, spikes, colors):
+                    if len(s):
+                        entry['points'].add_batch_data(
+                            pos=np.c_[d.times[s], d.amplitudes[s]],
+                            color=color, size=view._marker_size,
+                            data_bounds=view.data_bounds)
+                view.canvas.update_visual(entry['points'])
+                entry['points'].show()
+            else:
+                entry['points'].hide()
+                entry['image'].set_data(image=density_image(hists, colors),
+                                        rect=rect)
+                entry['image'].show()
+            logger.log(5, '%i spikes visible in the amplitude view.',
+                       n_visible)
+            view.canvas.update()
+
+        def load(entry):
+            """
+            Load all spikes of the selected clusters in the background
+            (GUI thread only)
+            """
+            view = entry['view']
+            if entry['job'] is not None:
+                entry['job'][0].cancel()
+                entry['job'] = None
+            entry['data'] = None
+            cluster_ids = [int(c) for c in view.cluster_ids]
+            key = source(view)
+            cache = get_cache(key)
+            known = {c: cache.peek(c) for c in cluster_ids}
+            missing = [c for c in cluster_ids if known[c] is None]
+            if not missing:
+                set_data(entry, [known[c] for c in cluster_ids])
+                return
+            # The first cluster determines the channels (see `source`)
+            request = missing
+            if key[0] != 'template' and cluster_ids[0] not in missing:
+                request = cluster_ids[:1] + missing
+            future = executor.submit(
+                load_spikes, view.amplitudes[view.amplitudes_type], request)
+            # The request goes with its future
+            entry['job'] = (future, (key, cache, cache.state.generation,
+                                     cluster_ids, known, request))
+
+        def loaded(entry, pending, result):
+            """Cache the loaded spikes and combine them with the cached ones"""
+            key, cache, generation, cluster_ids, known, request = pending
+            if len(result) != len(request):
+                raise ValueError('%i clusters requested, %i loaded.' % (
+                    len(request), len(result)))
+            for cluster_id, d in zip(request, result):
+                cache.put(cluster_id, d, generation)
+                if known[cluster_id] is None:
+                    known[cluster_id] = d
+            trim({(key, c) for c in cluster_ids})
+            set_data(entry, [known[c] for c in cluster_ids])
+
+        def refresh():
+            """Check for loaded spikes and changes of the visible range"""
+            for entry in entries:
+                requested = entry['requested']
+                if requested != entry['handled']:
+                    # Replotted since the last check
+                    entry['handled'] = requested
+                    if entry['view'].density_mode and \
+                            len(entry['view'].cluster_ids):
+                        load(entry)
+                job = entry['job']
+                if job is not None and job[0].done():
+                    entry['job'] = None
+                    future, pending = job
+                    try:
+                        loaded(entry, pending, future.result())
+                    except Exception as e:
+                        logger.error('Could not load the amplitudes: %s', e)
+                        continue
+                    logger.debug('Loaded %i spikes for the density mode.',
+                                 sum(len(d.times) for d in future.result()))
+                if not entry['view'].density_mode or entry['view']._closed:
+                    continue
+                if entry['data'] is None and entry['key'] is not None:
+                    # Show the subset of the view while loading
+                    show_scatter(entry, True)
+                    entry['view'].canvas.update()
+                plot(entry)
+            if not any(e['view'].density_mode for e in entries):
+                timer.stop()
+
+        timer.timeout.connect(refresh)
+
+        @connect
+        def on_gui_ready(sender, gui):
+            @connect(sender=gui)
+            def on_close(sender):
+                timer.stop()
+                executor.shutdown(wait=False)
+
+        @connect
+        def on_view_attached(view, gui):
+            if not isinstance(view, AmplitudeView):
+                return
+
+            image_visual = DensityVisual()
+            view.canvas.add_visual(image_visual)
+            image_visual.hide()
+            points_visual = ScatterVisual()
+            view.canvas.add_visual(points_visual)
+            points_visual.hide()
+
+            entry = dict(view=view, image=image_visual, points=points_visual,
+                         data=None, job=None, key=None, loaded=0,
+                         requested=0, handled=0)
+            entries.append(entry)
+
+            # Reload the spikes whenever the view is replotted (selection,
+            # amplitude type). The view may be replotted in a worker thread
+            # of phy: the reload is left to the timer on the GUI thread.
+            view_plot = view.plot
+
+            def plot_view(**kwargs):
+                view_plot(**kwargs)
+                if view.density_mode:
+                    entry['requested'] = next(requests)
+
+            view.plot = plot_view
+
+            if not hasattr(view, 'density_mode'):
+                view.density_mode = False
+            view.state_attrs += ('density_mode',)
+
+            @view.actions.add(shortcut='alt+v', checkable=True,
+                              checked=view.density_mode,
+                              name='Toggle density mode')
+            def toggle(on):
+                """Toggle the density mode"""
+                view.density_mode = on
+                show_scatter(entry, not on)
+                if on:
+                    if len(view.cluster_ids):
+                        load(entry)
+                    timer.start(self.refresh_interval)
+                elif entry['data'] is not None and len(view.cluster_ids):
+                    # Data bounds of the subset shown by the view
+                    view.plot()
+                view.canvas.update()
+
+            if view.density_mode:
+                show_scatter(entry, False)
+                timer.start(self.refresh_interval)
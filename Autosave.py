@@ -2,48 +2,132 @@
 Trigger automatic saving at certain interval.
 
 The interval can be set from the main menu.
+
+Only what changed since the last save is written: the cluster
+assignments of the spikes that were moved by splits and merges (patched
+into a copy of `spike_clusters.npy`) and the cluster metadata files of
+the changed labels. Note that copying `spike_clusters.npy` still takes
+time proportional to the number of spikes (a sequential file copy, in
+the kernel where the platform supports it). Patching the file in place
+would avoid it, but a crash could then leave a partially written file,
+and the file would no longer be replaced atomically, which
+`CurationJournal` relies on. The files are written in a background thread to a
+temporary file that then replaces the original, such that a crash while
+writing does not corrupt the dataset. The regular save from the menu
+still writes everything (and waits for a running auto-save first).
+
+The events `autosave_snapshot` and `autosave_done` are emitted when the
+changes are collected and when they were successfully written. Functions
+returned by the handlers of `autosave_snapshot` are called with the new
+`spike_clusters.npy` right before it replaces the original.
 """
 
-import json
 import logging
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 from phy import IPlugin, connect
-from phy.utils import phy_config_dir
+from phylib.io.model import save_metadata
+from phylib.utils import emit
 from PyQt5.QtCore import QTimer
 
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_config import load_config, save_config  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
+def _fsync(path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def _replace(path, write, commits=()):
+    """
+    Write a file via a temporary file that atomically replaces it
+
+    The functions `commits` are called with the complete temporary file
+    right before it replaces the original.
+    """
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        write(tmp)
+        _fsync(tmp)
+        for commit in commits:
+            commit(tmp)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def save_delta(dir_path, spike_ids, spike_clusters, labels, commits=()):
+    """
+    Write the changes since the last save
+
+    Parameters
+    ----------
+    dir_path : Path
+        Data directory
+    spike_ids : array or None
+        Spikes whose cluster assignment changed
+    spike_clusters : array
+        Cluster assignments of `spike_ids`, or of all spikes if there is
+        no `spike_clusters.npy` yet
+    labels : dict
+        Cluster labels {field: {cluster_id: value}} of the changed fields
+    commits : list
+        Functions called with the new `spike_clusters.npy` before it
+        replaces the original (see `_replace`)
+    """
+    path = dir_path / 'spike_clusters.npy'
+    if spike_ids is not None and spike_ids.size:
+        def patch(tmp):
+            # O(n_spikes) copy, see the module docstring
+            shutil.copyfile(path, tmp)
+            data = np.load(tmp, mmap_mode='r+')
+            data[spike_ids] = spike_clusters
+            data.flush()
+            del data
+
+        logger.debug('Auto-save %i changed spike clusters.', spike_ids.size)
+        _replace(path, patch, commits)
+    elif spike_ids is None:
+        logger.debug('Auto-save all spike clusters.')
+        def save(tmp):
+            # np.save() would append .npy to the name of the temporary file
+            with open(tmp, 'wb') as f:
+                np.save(f, spike_clusters)
+
+        _replace(path, save, commits)
+
+    for field, values in labels.items():
+        logger.debug('Auto-save cluster metadata `%s`.', field)
+        _replace(dir_path / ('cluster_%s.tsv' % field),
+                 lambda tmp: save_metadata(tmp, field, values))
+
+
 class Autosave(IPlugin):
+    # Delay before a failed auto-save is tried again (seconds)
+    retry_delay = 60
+
     # Load config
     def __init__(self):
-        self.filepath = Path(phy_config_dir()) / 'plugin_autosave.json'
-
         # Default config (do not change here!)
         self.dflts = dict(
             interval_minutes=10,
             interval_debug=10,
         )
-
-        # Create config file with defaults if it does not exist
-        if not self.filepath.exists():
-            logger.debug("Create default config at %s.", self.filepath)
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", self.filepath)
-        with open(self.filepath, 'r') as f:
-            try:
-                self.config = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                self.config = self.dflts
+        self.config = load_config('Autosave', self.dflts)
 
         # Check value validity
         self.config['interval_minutes'] = self.check_validity(
             self.config.get('interval_minutes'))
-        self.config.setdefault('interval_debug', self.dflts['interval_debug'])
 
         # Give message
         self.show_update()
@@ -62,19 +146,116 @@ class Autosave(IPlugin):
                     self.config['interval_minutes'])
 
     def update_config(self):
-        with open(self.filepath, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, ensure_ascii=False, indent=4)
+        save_config('Autosave', self.config)
         self.show_update()
 
     def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.job = None  # Running auto-save
+        self.job_spike_ids = None
+        self.changed_spikes = []  # Spike ids changed since last save
+        self.changed_fields = set()  # Label fields changed since last save
+        self.all_fields = False
+        self.all_spikes = False  # Write the whole spike_clusters.npy
+
+        def reset_changes():
+            self.changed_spikes = []
+            self.changed_fields = set()
+            self.all_fields = False
+            self.all_spikes = False
+
+        def snapshot():
+            """Collect the changes since the last save on the GUI thread"""
+            sup = controller.supervisor
+            dir_path = Path(controller.model.dir_path)
+            if self.all_spikes or \
+                    not (dir_path / 'spike_clusters.npy').exists():
+                spike_ids = None
+                spike_clusters = sup.clustering.spike_clusters.copy()
+            elif self.changed_spikes:
+                spike_ids = np.unique(np.concatenate(self.changed_spikes))
+                spike_clusters = sup.clustering.spike_clusters[spike_ids]
+            else:
+                spike_ids = spike_clusters = np.array([], dtype=np.int64)
+
+            fields = (sup.cluster_meta.fields if self.all_fields
+                      else self.changed_fields)
+            labels = {
+                field: {c: v for c, v in sup.get_labels(field).items()
+                        if v is not None}
+                for field in fields if field != 'next_cluster'}
+            return dir_path, spike_ids, spike_clusters, labels
+
+        def wait():
+            """Finish a running auto-save"""
+            if self.job is None:
+                return
+            try:
+                self.job.result()
+                logger.debug('Auto-save complete.')
+                emit('autosave_done', self)
+            except Exception as e:
+                # Write the changes again with the next auto-save, soon
+                logger.error('Auto-save failed (retry in %i s): %s',
+                             self.retry_delay, e)
+                self.all_fields = True
+                if self.job_spike_ids is None:
+                    # The whole clustering was being written
+                    self.all_spikes = True
+                else:
+                    self.changed_spikes.append(self.job_spike_ids)
+                self.count = max(self.count, self.config[
+                    'interval_minutes'] * 60 - self.retry_delay)
+            self.job = self.job_spike_ids = None
+
+        # Let the regular save wait for a running auto-save
+        def wait_before(save):
+            def wrapped(*args, **kwargs):
+                wait()
+                return save(*args, **kwargs)
+            return wrapped
+
+        @connect
+        def on_controller_ready(sender):
+            model = controller.model
+            model.save_spike_clusters = wait_before(model.save_spike_clusters)
+            model.save_metadata = wait_before(model.save_metadata)
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                if up.description.startswith('metadata_'):
+                    self.changed_fields.add(up.description[9:])
+                elif up.spike_ids is not None and len(up.spike_ids):
+                    # Clustering changed and new clusters inherited labels
+                    self.changed_spikes.append(np.asarray(up.spike_ids))
+                    self.all_fields = True
+
         @connect
         def on_gui_ready(sender, gui):
             # Trigger auto-save
             def checkTime(*args):
                 self.count += 1
+                if self.job is not None and self.job.done():
+                    wait()
                 if self.count > self.config['interval_minutes'] * 60:
+                    self.count = 0
+                    if self.job is not None:
+                        logger.debug('Previous auto-save still running.')
+                        return
+                    if not (self.changed_spikes or self.changed_fields or
+                            self.all_spikes or self.all_fields):
+                        logger.debug('Nothing to auto-save.')
+                        return
                     logger.info('Trigger auto-save.')
-                    gui.file_actions.save()
+                    args = snapshot()
+                    reset_changes()
+                    # Plugins may return functions to mark the new
+                    # spike_clusters.npy (see `CurationJournal`)
+                    commits = [commit for commit in
+                               emit('autosave_snapshot', self)
+                               if callable(commit)]
+                    self.job = executor.submit(save_delta, *args, commits)
+                    self.job_spike_ids = args[1]
                 elif self.count % self.config['interval_debug'] == 0:
                     logger.debug('Counter: %d seconds', self.count)
 
@@ -93,5 +274,8 @@ class Autosave(IPlugin):
 
             @connect(sender=gui)
             def on_request_save(sender):
+                # Everything is saved
+                wait()
+                reset_changes()
                 logger.debug('Reset auto-save counter.')
                 self.count = 0
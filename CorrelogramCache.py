@@ -0,0 +1,95 @@
+"""
+Compute the correlograms of the correlogram view pair by pair, with cache
+
+The correlograms of all pairs of selected clusters are computed in one
+pass over the merged spike trains of the clusters (see `plugin_ccg`),
+on the same spikes as phy. The correlograms of each pair of clusters
+are kept in memory (at most `max_pairs` pairs), so that selecting a
+cluster next to already selected ones only compares the spikes of the
+new cluster with those of the selection. As a cluster id always refers
+to the same spikes, the correlograms of the clusters restored by undo
+or redo are taken from the cache.
+
+With `n_workers` > 1, large selections are computed in parallel, each
+worker counting the pairs of a part of the merged spike train.
+"""
+
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_ccg import CCGCache, ccg_counts, symmetrize  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class CorrelogramCache(IPlugin):
+    # Maximum number of cached pairs of clusters
+    max_pairs = 50000
+
+    # Number of threads computing the correlograms of a selection
+    n_workers = 1
+
+    # Minimum number of spikes of a selection computed in parallel
+    min_spikes_parallel = 100000
+
+    def attach_to_controller(self, controller):
+        cache = CCGCache(self.max_pairs)
+        executor = (ThreadPoolExecutor(max_workers=self.n_workers)
+                    if self.n_workers > 1 else None)
+
+        def get_correlograms(cluster_ids, bin_size, window_size):
+            """Correlograms of the clusters, as `_get_correlograms`"""
+            cluster_ids = [int(c) for c in cluster_ids]
+            params = (float(bin_size), float(window_size))
+
+            # Ordered by cluster id such that the counts of a pair do not
+            # depend on the selection order
+            ordered = sorted(set(cluster_ids))
+            counts, missing = cache.get(ordered, params)
+            if missing:
+                # Only the pairs with the missing clusters
+                trains = [controller.model.spike_times[controller.selector(
+                    controller.n_spikes_correlograms, [c])]
+                    for c in ordered]
+                rows = ([ordered.index(c) for c in missing]
+                        if counts is not None else None)
+                n_spikes = sum(len(trains[i]) for i in rows or
+                               range(len(ordered)))
+                new = ccg_counts(
+                    trains, controller.model.sample_rate, bin_size,
+                    window_size, executor=executor
+                    if n_spikes >= self.min_spikes_parallel else None,
+                    n_chunks=self.n_workers, rows=rows)
+                if counts is None:
+                    counts = new
+                else:
+                    counts[rows] = new[rows]
+                    counts[:, rows] = new[:, rows]
+                cache.put(ordered, params, counts)
+                logger.debug('Computed the correlograms of %i of %i '
+                             'clusters (%i spikes).', len(missing),
+                             len(ordered), n_spikes)
+
+            index = [ordered.index(c) for c in cluster_ids]
+            return symmetrize(counts[np.ix_(index, index)])
+
+        @connect
+        def on_controller_ready(sender):
+            # Replaces phy's method (and its disk cache, keyed by selection)
+            controller._get_correlograms = get_correlograms
+
+        @connect
+        def on_gui_ready(sender, gui):
+            if executor is None:
+                return
+
+            @connect(sender=gui)
+            def on_close(sender):
+                executor.shutdown(wait=False)
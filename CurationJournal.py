@@ -0,0 +1,350 @@
+"""
+Journal of all curation actions for crash recovery
+
+The effect of every split, merge, label change, undo and redo is
+appended to a journal file in the `.phy` folder of the data directory as
+soon as it happens: the new cluster assignment of the moved spikes
+(compact binary records, or the merged clusters for merges) with the
+labels of the new clusters, and the new values of changed labels. Undo
+and redo are recorded by what they changed, not as history operations,
+such that the journal does not depend on the undo history of the
+session. The file is flushed after every record and synced to disk at
+most every `fsync_interval` seconds.
+
+If phy crashed, the journal is replayed when the GUI is ready, such
+that the session continues where it ended. The journal is cleared after
+a successful save and when closing phy (saving or not), and after an
+auto-save (see `Autosave`) for the actions up to that auto-save.
+
+The records are numbered. A marker file next to the journal tells which
+version of `spike_clusters.npy` contains the actions up to which record.
+The auto-save writes it right before its new `spike_clusters.npy`
+replaces the old one, such that assignments that already are on disk
+are never replayed again, even after a crash during the auto-save.
+Labels are replayed in any case, as they are stored as absolute values.
+"""
+
+import json
+import logging
+import os
+import struct
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from phylib.utils import emit
+from PyQt5.QtCore import QTimer
+
+logger = logging.getLogger('phy')
+
+# Record header: type (b'A' assignment, b'J' JSON), number and payload size
+_HEADER = struct.Struct('<cQQ')
+
+
+def encode_assign(spike_ids, spike_clusters, labels):
+    """Binary payload of a cluster assignment with the new labels"""
+    spike_ids = np.asarray(spike_ids, dtype=np.int64)
+    spike_clusters = np.asarray(spike_clusters, dtype=np.int64)
+    return struct.pack('<Q', spike_ids.size) + spike_ids.tobytes() + \
+        spike_clusters.tobytes() + json.dumps(labels).encode('utf-8')
+
+
+def decode_assign(payload):
+    """Spike ids, new cluster ids and new labels of an assignment"""
+    n, = struct.unpack_from('<Q', payload)
+    spike_ids = np.frombuffer(payload, dtype=np.int64, count=n, offset=8)
+    spike_clusters = np.frombuffer(payload, dtype=np.int64, count=n,
+                                   offset=8 + 8 * n)
+    labels = json.loads(payload[8 + 16 * n:].decode('utf-8'))
+    return spike_ids, spike_clusters, labels
+
+
+def read_records(path):
+    """
+    Iterate over the records of a journal
+
+    An incomplete record at the end (crash while writing) is ignored.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            kind, seq, size = _HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                logger.debug('Ignore incomplete journal record.')
+                return
+            if kind == b'A':
+                spike_ids, spike_clusters, labels = decode_assign(payload)
+                yield dict(op='assign', seq=seq, spike_ids=spike_ids,
+                           spike_clusters=spike_clusters, labels=labels)
+            else:
+                yield dict(json.loads(payload.decode('utf-8')), seq=seq)
+
+
+def file_id(path):
+    """Identity of a file version (inode and modification time)"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_mtime_ns]
+
+
+def read_marker(path):
+    """Entries `{seq, file}` of a marker file, or None"""
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_marker(path, entries):
+    """Atomically replace a marker file"""
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(entries, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CurationJournal(IPlugin):
+    # Maximum time between syncs of the journal to disk (seconds)
+    fsync_interval = 2
+
+    def attach_to_controller(self, controller):
+        self.file = None
+        self.unsynced = False
+        self.replaying = False
+        self.seq = 0  # Number of the last record
+
+        def paths():
+            path = Path(controller.dir_path) / '.phy'
+            path.mkdir(exist_ok=True)
+            return (path / 'curation_journal',
+                    path / 'curation_journal.old',
+                    path / 'curation_journal.saved')
+
+        def spike_clusters_path():
+            return Path(controller.model.dir_path) / 'spike_clusters.npy'
+
+        def marker_entries():
+            """Saved versions of spike_clusters.npy and their last record"""
+            entries = read_marker(paths()[2])
+            if entries is None:
+                # The journal starts from the current file
+                entries = [dict(seq=self.seq,
+                                file=file_id(spike_clusters_path()))]
+            return entries
+
+        def write(kind, payload):
+            if self.replaying:
+                return
+            if self.file is None:
+                current, _, marker = paths()
+                if not marker.exists():
+                    write_marker(marker, marker_entries())
+                self.file = open(current, 'ab')
+            self.seq += 1
+            self.file.write(_HEADER.pack(kind, self.seq, len(payload)) +
+                            payload)
+            self.file.flush()
+            self.unsynced = True
+
+        def write_json(**record):
+            write(b'J', json.dumps(record).encode('utf-8'))
+
+        def sync():
+            if self.unsynced and self.file is not None:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+        def close():
+            if self.file is not None:
+                sync()
+                self.file.close()
+                self.file = None
+
+        def clear(which=(0, 1, 2)):
+            if 0 in which:
+                close()
+            for i in which:
+                path = paths()[i]
+                if path.exists():
+                    path.unlink()
+
+        def current_labels(cluster_ids):
+            """Values of all labels of some clusters"""
+            meta = controller.supervisor.cluster_meta
+            return {field: {int(c): meta.get(field, c) for c in cluster_ids}
+                    for field in meta.fields if field != 'next_cluster'}
+
+        def set_labels(labels, silent=False):
+            """Set the recorded labels that differ from the current ones"""
+            sup = controller.supervisor
+            meta = sup.cluster_meta
+            existing = set(sup.clustering.cluster_ids)
+            for field, values in labels.items():
+                by_value = {}
+                for c, value in values.items():
+                    c = int(c)
+                    if c in existing and (field not in meta.fields or
+                                          meta.get(field, c) != value):
+                        by_value.setdefault(value, []).append(c)
+                for value, cluster_ids in by_value.items():
+                    if silent:
+                        meta.set(field, cluster_ids, value,
+                                 add_to_stack=False)
+                    else:
+                        sup.label(field, value, cluster_ids=cluster_ids)
+
+        def assign(spike_ids, spike_clusters, labels):
+            """Apply a recorded assignment as an action that can be undone"""
+            sup = controller.supervisor
+            clustering = sup.clustering
+            spike_ids = np.asarray(spike_ids, dtype=np.int64)
+            if spike_ids.size and (spike_ids.min() < 0 or
+                                   spike_ids.max() >= clustering.n_spikes):
+                raise ValueError('Some spikes do not exist.')
+            up = clustering._do_assign(spike_ids, spike_clusters)
+            undo_state = emit('request_undo_state', clustering, up)
+            clustering._undo_stack.add((spike_ids, spike_clusters,
+                                        undo_state))
+            # Labels of the new clusters before the views are updated
+            set_labels(labels, silent=True)
+            emit('cluster', clustering, up)
+            sup._global_history.action(clustering)
+            set_labels(labels)
+
+        def discard():
+            """Keep the journal for inspection, but do not replay again"""
+            for path in paths():
+                if path.exists():
+                    path.rename(path.with_name(path.name + '.failed'))
+
+        def replay():
+            """Apply the actions of the journal after a crash"""
+            sup = controller.supervisor
+            current, old, marker = paths()
+            try:
+                records = [r for path in (old, current) if path.exists()
+                           for r in read_records(path)]
+            except Exception as e:
+                logger.error('Could not read the journal: %s', e)
+                discard()
+                return
+            entries = read_marker(marker)
+            if entries:
+                self.seq = max(e['seq'] for e in entries)
+            if not records:
+                return
+            self.seq = max(self.seq, max(r['seq'] for r in records))
+
+            # Last record whose assignment is in spike_clusters.npy
+            if entries is None:
+                saved = 0
+            else:
+                cur = file_id(spike_clusters_path())
+                matches = [e['seq'] for e in entries if e['file'] == cur]
+                saved = max(matches) if matches else None
+            if saved is None:
+                logger.info('The clustering was saved after the last '
+                            'journal entry, only restore the labels.')
+
+            logger.warn('Restore %i curation actions of the previous '
+                        'session from journal.', len(records))
+            self.replaying = True
+            try:
+                for r in records:
+                    skip = saved is None or r['seq'] <= saved
+                    if r['op'] == 'label' or skip:
+                        set_labels(r['labels'])
+                    elif r['op'] == 'assign':
+                        assign(r['spike_ids'], r['spike_clusters'],
+                               r['labels'])
+                    elif r['op'] == 'merge':
+                        spike_ids = sup.clustering.spikes_in_clusters(
+                            r['cluster_ids'])
+                        assign(spike_ids, [r['to']], r['labels'])
+            except Exception as e:
+                logger.error('Restoring from journal failed: %s', e)
+                discard()
+            else:
+                if saved is None:
+                    # Nothing to keep: start from the saved file
+                    clear()
+            finally:
+                self.replaying = False
+
+        @connect
+        def on_gui_ready(sender, gui):
+            replay()
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                sup = controller.supervisor
+                if up.description.startswith('metadata_'):
+                    # New values, also for undo and redo
+                    field = up.description[9:]
+                    write_json(op='label', labels={field: {
+                        int(c): sup.cluster_meta.get(field, c)
+                        for c in up.metadata_changed}})
+                elif len(up.added) == 1:
+                    # Merge of whole clusters (also undo of a split)
+                    write_json(op='merge',
+                               cluster_ids=list(map(int, up.deleted)),
+                               to=int(up.added[0]),
+                               labels=current_labels(up.added))
+                elif up.added:
+                    spike_ids = np.asarray(up.spike_ids)
+                    write(b'A', encode_assign(
+                        spike_ids, sup.clustering.spike_clusters[spike_ids],
+                        current_labels(up.added)))
+
+            @connect(sender=controller.supervisor)
+            def on_save_clustering(sender, *args):
+                logger.debug('Clear curation journal.')
+                clear()
+
+            # Clear the journal once the GUI closes (unless closing was
+            # cancelled): unsaved actions are only restored after a crash
+            close_event = gui.closeEvent
+
+            def closeEvent(e):
+                close_event(e)
+                if gui._closed:
+                    clear()
+
+            gui.closeEvent = closeEvent
+
+            @connect
+            def on_autosave_snapshot(sender):
+                # Continue with a new journal during the auto-save
+                close()
+                current, old, marker = paths()
+                if current.exists():
+                    if old.exists():
+                        # Previous auto-save failed: keep its actions
+                        with open(old, 'ab') as f:
+                            f.write(current.read_bytes())
+                        current.unlink()
+                    else:
+                        current.rename(old)
+                entries = marker_entries()
+                seq = self.seq
+
+                def commit(tmp):
+                    """Mark the new spike_clusters.npy before it is used"""
+                    write_marker(marker, entries + [
+                        dict(seq=seq, file=file_id(tmp))])
+
+                return commit
+
+            @connect
+            def on_autosave_done(sender):
+                clear(which=(1,))
+
+            timer = QTimer(gui)
+            timer.timeout.connect(sync)
+            timer.start(self.fsync_interval * 1000)
@@ -1,23 +1,39 @@
 """
-Add event markers to the amplitude view
+Add event markers to the amplitude view and the trace view
 
-The event markers are read from the file `eventmarkers.txt`. The file is
+The event markers are read from the file `eventmarkers.npy` (memory-
+mapped) or, if not present, from `eventmarkers.txt`. The text file is
 expected to contain one event per line. If the events are provided as
 floats (with decimal point), they are treated as seconds. If they are
 provided as integers (no decimal point), they are treated as samples.
-Optionally, corresponding names can be supplied in
+The same applies to the data type of the binary file. Optionally,
+corresponding names can be supplied in `eventmarkernames.npy` or
 `eventmarkernames.txt`.
 
+The files are loaded in a background thread. Only the events within the
+currently visible time range are drawn. If there are more than
+`max_lines` of them, they are decimated to every n-th event, and labels
+are only drawn for at most `max_labels` of them.
+
 The event markers may be toggled on/off from the amplitude view menu or
-by keyboard shortcut.
+by keyboard shortcut, and from the trace view menu.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from phy import IPlugin, connect
 from phy.cluster.views import AmplitudeView, TraceView
 from phy.plot.visuals import LineVisual, TextVisual
 from phy.plot.transform import _fix_coordinate_in_visual
+from PyQt5.QtCore import QTimer
 import logging
 import numpy as np
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_events import load_events, visible_events  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -26,106 +42,205 @@ class EventMarker(IPlugin):
     # Line color of the event markers
     line_color = (1, 1, 1, 0.75)
 
+    # Maximum number of lines and labels drawn in the visible range
+    max_lines = 1000
+    max_labels = 50
+
+    # Interval to check for a changed visible range (milliseconds)
+    refresh_interval = 200
+
     def attach_to_controller(self, controller):
+        self.data = None  # Loaded events
+        self.views = []  # Registered views and their visuals
+        executor = ThreadPoolExecutor(max_workers=1)
+        loading = []
+
+        @connect
+        def on_controller_ready(sender):
+            # Start reading the event markers off the GUI thread
+            loading.append(executor.submit(load_events, controller.dir_path,
+                                           controller.model.sample_rate))
+
+        def time_range(view):
+            """Time range spanning the view (without pan and zoom)"""
+            if isinstance(view, TraceView):
+                return view.interval
+            return 0, view.duration
+
+        def visible_range(view):
+            """Time range currently visible within the view"""
+            b0, b1 = time_range(view)
+            pan = view.canvas.panzoom.pan[0]
+            zoom = view.canvas.panzoom.zoom[0]
+            x = np.clip([-1 / zoom - pan, 1 / zoom - pan], -1, 1)
+            t0, t1 = b0 + (x + 1) / 2 * (b1 - b0)
+            return t0, t1
+
+        def labels(idx):
+            """Names of the events at sorted indices"""
+            d = self.data
+            idx = d['order'][idx] if d['order'] is not None else idx
+            if d['names'] is None:
+                return [str(i + 1) for i in idx]
+            return [str(d['names'][i]) if i < d['names'].size
+                    else str(i + 1) for i in idx]
+
+        def plot(entry, force=False):
+            """Draw the markers visible in the current range"""
+            if self.data is None:
+                return
+            view = entry['view']
+            b0, b1 = time_range(view)
+            t0, t1 = visible_range(view)
+            d = self.data
+            idx = visible_events(d['times'], d['scale'], t0, t1,
+                                 self.max_lines)
+
+            # Skip redrawing if the same markers would be drawn
+            key = (b0, b1, idx[0] if idx.size else None, idx.size)
+            if key == entry['key'] and not force:
+                return
+            entry['key'] = key
+
+            if idx.size == 0 or not view.show_events:
+                entry['line'].hide()
+                entry['text'].hide()
+                view.canvas.update()
+                return
+
+            # Obtain horizontal positions
+            t = d['times'][idx] * d['scale']
+            x = -1 + 2 * (t - b0) / (b1 - b0)
+            x = x.repeat(4, 0).reshape(-1, 4)
+            x[:, 1::2] = 1, -1
+
+            # Add lines and update view
+            entry['line'].reset_batch()
+            entry['line'].add_batch_data(pos=x, color=self.line_color)
+            view.canvas.update_visual(entry['line'])
+
+            # Add text for a subset of the lines and update view
+            step = max(1, -(-idx.size // self.max_labels))
+            entry['text'].reset_batch()
+            entry['text'].add_batch_data(pos=x[::step, :2], anchor=(1, -1),
+                                         text=labels(idx[::step]))
+            view.canvas.update_visual(entry['text'])
+
+            entry['line'].show()
+            entry['text'].show()
+            view.canvas.update()
+
+        def finish_loading():
+            """Apply the loaded events once the background thread is done"""
+            try:
+                self.data = loading[0].result()
+            except Exception as e:
+                # Logged once: the timer stops without data
+                if isinstance(e, FileNotFoundError):
+                    logger.warn('Event marker file not found: `%s`.',
+                                controller.dir_path / 'eventmarkers.txt')
+                else:
+                    logger.error('Could not load the event markers: %s', e)
+                for entry in self.views:
+                    entry['view'].show_events = False
+                return
+            logger.debug('Loaded %i event markers.',
+                         self.data['events'].size)
+            for entry in self.views:
+                enable(entry)
+
+        def enable(entry):
+            """Enable the menu and show the markers of a view"""
+            view = entry['view']
+            logger.debug('Enable menu items.')
+            for name in entry['actions']:
+                view.actions.enable(name)
+            if view.show_events:
+                view.actions.get('Toggle event markers').toggle()
+            else:
+                entry['line'].hide()
+                entry['text'].hide()
+            plot(entry, force=True)
+
+        def refresh():
+            """Check for loaded events and changes of the visible range"""
+            if self.data is None:
+                if loading and loading[0].done():
+                    finish_loading()
+                    if self.data is None:
+                        self.timer.stop()
+                return
+            for entry in self.views:
+                plot(entry)
+
+        @connect
+        def on_gui_ready(sender, gui):
+            self.timer = QTimer(gui)
+            self.timer.timeout.connect(refresh)
+            self.timer.start(self.refresh_interval)
+
         @connect
         def on_view_attached(view, gui):
-            if isinstance(view, AmplitudeView):
-                # Create batch of vertical lines (full height)
-                self.line_visual = LineVisual()
-                _fix_coordinate_in_visual(self.line_visual, 'y')
-                view.canvas.add_visual(self.line_visual)
-
-                # Create batch of annotative text
-                self.text_visual = TextVisual(self.line_color)
-                _fix_coordinate_in_visual(self.text_visual, 'y')
-                self.text_visual.inserter.insert_vert(
-                    'gl_Position.x += 0.001;', 'after_transforms')
-                view.canvas.add_visual(self.text_visual)
-
-                @view.actions.add(shortcut='alt+b', checkable=True,
-                                  name='Toggle event markers')
-                def toggle(on):
-                    """Toggle event markers"""
-                    # Use `show` and `hide` instead of `toggle` here in
-                    # case synchronization issues
-                    if on:
-                        logger.debug('Toggle on markers.')
-                        self.line_visual.show()
-                        self.text_visual.show()
-                        view.show_events = True
-                    else:
-                        logger.debug('Toggle off markers.')
-                        self.line_visual.hide()
-                        self.text_visual.hide()
-                        view.show_events = False
-                    view.canvas.update()
+            if not isinstance(view, (AmplitudeView, TraceView)):
+                return
+
+            # Create batch of vertical lines (full height)
+            line_visual = LineVisual()
+            _fix_coordinate_in_visual(line_visual, 'y')
+
+            # Create batch of annotative text
+            text_visual = TextVisual(self.line_color)
+            _fix_coordinate_in_visual(text_visual, 'y')
+            text_visual.inserter.insert_vert(
+                'gl_Position.x += 0.001;', 'after_transforms')
+
+            if isinstance(view, TraceView):
+                # Span all channels instead of one box of the layout
+                view.canvas.add_visual(line_visual,
+                                       exclude_origins=(view.canvas.interact,))
+                view.canvas.add_visual(text_visual,
+                                       exclude_origins=(view.canvas.interact,))
+            else:
+                view.canvas.add_visual(line_visual)
+                view.canvas.add_visual(text_visual)
+
+            entry = dict(view=view, line=line_visual, text=text_visual,
+                         key=None, actions=['Toggle event markers'])
+
+            @view.actions.add(shortcut=('alt+b' if isinstance(
+                                  view, AmplitudeView) else None),
+                              checkable=True, name='Toggle event markers')
+            def toggle(on):
+                """Toggle event markers"""
+                # Use `show` and `hide` instead of `toggle` here in
+                # case synchronization issues
+                if on:
+                    logger.debug('Toggle on markers.')
+                    view.show_events = True
+                else:
+                    logger.debug('Toggle off markers.')
+                    view.show_events = False
+                plot(entry, force=True)
 
+            if isinstance(view, AmplitudeView):
                 @view.actions.add(shortcut='shift+alt+e', prompt=True,
                                   name='Go to event', alias='ge')
                 def Go_to_event(event_num):
                     trace_view = gui.get_view(TraceView)
+                    events = self.data['events']
                     if 0 < event_num <= events.size:
-                        trace_view.go_to(events[event_num - 1])
+                        trace_view.go_to(events[event_num - 1]
+                                         * self.data['scale'])
 
-                # Disable the menu until events are successfully added
-                view.actions.disable('Go to event')
-                view.actions.disable('Toggle event markers')
-                if not hasattr(view, 'show_events'):
-                    view.show_events = True
-                view.state_attrs += ('show_events',)
+                entry['actions'].append('Go to event')
 
-                # Read event markers from file
-                filename = controller.dir_path / 'eventmarkers.txt'
-                try:
-                    events = np.genfromtxt(filename, usecols=0, dtype=None)
-                except (FileNotFoundError, OSError):
-                    logger.warn('Event marker file not found: `%s`.',
-                                filename)
-                    view.show_events = False
-                    return
-
-                # Create list of event names
-                labels = list(map(str, range(1, events.size + 1)))
-
-                # Read event names from file (if present)
-                filename = controller.dir_path / 'eventmarkernames.txt'
-                try:
-                    eventnames = np.loadtxt(filename, usecols=0, dtype=str,
-                                            max_rows=events.size)
-                    labels[:eventnames.size] = np.atleast_1d(eventnames)
-                except (FileNotFoundError, OSError):
-                    logger.info('Event marker names file not found (optional):'
-                                ' `%s`. Fall back to numbering.', filename)
-
-                # Obtain seconds from samples
-                if events.dtype == int:
-                    logger.debug('Converting input from samples to seconds.')
-                    events = events / controller.model.sample_rate
-
-                logger.debug('Add event markers to amplitude view.')
-
-                # Obtain horizontal positions
-                x = -1 + 2 * events / view.duration
-                x = x.repeat(4, 0).reshape(-1, 4)
-                x[:, 1::2] = 1, -1
-
-                # Add lines and update view
-                self.line_visual.reset_batch()
-                self.line_visual.add_batch_data(pos=x, color=self.line_color)
-                view.canvas.update_visual(self.line_visual)
-
-                # Add text and update view
-                self.text_visual.reset_batch()
-                self.text_visual.add_batch_data(pos=x[:, :2], anchor=(1, -1),
-                                                text=labels)
-                view.canvas.update_visual(self.text_visual)
-
-                # Finally enable the menu
-                logger.debug('Enable menu items.')
-                view.actions.enable('Go to event')
-                view.actions.enable('Toggle event markers')
-                if view.show_events:
-                    view.actions.get('Toggle event markers').toggle()
-                else:
-                    self.line_visual.hide()
-                    self.text_visual.hide()
+            # Disable the menu until events are successfully added
+            for name in entry['actions']:
+                view.actions.disable(name)
+            if not hasattr(view, 'show_events'):
+                view.show_events = True
+            view.state_attrs += ('show_events',)
+
+            self.views.append(entry)
+            if self.data is not None:
+                enable(entry)
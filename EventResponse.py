@@ -0,0 +1,230 @@
+"""
+Event-aligned raster and PSTH view, and stimulus response column
+
+The events are read from `eventmarkers.npy` or `eventmarkers.txt` as
+described in `EventMarker`. The view (add it from the View menu) shows
+the spike raster around each event (top) and the peri-stimulus time
+histogram (bottom) for each selected cluster.
+
+Additionally, a column 'resp' is added to the cluster view. It contains
+a response index of each cluster ranging from -1 (silenced by the
+events) to 1 (firing only after the events), comparing the firing rate
+before and after the events. It is computed for all clusters at once in
+a background thread once the event markers are loaded, and the column is
+filled in once done. New clusters (splits and merges) are computed on demand.
+
+The raster and the response index of each cluster are cached and
+discarded when the cluster is removed by a split or merge.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from phy import IPlugin, connect
+from phy.cluster.views import ManualClusteringView
+from phy.plot.visuals import HistogramVisual, LineVisual, ScatterVisual
+from phy.utils.color import selected_cluster_color
+from PyQt5.QtCore import QTimer
+import logging
+import numpy as np
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_events import (load_events, align_spikes,  # noqa: E402
+                           response_strength, response_strengths)
+
+logger = logging.getLogger('phy')
+
+
+class PSTHView(ManualClusteringView):
+    """Event-aligned raster and PSTH of the selected clusters"""
+    _default_position = 'right'
+
+    # Maximum number of points in the raster of each cluster
+    max_points = 20000
+
+    def __init__(self, get_raster=None, window=None, bin_size=None):
+        super(PSTHView, self).__init__()
+        self.get_raster = get_raster
+        self.window = window
+        self.bin_size = bin_size
+
+        self.canvas.set_layout('grid', shape=(2, 1))
+
+        self.raster_visual = ScatterVisual(marker='vbar')
+        self.canvas.add_visual(self.raster_visual)
+
+        self.psth_visual = HistogramVisual()
+        self.canvas.add_visual(self.psth_visual)
+
+        # Event onset
+        self.line_visual = LineVisual()
+        self.canvas.add_visual(self.line_visual)
+
+    def on_select(self, cluster_ids=(), **kwargs):
+        self.cluster_ids = cluster_ids
+        if not cluster_ids:
+            return
+        self.plot()
+
+    def plot(self, **kwargs):
+        n = len(self.cluster_ids)
+        self.canvas.grid.shape = (2, n)
+        w0, w1 = self.window
+        bins = np.arange(w0, w1 + self.bin_size / 2, self.bin_size)
+
+        self.raster_visual.reset_batch()
+        self.psth_visual.reset_batch()
+        self.line_visual.reset_batch()
+        for i, cluster_id in enumerate(self.cluster_ids):
+            color = selected_cluster_color(i, alpha=1)
+            rel_times, event_idx, n_events = self.get_raster(cluster_id)
+
+            # Only show a subset of the events if there are too many
+            step = max(1, -(-rel_times.size // self.max_points))
+            keep = event_idx % step == 0
+
+            if np.any(keep):
+                self.raster_visual.add_batch_data(
+                    x=rel_times[keep], y=event_idx[keep], color=color,
+                    size=2, data_bounds=(w0, 0, w1, max(n_events, 1)),
+                    box_index=(0, i))
+
+            # Firing rate in Hz
+            hist, _ = np.histogram(rel_times, bins=bins)
+            rate = hist / (max(n_events, 1) * self.bin_size)
+            self.psth_visual.add_batch_data(hist=rate, color=color,
+                                            box_index=(1, i))
+
+            for j in range(2):
+                self.line_visual.add_batch_data(
+                    pos=[0, 0, 0, 1], color=(1, 1, 1, 0.5),
+                    data_bounds=(w0, 0, w1, 1), box_index=(j, i))
+
+        self.canvas.update_visual(self.raster_visual)
+        self.canvas.update_visual(self.psth_visual)
+        self.canvas.update_visual(self.line_visual)
+        self.canvas.update()
+
+
+class EventResponse(IPlugin):
+    # Time window around each event (seconds)
+    window = (-0.5, 1.0)
+
+    # Bin size of the PSTH (seconds)
+    bin_size = 0.02
+
+    # Interval to check for finished background work (milliseconds)
+    refresh_interval = 500
+
+    def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        jobs = dict()
+        self.events = None
+        self.rasters = dict()  # Raster per cluster
+        self.scores = dict()  # Response index per cluster
+        self.batch_done = False
+
+        def get_events():
+            """Sorted event times in seconds"""
+            if self.events is None:
+                try:
+                    data = jobs['events'].result()  # Blocks until loaded
+                except (FileNotFoundError, OSError):
+                    logger.warn('Event marker file not found: `%s`.',
+                                controller.dir_path / 'eventmarkers.txt')
+                    self.events = np.array([])
+                except Exception as e:
+                    logger.error('Could not load the event markers: %s', e)
+                    self.events = np.array([])
+                else:
+                    self.events = np.asarray(data['times'] * data['scale'],
+                                             dtype=np.float64)
+            return self.events
+
+        def get_raster(cluster_id):
+            """Event-aligned spike times of a cluster (cached)"""
+            if cluster_id not in self.rasters:
+                spike_times = np.asarray(controller.get_spike_times(
+                    cluster_id))
+                events = get_events()
+                self.rasters[cluster_id] = (
+                    *align_spikes(spike_times, events, self.window),
+                    events.size)
+            return self.rasters[cluster_id]
+
+        def response(cluster_id):
+            """Response index of a cluster (cached)"""
+            if cluster_id in self.scores:
+                return self.scores[cluster_id]
+            if not self.batch_done:
+                return None  # Filled in after the batch is done
+            events = get_events()
+            spike_times = np.asarray(controller.get_spike_times(cluster_id))
+            score = response_strength(spike_times, events, self.window)
+            self.scores[cluster_id] = round(score, 3)
+            return self.scores[cluster_id]
+
+        # Custom column in the cluster view
+        controller.cluster_metrics['resp'] = response
+
+        def create_psth_view():
+            return PSTHView(get_raster=get_raster, window=self.window,
+                            bin_size=self.bin_size)
+
+        controller.view_creator['PSTHView'] = create_psth_view
+
+        @connect
+        def on_controller_ready(sender):
+            # Start reading the event markers off the GUI thread
+            jobs['events'] = executor.submit(
+                load_events, controller.dir_path,
+                controller.model.sample_rate)
+
+        @connect
+        def on_gui_ready(sender, gui):
+            def check():
+                if 'scores' not in jobs:
+                    if not jobs['events'].done():
+                        return
+                    events = get_events()  # Loaded, does not block
+                    if events.size == 0:
+                        timer.stop()
+                        return
+                    # Compute the response index of all clusters in the
+                    # background
+                    logger.debug('Compute response index of all clusters.')
+                    jobs['scores'] = executor.submit(
+                        response_strengths, controller.model.spike_times,
+                        controller.supervisor.clustering.spike_clusters.copy(),
+                        events, self.window)
+                    return
+                if not jobs['scores'].done():
+                    return
+                timer.stop()
+                # Keep the clusters that were not changed in the meantime
+                cluster_ids = set(controller.supervisor.clustering.cluster_ids)
+                scores = jobs['scores'].result()
+                self.scores.update({c: round(s, 3) for c, s in scores.items()
+                                    if c in cluster_ids})
+                self.batch_done = True
+                logger.info('Computed response index of %i clusters.',
+                            len(scores))
+                # Fill in the column (without resetting the views)
+                sup = controller.supervisor
+                data = [dict(id=int(c), resp=response(c))
+                        for c in sup.clustering.cluster_ids]
+                sup.cluster_view.change(data)
+                sup.similarity_view.change(data)
+
+            timer = QTimer(gui)
+            timer.timeout.connect(check)
+            timer.start(self.refresh_interval)
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                # Discard the cache of removed clusters (split, merge)
+                for cluster_id in up.deleted:
+                    self.rasters.pop(cluster_id, None)
+                    self.scores.pop(cluster_id, None)
@@ -1,12 +1,24 @@
 """
 Additional jump options in trace view.
+
+The spike times of all selected clusters are merged into one sorted
+array once per selection. The array is kept until the selection or the
+spikes of the selected clusters change (see `plugin_generation`), such
+that each jump is a single binary search.
 """
 
 import logging
+import sys
+from pathlib import Path
 import numpy as np
 from phy import IPlugin, connect
 from phy.cluster.views.trace import TraceView as TraceView
 
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_generation import get_state  # noqa: E402
+
 logger = logging.getLogger('phy')
 
 
@@ -17,6 +29,36 @@ class JumpInTrace(IPlugin):
         @connect
         def on_view_attached(view, gui):
             if isinstance(view, TraceView):
+                # Merged spike times of the last selection
+                state = get_state(controller)
+                cache = dict(selected=None, generation=None,
+                             spike_times=None)
+
+                def _merged_spike_times(selected):
+                    """
+                    Return the sorted spike times of all selected
+                    clusters, recomputed only if the selection changed.
+                    """
+                    selected = tuple(selected)
+                    if cache['selected'] == selected and not state.changed(
+                            cache['generation'], selected, labels=False):
+                        return cache['spike_times']
+
+                    # The spike times of each cluster are already sorted.
+                    # The stable sort (timsort) detects these runs and
+                    # effectively performs a k-way merge
+                    spt = [np.asarray(controller.get_spike_times(sel))
+                           for sel in selected]
+                    spt = np.concatenate(spt) if spt else np.array([])
+                    spike_times = np.sort(spt, kind='stable')
+
+                    logger.debug('Merged %i spike times of clusters %s.',
+                                 spike_times.size,
+                                 ', '.join(map(str, selected)))
+                    cache.update(selected=selected,
+                                 generation=state.generation,
+                                 spike_times=spike_times)
+                    return spike_times
 
                 def _jump_to_spike(delta=+1):
                     """
@@ -25,13 +67,11 @@ class JumpInTrace(IPlugin):
                     time = view.time  # Current position
 
                     selected = controller.supervisor.selected
-                    spt = np.array([])
-                    for sel in selected:
-                        spt = np.hstack((spt,
-                                         (controller.get_spike_times(sel))))
-                    spike_times = np.sort(spt)
-                    ind = np.searchsorted(spike_times, time)
+                    spike_times = _merged_spike_times(selected)
                     n = len(spike_times)
+                    if n == 0:
+                        return
+                    ind = np.searchsorted(spike_times, time)
                     target = spike_times[(ind + delta) % n]
                     logger.debug('Jump with %+d to one of the spikes from '
                                  'clusters %s. Jumped from %.5f to %.5f.',
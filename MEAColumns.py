@@ -1,17 +1,236 @@
-"""Remove unneccessary columns for curating MEA data"""
+"""
+Remove unneccessary columns for curating MEA data
 
+The columns 'sh' and 'depth' are meaningless on a 2-D MEA. Instead, the
+columns 'x' and 'y' hold the position of each cluster: the centroid of
+the channel positions weighted by the amplitude of its template above
+the noise level (median amplitude across channels).
+
+The cluster positions are kept in a spatial index (KD-tree), which
+answers the action 'Select clusters within distance' (in µm, or the unit
+of `channel_positions.npy`) around the first selected cluster. The index
+is updated on splits and merges without being rebuilt each time.
+
+The template amplitudes are computed in a background thread when the
+controller is ready. Until then, the columns 'x' and 'y' are empty; they
+are filled in once the positions are known.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
 from phy import IPlugin, connect
+from PyQt5.QtCore import QTimer
+from pathlib import Path
 import logging
+import numpy as np
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_templates import get_template_amplitudes  # noqa: E402
 
 logger = logging.getLogger('phy')
 
 
+def template_positions(ptp, channel_positions):
+    """Amplitude-weighted centroid of each template, shape (n, 2)"""
+    weights = ptp - np.median(ptp, axis=1, keepdims=True)
+    np.clip(weights, 0, None, out=weights)
+    total = weights.sum(axis=1, keepdims=True)
+    positions = weights @ channel_positions / np.where(total > 0, total, 1)
+
+    # Fall back to the best channel for flat templates
+    flat = total[:, 0] == 0
+    positions[flat] = channel_positions[np.argmax(ptp[flat], axis=1)]
+    return positions
+
+
+class SpatialIndex(object):
+    """
+    KD-tree of cluster positions with incremental updates
+
+    Added clusters are kept aside and searched exhaustively, removed
+    clusters are masked, until `rebuild_threshold` changes accumulated
+    and the tree is rebuilt.
+    """
+    rebuild_threshold = 256
+
+    def __init__(self, positions):
+        self.positions = dict(positions)
+        self._rebuild()
+
+    def _rebuild(self):
+        from scipy.spatial import cKDTree  # Deferred import
+        self.ids = np.array(list(self.positions), dtype=np.int64)
+        points = np.array([self.positions[c] for c in self.ids])
+        self.tree = cKDTree(points.reshape(-1, 2)) if self.ids.size else None
+        self.in_tree = set(self.ids.tolist())
+        self.added = dict()
+        self.removed = set()
+
+    def _check(self):
+        if len(self.added) + len(self.removed) > self.rebuild_threshold:
+            self._rebuild()
+
+    def add(self, cluster_id, position):
+        self.positions[cluster_id] = position
+        if cluster_id in self.in_tree:
+            self.removed.discard(cluster_id)  # Restored by undo
+        else:
+            self.added[cluster_id] = position
+        self._check()
+
+    def remove(self, cluster_id):
+        self.positions.pop(cluster_id, None)
+        if self.added.pop(cluster_id, None) is None \
+                and cluster_id in self.in_tree:
+            self.removed.add(cluster_id)
+        self._check()
+
+    def query_radius(self, position, radius):
+        """Clusters within a distance of a position"""
+        found = []
+        if self.tree is not None:
+            idx = self.tree.query_ball_point(position, radius)
+            found = [c for c in self.ids[idx].tolist()
+                     if c not in self.removed]
+        found += [c for c, p in self.added.items()
+                  if np.hypot(p[0] - position[0], p[1] - position[1])
+                  <= radius]
+        return found
+
+
 class MEAColumns(IPlugin):
+    # Safety measure of maximum resulting selections
+    max_selections = 50
+
+    # Interval to check whether the positions are computed (milliseconds)
+    refresh_interval = 200
+
     def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        jobs = dict()
+        positions = dict()  # Position per cluster
+        index = []
+
+        def compute_template_positions():
+            return template_positions(
+                np.asarray(get_template_amplitudes(controller)),
+                np.asarray(controller.model.channel_positions))
+
+        def get_template_positions():
+            """Position of each template (blocks until computed)"""
+            if not hasattr(self, 'template_positions'):
+                if 'positions' not in jobs:
+                    jobs['positions'] = executor.submit(
+                        compute_template_positions)
+                self.template_positions = jobs['positions'].result()
+            return self.template_positions
+
+        def ready():
+            """Whether the positions were computed successfully"""
+            job = jobs.get('positions')
+            return (job is not None and job.done()
+                    and job.exception() is None)
+
+        def position(cluster_id):
+            if cluster_id not in positions:
+                template_id = controller.get_template_for_cluster(cluster_id)
+                positions[cluster_id] = get_template_positions()[template_id]
+            return positions[cluster_id]
+
+        def get_index():
+            """Spatial index of all clusters (built on first use)"""
+            if not index:
+                cluster_ids = controller.supervisor.clustering.cluster_ids
+                index.append(SpatialIndex(
+                    {int(c): position(c) for c in cluster_ids}))
+            return index[0]
+
+        def column(dim):
+            def metric(cluster_id):
+                if not ready():
+                    return None  # Filled in once the positions are known
+                return round(float(position(cluster_id)[dim]), 1)
+            return metric
+
+        # Custom columns in the cluster view
+        controller.cluster_metrics['x'] = column(0)
+        controller.cluster_metrics['y'] = column(1)
+
         @connect
         def on_controller_ready(sender):
+            # Compute the positions off the GUI thread
+            jobs['positions'] = executor.submit(compute_template_positions)
+
             columns_to_remove = ['sh', 'depth', 'Amplitude']
             for col in columns_to_remove:
                 if col in controller.supervisor.columns:
                     logger.debug('Remove column `%s`.', col)
                     controller.supervisor.columns.remove(col)
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                if not index:
+                    return
+                for cluster_id in up.deleted:
+                    index[0].remove(cluster_id)
+                for cluster_id in up.added:
+                    index[0].add(cluster_id, position(cluster_id))
+
+        @connect
+        def on_gui_ready(sender, gui):
+            def check():
+                job = jobs.get('positions')
+                if job is None or not job.done():
+                    return
+                timer.stop()
+                if job.exception() is not None:
+                    logger.error('Could not compute the cluster positions: '
+                                 '%s', job.exception())
+                    return
+                logger.debug('Computed the positions of the clusters.')
+                # Fill in the columns (without resetting the views)
+                sup = controller.supervisor
+                data = [dict(id=int(c), x=column(0)(c), y=column(1)(c))
+                        for c in sup.clustering.cluster_ids]
+                sup.cluster_view.change(data)
+                sup.similarity_view.change(data)
+
+            timer = QTimer(gui)
+            timer.timeout.connect(check)
+            timer.start(self.refresh_interval)
+
+            @controller.supervisor.actions.add(name='Select clusters within '
+                                                    'distance',
+                                               alias='seldist',
+                                               menu='Sele&ct',
+                                               prompt=True,
+                                               prompt_default=lambda: 50)
+            def Select_clusters_within(radius):
+                """Select all non-noise clusters within a distance (µm)"""
+                sup = controller.supervisor
+
+                # Safety check in case there was no prior selection
+                if not sup.selected_clusters:
+                    logger.debug('No clusters selected.')
+                    return
+
+                cid = sup.selected_clusters[0]
+                center = position(cid)
+                groups = sup.get_labels('group')
+                sel = [c for c in get_index().query_radius(center, radius)
+                       if c != cid and groups.get(c) != 'noise']
+
+                # Nearest first
+                sel.sort(key=lambda c: np.hypot(*(position(c) - center)))
+
+                # Safety measure
+                if len(sel) + 1 > self.max_selections:
+                    logger.warn('Capped the number of selections from %i '
+                                'to %i.', len(sel) + 1, self.max_selections)
+                    sel = sel[:self.max_selections - 1]
+
+                logger.info('Select %i non-noise clusters within %g of '
+                            'cluster %i.', len(sel), radius, cid)
+                sup.select([cid] + sel)
@@ -1,26 +1,91 @@
 """
 Highlight all clusters in the same channel
+
+The highlighting is re-applied whenever the table is updated (sorting,
+new clusters, rows rendered while scrolling a virtualized table). While
+stepping quickly through the clusters, only the last selection is
+highlighted. The best channel of each cluster is kept until the spikes
+of the cluster change (see `plugin_generation`).
 """
 
 import numpy as np
+from pathlib import Path
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
 from phy.utils.color import selected_cluster_color
 import logging
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_generation import ClusterCache, get_state  # noqa: E402
+from plugin_jsbridge import get_bridge  # noqa: E402
+from plugin_scheduler import get_scheduler  # noqa: E402
 
 logger = logging.getLogger('phy')
 
 
+# Highlighting by cluster id, kept for rows that are rendered later (e.g.
+# virtualized table, see `VirtualTable`)
+js_highlight = """
+    function(clust) {
+        window.channelHighlight = clust;
+        if (!window.applyChannelHighlight) {
+            window.applyChannelHighlight = function() {
+                var ll = window.channelHighlight;
+                var itms = document.getElementsByTagName("tr");
+                var chng = []
+                for (var i = 0; i < itms.length; i++) {
+                    var c_id = itms[i].getAttribute('data-_id');
+
+                    // New clusters do not have this attribute
+                    if (!c_id) {
+                        c_id = itms[i].getElementsByClassName('id')
+                        if (c_id.length) {
+                            c_id = c_id[0].innerHTML;
+                        } else {
+                            continue;
+                        }
+                    };
+
+                    if (ll.hasOwnProperty(c_id)) {
+                        itms[i].style.background = ll[c_id];
+                        chng.push(c_id);
+                    } else {
+                        itms[i].style.background = '';
+                    }
+                }
+                return chng;
+            };
+            table.on('updated', window.applyChannelHighlight);
+        }
+
+        // Report highlighted clusters to callback function
+        return window.applyChannelHighlight();
+    }
+"""
+
+
 class MarkChannel(IPlugin):
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
-            @connect(sender=controller.supervisor)
+            get_bridge(gui.get_view(ClusterView)).define('highlightChannel',
+                                                         js_highlight)
+            best_channels = ClusterCache(get_state(controller), labels=False)
+
+            def best_channel(cluster_id):
+                return controller.supervisor.get_cluster_info(
+                    cluster_id)['ch']
+
+            # Deferred while stepping quickly through the clusters
+            @get_scheduler(controller).on_select(deferrable=True)
             def on_select(sender, cluster_ids=None, **kwargs):
                 view = gui.get_view(ClusterView)
 
                 # Get selected channels
-                channels = [sender.get_cluster_info(c)['ch']
+                channels = [best_channels.get(c, best_channel)
                             for c in cluster_ids]
                 channels, c_ids = np.unique(channels, return_index=True)
                 channels = channels.tolist()
@@ -33,42 +98,16 @@ class MarkChannel(IPlugin):
                           for c in colors]
 
                 clust = dict()
-                for c in sender.clustering.cluster_ids:
-                    ch = sender.get_cluster_info(c)['ch']
+                for i, c in enumerate(sender.clustering.cluster_ids):
+                    ch = best_channels.get(c, best_channel)
                     if ch in channels:
                         clust[str(c)] = colors[channels.index(ch)]
-
-                js = """
-                    var ll = """ + str(clust) + """;
-                    var itms = document.getElementsByTagName("tr");
-                    var chng = []
-                    for (var i = 0; i < itms.length; i++) {
-                        var c_id = itms[i].getAttribute('data-_id');
-
-                        // New clusters do not have this attribute
-                        if (!c_id) {
-                            c_id = itms[i].getElementsByClassName('id')
-                            if (c_id.length) {
-                                c_id = c_id[0].innerHTML;
-                            } else {
-                                continue;
-                            }
-                        };
-
-                        if (Object.keys(ll).indexOf(c_id) >= 0) {
-                            itms[i].style.background = ll[c_id];
-                            chng.push(c_id);
-                        } else {
-                            itms[i].style.background = '';
-                        }
-                    }
-
-                    // Report highlighted clusters to callback function
-                    chng
-                """
+                    if i % 1000 == 999:
+                        yield  # Abandoned if a new selection is made
 
                 def report(obj):
                     logger.debug('Highlighted clusters %s.',
-                                 ', '.join(obj) if len(obj) > 0 else 'none')
+                                 ', '.join(obj) if obj else 'none')
 
-                view.eval_js(js, callback=report)
+                get_bridge(view).call('highlightChannel', clust,
+                                      callback=report)
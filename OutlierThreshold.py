@@ -0,0 +1,246 @@
+"""
+Histogram of the Mahalanobis distances with an adjustable threshold
+
+The view (add MahalanobisView from the View menu) shows the histogram of
+the Mahalanobis distances (in STDs) of the spikes of the selected
+clusters, computed as in 'Split by Mahalanobis distance' of `Recluster`.
+The distances are computed once per selection in a background thread
+and kept sorted, such that the number of outliers for any threshold is
+a binary search.
+
+The threshold (vertical line) is moved with shift+wheel, set with
+ctrl+click or entered with the action 'Set threshold' (snippet :mt).
+The outlier count is updated immediately. The action 'Split outliers'
+splits the spikes above the threshold off the selected clusters.
+"""
+
+import logging
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from phy.cluster.views import ManualClusteringView
+from phy.plot.transform import NDC, Range
+from phy.plot.visuals import HistogramVisual, LineVisual, TextVisual
+from phylib.utils import Bunch
+from PyQt5.QtCore import QTimer
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import mahalanobis_distances  # noqa: E402
+from plugin_features import get_feature_store  # noqa: E402
+from plugin_generation import get_state  # noqa: E402
+from plugin_spikes import get_spike_index  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+def outlier_distances(controller, cluster_ids):
+    """Spike ids and Mahalanobis distances (STDs), sorted by distance"""
+    spike_ids = get_spike_index(controller).spikes_in_clusters(cluster_ids)
+    data, _ = get_feature_store(controller.dir_path).aligned(spike_ids)
+    data = data.reshape((data.shape[0], -1))
+    if data.shape[0] < data.shape[1]:
+        return Bunch(spike_ids=spike_ids[:0], distances=np.array([]))
+    distances = np.sqrt(mahalanobis_distances(data, overwrite=True))
+    order = np.argsort(distances, kind='stable')
+    return Bunch(spike_ids=spike_ids[order], distances=distances[order])
+
+
+class MahalanobisView(ManualClusteringView):
+    """Mahalanobis distances of the selected spikes and outlier threshold"""
+    _default_position = 'right'
+
+    # Number of bins of the histogram
+    n_bins = 200
+
+    # Outlier threshold (STDs)
+    threshold = 14.
+
+    default_shortcuts = {
+        'split_outliers': 'alt+shift+x',
+    }
+
+    default_snippets = {
+        'set_threshold': 'mt',
+    }
+
+    def __init__(self, get_distances=None, split=None):
+        super(MahalanobisView, self).__init__()
+        self.state_attrs += ('threshold',)
+        self.get_distances = get_distances
+        self.split = split
+        self.data = None
+        self.data_bounds = (0, 0, 1, 1)
+        self.canvas.enable_axes()
+
+        self.visual = HistogramVisual()
+        self.canvas.add_visual(self.visual)
+
+        self.line_visual = LineVisual()
+        self.canvas.add_visual(self.line_visual)
+
+        self.text_visual = TextVisual(color=(1., 1., 1., 1.))
+        self.canvas.add_visual(self.text_visual)
+
+    def on_select(self, cluster_ids=(), **kwargs):
+        self.cluster_ids = cluster_ids
+        if not cluster_ids:
+            return
+        self.plot()
+
+    @property
+    def n_outliers(self):
+        if self.data is None:
+            return 0
+        d = self.data.distances
+        return len(d) - np.searchsorted(d, self.threshold, side='right')
+
+    def plot(self, **kwargs):
+        """Histogram of the distances, if computed (None while computing)"""
+        self.data = self.get_distances(self.cluster_ids)
+        self.visual.reset_batch()
+        self.text_visual.reset_batch()
+        if self.data is not None and len(self.data.distances):
+            d = self.data.distances
+            x_max = max(1.5 * self.threshold, d[int(.995 * (len(d) - 1))])
+            edges = np.linspace(0, x_max, self.n_bins + 1)
+            hist = np.diff(np.searchsorted(d, edges))
+            self.data_bounds = (0, 0, x_max, max(hist.max(), 1))
+            self.visual.add_batch_data(hist=hist, ylim=self.data_bounds[3],
+                                       color=(.4, .6, 1., 1.))
+        else:
+            text = ('Computing...' if self.data is None
+                    else 'Not enough spikes.')
+            self.text_visual.add_batch_data(text=[text], pos=[(0, 0)],
+                                            anchor=[(0, 0)])
+        self.canvas.update_visual(self.visual)
+        self.canvas.update_visual(self.text_visual)
+        self._update_axes()
+        self._plot_threshold()
+
+    def _plot_threshold(self):
+        """Redraw the threshold line only"""
+        self.line_visual.reset_batch()
+        if self.data is not None and len(self.data.distances):
+            x = self.threshold
+            self.line_visual.add_batch_data(
+                pos=[x, 0, x, self.data_bounds[3]], color=(1., .3, .3, 1.),
+                data_bounds=self.data_bounds)
+        self.canvas.update_visual(self.line_visual)
+        self.canvas.update()
+        self.update_status()
+
+    @property
+    def status(self):
+        if self.data is None or not len(self.data.distances):
+            return ''
+        n = len(self.data.distances)
+        return 'threshold %.1f: %i outliers (%.2f%%)' % (
+            self.threshold, self.n_outliers, 100. * self.n_outliers / n)
+
+    def attach(self, gui):
+        super(MahalanobisView, self).attach(gui)
+        self.actions.add(self.set_threshold, prompt=True,
+                         prompt_default=lambda: self.threshold)
+        self.actions.add(self.split_outliers)
+        self.actions.separator()
+
+    def set_threshold(self, threshold):
+        """Set the outlier threshold (STDs)"""
+        self.threshold = max(float(threshold), 0.)
+        self._plot_threshold()
+
+    def split_outliers(self):
+        """Split the spikes above the threshold off the selected clusters"""
+        if not self.n_outliers:
+            return
+        labels = np.ones(len(self.data.spike_ids), dtype=int)
+        labels[len(labels) - self.n_outliers:] = 2
+        logger.info('Split %i outliers with a Mahalanobis distance greater '
+                    'than %.2g.', self.n_outliers, self.threshold)
+        self.split(self.data.spike_ids, labels)
+
+    def on_mouse_wheel(self, e):
+        if e.modifiers == ('Shift',):
+            self.set_threshold(self.threshold * 1.05 ** e.delta)
+
+    def on_mouse_click(self, e):
+        if 'Control' in e.modifiers and self.data is not None:
+            pos = self.canvas.panzoom.window_to_ndc(e.pos)
+            self.set_threshold(Range(NDC, self.data_bounds).apply(pos)[0][0])
+
+
+class OutlierThreshold(IPlugin):
+    # Number of selections whose distances are kept
+    max_selections = 8
+
+    # Interval to check for finished background work (milliseconds)
+    refresh_interval = 50
+
+    def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        results = OrderedDict()  # {cluster_ids: (generation, distances)}
+        jobs = dict()  # {cluster_ids: (generation, future)}
+        views = []
+        timer = QTimer()
+
+        def get_distances(cluster_ids):
+            """Distances of a selection, or None if not computed yet"""
+            key = tuple(int(c) for c in cluster_ids)
+            state = get_state(controller)
+            if key in results:
+                generation, data = results[key]
+                if not state.changed(generation, key, labels=False):
+                    results.move_to_end(key)
+                    return data
+                del results[key]
+            if key not in jobs:
+                # Superseded selections are not computed anymore
+                for k in [k for k, (_, f) in jobs.items() if f.cancel()]:
+                    del jobs[k]
+                jobs[key] = (state.generation, executor.submit(
+                    outlier_distances, controller, list(key)))
+                timer.start(self.refresh_interval)
+            return None
+
+        def check():
+            for key, (generation, future) in list(jobs.items()):
+                if not future.done():
+                    continue
+                del jobs[key]
+                try:
+                    results[key] = (generation, future.result())
+                except Exception as e:
+                    logger.error('Could not compute the Mahalanobis '
+                                 'distances: %s', e)
+                    continue
+                while len(results) > self.max_selections:
+                    results.popitem(last=False)
+                for view in views:
+                    if tuple(view.cluster_ids) == key and not view._closed:
+                        view.plot()
+            if not jobs:
+                timer.stop()
+
+        timer.timeout.connect(check)
+
+        def create_mahalanobis_view():
+            view = MahalanobisView(
+                get_distances=get_distances,
+                split=lambda spike_ids, labels:
+                controller.supervisor.actions.split(spike_ids, labels))
+            views.append(view)
+            return view
+
+        controller.view_creator['MahalanobisView'] = create_mahalanobis_view
+
+        @connect
+        def on_gui_ready(sender, gui):
+            @connect(sender=gui)
+            def on_close(sender):
+                timer.stop()
+                executor.shutdown(wait=False)
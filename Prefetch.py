@@ -0,0 +1,205 @@
+"""
+Load the data of the next clusters while stepping through the clusters
+
+When a single cluster is selected next to the previously selected one,
+in the order of the cluster view (e.g. with the arrow keys) or in the
+order of the cluster ids (e.g. with `SelectionOptions`), the next
+`n_ahead` clusters in the same direction are predicted (skipping noise
+clusters). Once the selection settles (see `plugin_scheduler`), their
+waveforms, features, amplitudes and correlograms are loaded in a
+background thread, as the views would request them.
+
+The prefetched data is kept in memory (at most `max_entries` results)
+and handed to the views when they request it. Prefetching is cancelled
+as soon as another selection is made, and its data is discarded when
+the clustering changes.
+
+Plugins that replace these data methods of the controller (e.g.
+`CorrelogramCache`) must be listed before this plugin.
+"""
+
+import inspect
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from phy.cluster.views import AmplitudeView, CorrelogramView
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_scheduler import get_scheduler  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+# Controller methods requested by the views for the selected clusters
+METHODS = ('_get_waveforms', '_get_template_waveforms', '_get_features',
+           '_amplitude_getter', '_get_correlograms',
+           '_get_correlograms_rate')
+
+
+def _freeze(value):
+    """Hashable version of an argument"""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def predict(order, previous, current, n, skip=()):
+    """
+    Next `n` ids after `current` in `order`, in the direction from
+    `previous`, if both are adjacent (ignoring the ids in `skip`)
+    """
+    order = [c for c in order if c not in skip or c in (previous, current)]
+    try:
+        i, j = order.index(previous), order.index(current)
+    except ValueError:
+        return []
+    if abs(j - i) != 1:
+        return []
+    out = order[j + 1:] if j > i else order[:j][::-1]
+    return out[:n]
+
+
+class Prefetch(IPlugin):
+    # Number of clusters loaded ahead
+    n_ahead = 2
+
+    # Maximum number of prefetched results kept in memory
+    max_entries = 32
+
+    def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        lock = threading.Lock()
+        results = OrderedDict()  # {(method, arguments): data}
+        loaders = dict()
+        self.token = 0  # Incremented to cancel the running prefetch
+        self.previous = None  # Previously selected cluster
+        self.hits = 0
+
+        def _key(name, signature, args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            # The waveforms depend on the raw data filter
+            current_filter = getattr(getattr(
+                controller, 'raw_data_filter', None), 'current_filter', None)
+            return (name, current_filter) + tuple(
+                _freeze(v) for v in bound.arguments.values())
+
+        def wrap(name):
+            func = getattr(controller, name, None)
+            if func is None:
+                return
+            signature = inspect.signature(func)
+
+            def get(*args, **kwargs):
+                key = _key(name, signature, args, kwargs)
+                with lock:
+                    if key in results:
+                        results.move_to_end(key)
+                        self.hits += 1
+                        logger.log(5, 'Prefetched %s%s.', name, key[2:])
+                        return results[key]
+                return func(*args, **kwargs)
+
+            def load(*args, **kwargs):
+                key = _key(name, signature, args, kwargs)
+                with lock:
+                    if key in results:
+                        return
+                data = func(*args, **kwargs)
+                with lock:
+                    results[key] = data
+                    while len(results) > self.max_entries:
+                        results.popitem(last=False)
+
+            setattr(controller, name, get)
+            loaders[name] = load
+
+        def prefetch(token, requests):
+            """Load the data of the predicted clusters (background thread)"""
+            for cluster_id, calls in requests:
+                for name, args, kwargs in calls:
+                    if token != self.token:
+                        return  # Another selection was made
+                    try:
+                        loaders[name](*args, **kwargs)
+                    except Exception as e:
+                        logger.debug('Could not prefetch %s of cluster %i: '
+                                     '%s', name, cluster_id, e)
+            logger.debug('Prefetched clusters %s.',
+                         ', '.join(str(c) for c, _ in requests))
+
+        @connect
+        def on_controller_ready(sender):
+            # Before the views are created with these methods
+            for name in METHODS:
+                wrap(name)
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                if up.added or up.deleted:
+                    self.token += 1
+                    with lock:
+                        results.clear()
+
+        @connect
+        def on_gui_ready(sender, gui):
+            def requests(cluster_id):
+                """Method calls of the views for a single cluster"""
+                yield '_get_waveforms', (cluster_id,), {}
+                yield '_get_template_waveforms', (cluster_id,), {}
+                yield '_get_features', (cluster_id,), {}
+                for view in gui.list_views(AmplitudeView):
+                    # Feature amplitudes depend on the feature view
+                    if view.amplitudes_type != 'feature':
+                        yield '_amplitude_getter', ([None, cluster_id],), \
+                            dict(name=view.amplitudes_type, load_all=None)
+                for view in gui.list_views(CorrelogramView):
+                    yield '_get_correlograms', (
+                        [cluster_id], view.bin_size, view.window_size), {}
+                    yield '_get_correlograms_rate', (
+                        [cluster_id], view.bin_size), {}
+
+            def start(cluster_id, order):
+                groups = controller.supervisor.get_labels('group')
+                noise = {c for c, g in groups.items() if g == 'noise'}
+                previous, self.previous = self.previous, cluster_id
+                ids = sorted(controller.supervisor.clustering.cluster_ids)
+                for o in (order, ids):
+                    cluster_ids = predict(o, previous, cluster_id,
+                                          self.n_ahead, noise)
+                    if cluster_ids:
+                        break
+                else:
+                    return
+                self.token += 1
+                executor.submit(prefetch, self.token, [
+                    (c, [r for r in requests(c) if r[0] in loaders])
+                    for c in cluster_ids])
+
+            @get_scheduler(controller).on_select
+            def on_select(sender, cluster_ids=None, **kwargs):
+                self.token += 1  # Cancel the running prefetch
+
+            @get_scheduler(controller).on_select(deferrable=True)
+            def on_select_settled(sender, cluster_ids=None, **kwargs):
+                if not cluster_ids or len(cluster_ids) != 1:
+                    self.previous = None
+                    return
+                cluster_id = int(cluster_ids[0])
+                cluster_view = controller.supervisor.cluster_view
+                cluster_view.get_ids(
+                    lambda ids: start(cluster_id, [int(c) for c in ids]))
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.token += 1
+                executor.shutdown(wait=False)
+                logger.debug('Prefetched data used %i times.', self.hits)
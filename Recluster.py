@@ -1,15 +1,34 @@
 """
 Copied and modified from https://github.com/petersenpeter/phy2-plugins/
+
+The drift-aware amplitude clustering clusters the amplitudes in time
+windows of `drift_window` seconds (in parallel) and links the
+sub-clusters of consecutive windows by their centroids. Only one window
+of amplitudes per worker is loaded at a time.
 """
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import numpy as np
 from phy import IPlugin, connect
-from scipy.cluster.vq import kmeans2, whiten
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import (kmeans_labels,  # noqa: E402
+                               mahalanobis_outlier_labels,
+                               windowed_kmeans_labels)
+from plugin_features import get_feature_store  # noqa: E402
+from plugin_spikes import get_amplitudes, get_spike_index  # noqa: E402
 
 logger = logging.getLogger('phy')
 
 
 class Recluster(IPlugin):
+    # Duration of the time windows of the drift-aware clustering (seconds)
+    drift_window = 300.
+
     def attach_to_controller(self, controller):
         @connect
         def on_gui_ready(sender, gui):
@@ -22,15 +41,17 @@ class Recluster(IPlugin):
                 logger.info("Running K-means clustering.")
 
                 cluster_ids = controller.supervisor.selected
-                spike_ids = controller.supervisor.clustering.spikes_in_clusters(cluster_ids)
-                channel_ids = controller.model.get_cluster_channels(cluster_ids[0])
-                data = controller.model.get_features(
-                    spike_ids=spike_ids,
-                    channel_ids=channel_ids
-                )
-                data = np.reshape(data, (data.shape[0], data.shape[1]*data.shape[2]))
-                whitened = whiten(data)
-                clusters_out, label = kmeans2(whitened, kmeanclusters, minit='++')
+                spike_ids = get_spike_index(controller).spikes_in_clusters(
+                    cluster_ids)
+
+                # Features on the best channels of all selected clusters
+                # (also of the clusters created in this session)
+                channel_ids = list(dict.fromkeys(
+                    int(ch) for c in cluster_ids
+                    for ch in controller.get_best_channels(c)))
+                data, _ = get_feature_store(controller.dir_path).aligned(
+                    spike_ids, channel_ids)
+                label = kmeans_labels(data, kmeanclusters)
                 assert spike_ids.shape == label.shape
 
                 controller.supervisor.actions.split(spike_ids, label)
@@ -48,30 +69,48 @@ class Recluster(IPlugin):
                 # Selected clusters across cluster and similarity views
                 cluster_ids = controller.supervisor.selected
 
-                # Get amplitudes using the same controller method as
-                # what the amplitude view is using.
-                # Note that we need load_all=True to load all spikes
-                # from the selected clusters, instead of just the
-                # selection of them chosen for display
-                bunchs = controller._amplitude_getter(cluster_ids,
-                                                      name='template',
-                                                      load_all=True)
-
                 # Spike ids and corresponding spike template amplitudes
                 # NOTE: we only consider the first selected cluster
-                spike_ids = bunchs[0].spike_ids
-                y = bunchs[0].amplitudes
-                y_whitened = whiten(y.reshape((-1, 1)))
+                spike_ids = get_spike_index(controller).spike_ids(
+                    cluster_ids[0])
+                y = get_amplitudes(controller, spike_ids)
 
                 # Perform the clustering algorithm, which returns an
                 # integer for each sub-cluster
-                clusters_out, labels = kmeans2(y_whitened, n_clusters)
+                labels = kmeans_labels(y.reshape((-1, 1)), n_clusters,
+                                       minit='random')
 
                 assert spike_ids.shape == labels.shape
 
                 # We split according to the labels.
                 controller.supervisor.actions.split(spike_ids, labels)
 
+            @controller.supervisor.actions.add(prompt=True,
+                                               prompt_default=lambda: 2,
+                                               submenu='Clustering')
+            def K_means_clustering_amplitude_drift(n_clusters):
+                """
+                Split based on template amplitudes in time windows,
+                following slow changes of the amplitudes. Select number
+                of clusters
+                """
+                cluster_ids = controller.supervisor.selected
+
+                # NOTE: we only consider the first selected cluster
+                spike_ids, spike_times = get_spike_index(controller).spikes(
+                    cluster_ids[0])
+
+                def get_values(start, stop):
+                    return get_amplitudes(controller, spike_ids[start:stop])
+
+                with ThreadPoolExecutor() as executor:
+                    labels = windowed_kmeans_labels(
+                        spike_times, get_values, n_clusters,
+                        self.drift_window, executor=executor)
+
+                assert spike_ids.shape == labels.shape
+                controller.supervisor.actions.split(spike_ids, labels)
+
             @controller.supervisor.actions.add(shortcut='alt+x', prompt=True,
                                                prompt_default=lambda: 14,
                                                name='Split by Mahalanobis '
@@ -83,55 +122,19 @@ class Recluster(IPlugin):
                 logger.info("Removing outliers with a Mahalanobis distance "
                             "greater than %.2g.", thres_in)
 
-                def MahalanobisDistCalc2(x, y):
-                    covariance_xy = np.cov(x, y, rowvar=0)
-                    inv_covariance_xy = np.linalg.inv(covariance_xy)
-                    xy_mean = np.mean(x), np.mean(y)
-                    x_diff = np.array([x_i - xy_mean[0] for x_i in x])
-                    y_diff = np.array([y_i - xy_mean[1] for y_i in y])
-                    diff_xy = np.transpose([x_diff, y_diff])
-                    md = []
-                    for i in range(len(diff_xy)):
-                        ap = np.sqrt(np.dot(np.dot(np.transpose(diff_xy[i]),
-                                                   inv_covariance_xy),
-                                            diff_xy[i]))
-                        md.append(ap)
-                    return md
-
-                def MahalanobisDistCalc(X, Y):
-                    rx = X.shape[0]
-                    # cx = X.shape[1]
-                    ry = Y.shape[0]
-                    # cy = Y.shape[1]
-
-                    m = np.mean(X, axis=0)
-                    M = np.tile(m, (ry, 1))
-                    C = X - np.tile(m, (rx, 1))
-                    Q, R = np.linalg.qr(C)
-                    ri, ri2, ri3, ri4 = np.linalg.lstsq(np.transpose(R),
-                                                        np.transpose(Y-M),
-                                                        rcond=None)
-                    d = np.transpose(np.sum(ri*ri, axis=0)).dot(rx-1)
-                    return d
-
                 cluster_ids = controller.supervisor.selected
-                spike_ids = controller.selector.select_spikes(cluster_ids)
-                s = controller.supervisor.clustering.spikes_in_clusters(
+                s = get_spike_index(controller).spikes_in_clusters(
                     cluster_ids)
-                data = controller.model._load_features()
-                data3 = data.data[spike_ids]
-                data2 = np.reshape(data3, (data3.shape[0],
-                                           data3.shape[1]*data3.shape[2]))
-                if data2.shape[0] < data2.shape[1]:
+
+                # Features of all spikes on the channels of their templates
+                data2, _ = get_feature_store(controller.dir_path).aligned(s)
+                outliers2 = mahalanobis_outlier_labels(data2, thres_in,
+                                                       overwrite=True)
+                if outliers2 is None:
                     logger.warn("Not enough spikes in the cluster.")
                     return
 
-                MD = MahalanobisDistCalc(data2, data2)
-                # threshold = 16**2
-                threshold = thres_in**2
-                outliers = np.where(MD > threshold)[0]
-                outliers2 = np.ones(len(s), dtype=int)
-                outliers2[outliers] = 2
-                logger.info("Detected %d outliers.", len(outliers))
-                if len(outliers) > 0:
+                n_outliers = np.sum(outliers2 == 2)
+                logger.info("Detected %d outliers.", n_outliers)
+                if n_outliers > 0:
                     controller.supervisor.actions.split(s, outliers2)
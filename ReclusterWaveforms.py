@@ -2,9 +2,14 @@
 Copied and modified from https://github.com/petersenpeter/phy2-plugins/
 """
 import logging
-import numpy as np
+import sys
+from pathlib import Path
 from phy import IPlugin, connect
-from scipy.cluster.vq import kmeans2, whiten
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import as_dtype, kmeans_labels  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -31,20 +36,19 @@ class ReclusterWaveforms(IPlugin):
                 # where n_channels is limited to 5 for speed (five best channels for the cluster)
                 # and the channel_ids from which the waveforms are extracted are chosen relative
                 # to the first selected cluster (typically the blue cluster in phy)
-                data = controller.model.get_waveforms(
+                # (converted only if not already in the compute dtype)
+                data = as_dtype(controller.model.get_waveforms(
                     spike_ids=spike_ids,
                     channel_ids=controller.model.get_cluster_channels(cluster_ids[0])[:5]
-                ).astype(np.float32)
+                ))
                 logger.debug(f"Feature array shape: {data.shape}")
 
-                # reshape data to (n_spikes, template_size * n_channels)
+                # reshape data to (n_spikes, template_size * n_channels) (a view)
                 data = data.reshape((data.shape[0], data.shape[1] * data.shape[2]))
 
-                # whiten data before clustering
-                whitened = whiten(data)
-
-                # run k-means clustering on the waveforms, looking for `num_clusters` clusters
-                clusters_out, label = kmeans2(data, num_clusters)
+                # whiten data and run k-means clustering on the waveforms, looking for
+                # `num_clusters` clusters (in the compute dtype, see `plugin_algorithms`)
+                label = kmeans_labels(data, num_clusters)
                 
                 # make sure the num of labels matches the total number of spikes
                 assert spike_ids.shape == label.shape
@@ -20,8 +20,9 @@ column widths unnecessarily (False by default).
 
 Configuration:
 
-On first use, a JSON file will be created in the Phy configuration
-directory, usually {HOME}/.phy/plugin_reordercolumns.json. The column
+On first use, a section 'ReorderColumns' will be created in the plugin
+configuration file in the Phy configuration directory, usually
+{HOME}/.phy/plugins.json (see `plugin_config`). The column
 names for reordering (`last_columns`), the text alignment
 (`text_align`), and the tight column option (`tight_columns`) can be
 adjusted there. Here the details:
@@ -36,12 +37,16 @@ tight_columns : bool
     Whether to squeeze width of all column headers
 """
 
-import json
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
-from phy.utils import phy_config_dir
 from pathlib import Path
 import logging
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_config import load_config  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -49,8 +54,6 @@ logger = logging.getLogger('phy')
 class ReorderColumns(IPlugin):
     # Load config
     def __init__(self):
-        filepath = Path(phy_config_dir()) / 'plugin_reordercolumns.json'
-
         # Default config
         dflts = {
             'last_columns': ['quality', 'comment'],
@@ -58,24 +61,11 @@ class ReorderColumns(IPlugin):
             'tight_columns': False,
         }
 
-        # Create config file with defaults if it does not exist
-        if not filepath.exists():
-            logger.debug("Create default config at %s.", filepath)
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", filepath)
-        with open(filepath, 'r') as f:
-            try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                data = dflts
-
-        self.last_columns = data.get('last_columns', dflts['last_columns'])
-        self.text_align = data.get('text_align', dflts['text_align'])
-        self.tight_columns = data.get('tight_columns', dflts['tight_columns'])
+        data = load_config('ReorderColumns', dflts)
+
+        self.last_columns = data['last_columns']
+        self.text_align = data['text_align']
+        self.tight_columns = data['tight_columns']
 
     def attach_to_controller(self, controller):
         # Reduce width of the quality column/all columns
@@ -23,16 +23,22 @@ primary column is set to ascending (▲) or descending (▼) ordering.
 
 The priority ordering can be changed from the main menu in Phy:
     Select->Sort by->Select secondary sorting
-This configuration will be stored to disk to be preserved globally over
-opening and closing Phy.
+This configuration will be stored to disk (in the section
+'SortClusterView' of {HOME}/.phy/plugins.json) to be preserved globally
+over opening and closing Phy.
 """
 
-import json
 import logging
+import sys
 from pathlib import Path
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
-from phy.utils import phy_config_dir
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_config import load_config, save_config  # noqa: E402
+from plugin_jsbridge import get_bridge  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -40,75 +46,67 @@ logger = logging.getLogger('phy')
 class SortClusterView(IPlugin):
     # Load config
     def __init__(self):
-        self.filepath = Path(phy_config_dir()) / 'plugin_sortclusterview.json'
-
         # Default config
         dflts = ['ch', 'group', 'id']  # Do not change here
-
-        # Create config file with defaults if it does not exist
-        if not self.filepath.exists():
-            logger.debug("Create default config at %s.", self.filepath)
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", self.filepath)
-        with open(self.filepath, 'r') as f:
-            try:
-                self.column_order = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                self.column_order = dflts
+        self.column_order = load_config('SortClusterView', dflts)
 
     def update_config(self):
-        with open(self.filepath, 'w', encoding='utf-8') as f:
-            json.dump(self.column_order, f, ensure_ascii=False, indent=4)
+        save_config('SortClusterView', self.column_order)
 
     def attach_to_controller(self, controller):
 
-        # Javascript to execute
+        # Javascript functions (see `plugin_jsbridge`)
         js_base = """
-          // Priority of column sorting
-          var columnOrder = """ + json.dumps(self.column_order) + """;
-
-          // Set a custom sort function
-          table.sortFunction = function(itemA, itemB, options) {
-
-            // Default sorting (see listjs)
-            var sort = table.utils.naturalSort;
-            sort.alphabet = table.alphabet || options.alphabet || undefined;
-            if (!sort.alphabet && options.insensitive)
-              sort = table.utils.naturalSort.caseInsensitive;
-
-            // Primary and secondary keys
-            var multi = 1;
-            var keys = columnOrder.slice();
-            keys.unshift(options.valueName);
-
-            // Sort by the first non-identical column
-            for (var i = 0; i < keys.length; i++) {
-              if (itemA.values()[keys[i]] != itemB.values()[keys[i]])
-                return sort(itemA.values()[keys[i]],
-                            itemB.values()[keys[i]]) * multi;
-              multi = options.order === 'desc' ? -1 : 1; // Always ascending
+          function(order) {
+            // Priority of column sorting
+            window.columnOrder = order;
+            if (window.columnOrderInstalled) return;
+            window.columnOrderInstalled = true;
+
+            // Set a custom sort function
+            table.sortFunction = function(itemA, itemB, options) {
+
+              // Default sorting (see listjs)
+              var sort = table.utils.naturalSort;
+              sort.alphabet = table.alphabet || options.alphabet || undefined;
+              if (!sort.alphabet && options.insensitive)
+                sort = table.utils.naturalSort.caseInsensitive;
+
+              // Primary and secondary keys
+              var multi = 1;
+              var keys = columnOrder.slice();
+              keys.unshift(options.valueName);
+
+              // Sort by the first non-identical column
+              for (var i = 0; i < keys.length; i++) {
+                if (itemA.values()[keys[i]] != itemB.values()[keys[i]])
+                  return sort(itemA.values()[keys[i]],
+                              itemB.values()[keys[i]]) * multi;
+                multi = options.order === 'desc' ? -1 : 1; // Always ascending
+              }
             }
           }
         """
 
         js_resort = """
-          // Resort now
-          if (options.sort && options.sort[0])
-            table.sort(options.sort[0], {"order": options.sort[1]});
+          function() {
+            // Resort now
+            if (options.sort && options.sort[0])
+              table.sort(options.sort[0], {"order": options.sort[1]});
+          }
         """
 
         @connect
         def on_gui_ready(sender, gui):
             view = gui.get_view(ClusterView)
+            bridge = get_bridge(view)
+            bridge.define('setColumnOrder', js_base)
+            bridge.define('resort', js_resort)
 
             @connect(sender=view)
             def on_ready(sender):
-                view.eval_js(js_base)
-                view.eval_js(js_resort)
+                bridge.call('setColumnOrder', self.column_order)
+                bridge.call('resort')
 
             def check(entry):
                 column_avail = (['id'] + controller.supervisor.columns
@@ -135,9 +133,8 @@ class SortClusterView(IPlugin):
                 if len(order) > 0:
                     self.column_order = order
 
-                    js_up = "columnOrder = " + json.dumps(order) + ";"
-                    view.eval_js(js_up)
-                    view.eval_js(js_resort)
+                    bridge.call('setColumnOrder', order)
+                    bridge.call('resort')
 
                     self.update_config()
 
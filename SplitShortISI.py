@@ -1,8 +1,16 @@
 """Remove spikes with low interspike interval"""
 
 from phy import IPlugin, connect
+from pathlib import Path
 import numpy as np
 import logging
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import short_isi_labels  # noqa: E402
+from plugin_spikes import get_spike_index  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -29,25 +37,10 @@ class SplitShortISI(IPlugin):
                 # Selected clusters across cluster and similarity views
                 cluster_ids = controller.supervisor.selected
 
-                # Get amplitudes using the same controller method as
-                # what the amplitude view is using.
-                # Note that we need load_all=True to load all spikes
-                # from the selected clusters, instead of just the
-                # selection of them chosen for display
-                bunchs = controller._amplitude_getter(cluster_ids,
-                                                      name='template',
-                                                      load_all=True)
-
-                # Spike ids and corresponding spike template amplitudes
-                # NOTE: we only consider the first selected cluster
-                spike_ids = bunchs[0].spike_ids
-                spike_times = controller.model.spike_times[spike_ids]
-                dspike_times = np.diff(spike_times)
-
-                labels = np.ones(len(dspike_times), 'int64')
-                labels[dspike_times < .0015] = 2
-                # Include last spike to match with len spike_ids
-                labels = np.append(labels, 1)
+                # Spike ids and times of the first selected cluster
+                spike_ids, spike_times = get_spike_index(controller).spikes(
+                    cluster_ids[0])
+                labels = short_isi_labels(spike_times, .0015)
 
                 # # Perform the clustering algorithm, which returns an
                 # # integer for each sub-cluster
@@ -0,0 +1,72 @@
+"""
+Report the startup cost of each plugin
+
+The time each plugin takes to be created (e.g. loading its
+configuration) and to attach to the controller is measured, as well as
+the time until the GUI is ready and the time spent in all handlers of
+the GUI being ready (e.g. creating the actions). The report is written
+to the log once the GUI is ready.
+
+Only plugins attached after this one can be measured, so `StartupTiming`
+should be the first entry of the plugin list in ~/.phy/phy_config.py:
+    c.TemplateGUI.plugins = ['StartupTiming', <more plugins here>]
+"""
+
+import functools
+import logging
+import time
+from phy import IPlugin, connect
+from phy.utils.plugin import IPluginRegistry
+from PyQt5.QtCore import QTimer
+
+logger = logging.getLogger('phy')
+
+
+class StartupTiming(IPlugin):
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.timings = dict()  # {plugin: {step: seconds}}
+
+        for cls in IPluginRegistry.plugins:
+            if cls is StartupTiming or getattr(cls, '_timed', False):
+                continue
+            self._time_method(cls, '__init__', 'init')
+            self._time_method(cls, 'attach_to_controller', 'attach')
+            cls._timed = True
+
+    def _time_method(self, cls, method, step):
+        """Replace the method of a plugin class with a timed version"""
+        func = getattr(cls, method)
+        timings = self.timings
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.setdefault(cls.__name__, dict())[step] = (
+                    time.perf_counter() - t)
+
+        setattr(cls, method, timed)
+
+    def report(self, t_ready, t_done):
+        lines = ['Plugin startup times (ms):',
+                 '    %-20s %8s %8s' % ('Plugin', 'init', 'attach')]
+        for name, t in sorted(self.timings.items(),
+                              key=lambda x: -sum(x[1].values())):
+            lines.append('    %-20s %8.1f %8.1f' % (
+                name, t.get('init', 0) * 1e3, t.get('attach', 0) * 1e3))
+        lines.append('    Until GUI ready: %.0f ms' % (
+            (t_ready - self.t0) * 1e3))
+        lines.append('    GUI ready handlers: %.0f ms' % (
+            (t_done - t_ready) * 1e3))
+        logger.info('\n'.join(lines))
+
+    def attach_to_controller(self, controller):
+        @connect
+        def on_gui_ready(sender, gui):
+            # This handler runs first, the report once all others are done
+            t_ready = time.perf_counter()
+            QTimer.singleShot(0, lambda: self.report(t_ready,
+                                                     time.perf_counter()))
@@ -11,12 +11,16 @@ The displayed shortcut in the menu entries may not be updated depending
 on the operating system or Qt version(?).
 """
 
-import json
 import logging
+import sys
 from pathlib import Path
 from phy import IPlugin, connect
 from phy.cluster.supervisor import ClusterView
-from phy.utils import phy_config_dir
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_config import load_config, save_config  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -24,8 +28,6 @@ logger = logging.getLogger('phy')
 class ToggleModifier(IPlugin):
     # Load config
     def __init__(self):
-        self.filepath = Path(phy_config_dir()) / 'plugin_togglemodifier.json'
-
         # Default config (do not change here!)
         dflts = dict(
             enabled=False,
@@ -45,31 +47,13 @@ class ToggleModifier(IPlugin):
             ],
         )
 
-        # Create config file with defaults if it does not exist
-        if not self.filepath.exists():
-            logger.debug("Create default config at %s.", self.filepath)
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
-
-        # Load config
-        logger.debug("Load %s for config.", self.filepath)
-        with open(self.filepath, 'r') as f:
-            try:
-                self.config = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                self.config = dflts
-
-            # Ensure existence of keys
-            self.config.setdefault('enabled', dflts['enabled'])
-            self.config['modifier'] = self.config.get(
-                'modifier', dflts['modifier']).lower()
-            self.config['actions'] = list(self.config.get(
-                'actions', dflts['actions']))
+        self.config = load_config('ToggleModifier', dflts)
+
+        # Ensure lower case modifier
+        self.config['modifier'] = self.config['modifier'].lower()
 
     def update_config(self):
-        with open(self.filepath, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, ensure_ascii=False, indent=4)
+        save_config('ToggleModifier', self.config)
 
     def attach_to_controller(self, controller):  # noqa: C901
         def update_shortcuts(with_modifier, verbose=False):
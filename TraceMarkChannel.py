@@ -1,12 +1,22 @@
 """
 Mark selected channels in trace view
+
+While stepping quickly through the clusters, the labels are only updated
+for the last selection.
 """
 
 import numpy as np
+import sys
+from pathlib import Path
 from phy.cluster.views import TraceView
 from phy import IPlugin, connect
 from phy.utils.color import selected_cluster_color
 
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_scheduler import get_scheduler  # noqa: E402
+
 
 class TraceMarkChannel(IPlugin):
     def attach_to_controller(self, controller):
@@ -35,7 +45,7 @@ class TraceMarkChannel(IPlugin):
                     view.canvas.update_visual(view.text_visual)
                 view._plot_labels = _plot_labels
 
-                @connect(sender=controller.supervisor)
+                @get_scheduler(controller).on_select(deferrable=True)
                 def on_select(sender, cluster_ids=None, **kwargs):
                     if not cluster_ids:
                         view.ch = []
@@ -0,0 +1,250 @@
+"""
+Virtualized rendering of the cluster view and similarity view tables
+
+With many clusters, building and restyling one HTML row per cluster is
+slow. If a table has at least `min_rows` rows, only the rows within the
+visible part of the table (plus `margin` rows above and below) are kept
+in the page. The rows are generated from the data held by the table
+(list.js items) while scrolling, and spacers above and below the table
+keep the scroll bar consistent. Sorting (see `SortClusterView`) and
+column ordering (see `ReorderColumns`) operate on the table data and are
+unaffected. Highlighting (see `MarkChannel`) is applied to the rendered
+rows whenever the table is updated.
+
+The table methods that work on the rows of the page (selection, sibling
+and order of the clusters) are replaced by methods working on the table
+data: the selection is kept as a list of ids and applied to the rows
+when they are rendered.
+
+The selected cluster is scrolled into view on each selection.
+"""
+
+from phy import IPlugin, connect
+from phy.cluster.supervisor import ClusterView
+from pathlib import Path
+import logging
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_jsbridge import get_bridge  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class VirtualTable(IPlugin):
+    # Minimum number of rows to enable the virtualization
+    min_rows = 1000
+
+    # Number of rows rendered beyond the visible ones (each direction)
+    margin = 30
+
+    def attach_to_controller(self, controller):
+        # Javascript functions (see `plugin_jsbridge`)
+        js_install = """
+          function(margin) {
+            if (window.virtualTable) return;
+            var height = 0;
+
+            // Spacers in place of the rows that are not rendered
+            var el = table.list.parentNode;
+            var top = document.createElement('div');
+            var bottom = document.createElement('div');
+            el.parentNode.insertBefore(top, el);
+            el.parentNode.insertBefore(bottom, el.nextSibling);
+
+            function rowHeight() {
+              var row = table.list.firstElementChild;
+              if (row && row.offsetHeight) height = row.offsetHeight;
+              return height || 20;
+            }
+
+            function render() {
+              var h = rowHeight();
+              var n = table.matchingItems.length;
+              var offset = Math.max(0, window.scrollY - top.offsetTop);
+              var first = Math.max(0, Math.floor(offset / h) - margin);
+              var count = Math.ceil(window.innerHeight / h) + 2 * margin;
+              top.style.height = (first * h) + 'px';
+              bottom.style.height = (Math.max(0, n - first - count) * h
+                                     + 'px');
+              // Only render if the range changed (avoids update loops)
+              if (table.i != first + 1 || table.page != count)
+                table.show(first + 1, count);
+              // Rows rendered again keep the classes of their last rendering
+              applySelection();
+            }
+
+            // Selected ids, in the order of selection (all rows are still
+            // rendered at this point)
+            var selection = table.selected();
+
+            function matchingIds() {
+              return table.matchingItems.map(function(item) {
+                return item.values()['id'];
+              });
+            }
+
+            function applySelection() {
+              var pos = {};
+              selection.forEach(function(id, i) { pos[id] = i; });
+              for (var row of table._iterRows()) {
+                row.classList.remove('selected');
+                while (removeSelectedClasses(row) !== false);
+                var i = pos[getId(row)];
+                if (i === undefined) continue;
+                row.classList.add('selected', 'selected-' + i,
+                                  'color-' + (i + table._selectedIndexOffset));
+              }
+              table._nSelected = selection.length;
+            }
+
+            function isMasked(item) {
+              return item.values().is_masked == true;
+            }
+
+            // Table methods based on the table data instead of the rows
+            table._getIds = matchingIds;
+            table.selected = function() {
+              var ids = {};
+              for (var item of table.items) ids[item.values()['id']] = true;
+              return selection.filter(function(id) { return ids[id]; });
+            };
+            table._clearSelection = function() {
+              selection = [];
+              applySelection();
+            };
+            table._setSelected = function(ids) {
+              selection = ids.slice();
+              applySelection();
+            };
+            table.select = function(ids, kwargs) {
+              table._setSelected(ids);
+              return table._emitSelected(kwargs);
+            };
+            table.selectToggle = function(id) {
+              if (isNaN(id)) return;
+              var i = selection.indexOf(id);
+              if (i >= 0) selection.splice(i, 1);
+              else selection.push(id);
+              applySelection();
+              table._emitSelected();
+            };
+            table.selectUntil = function(id) {
+              if (isNaN(id)) return;
+              var ids = matchingIds();
+              var clicked = ids.indexOf(id);
+              if (clicked < 0) return;
+              var last = Math.max.apply(Math, selection.map(function(s) {
+                return ids.indexOf(s);
+              }));
+              var imin = last < 0 ? 0 : Math.min(clicked, last);
+              var imax = Math.max(clicked, last);
+              for (var i = imin; i <= imax; i++) {
+                if (selection.indexOf(ids[i]) < 0) selection.push(ids[i]);
+              }
+              applySelection();
+              table._emitSelected();
+            };
+            table.getSiblingId = function(id, dir) {
+              if (typeof(id) === 'undefined') id = table.selected()[0];
+              if (id == null) return null;
+              var items = table.matchingItems;
+              var i = matchingIds().indexOf(id);
+              if (i < 0) return null;
+              var step = (dir || 'next') == 'next' ? 1 : -1;
+              do {
+                i += step;
+              } while (i >= 0 && i < items.length && isMasked(items[i]));
+              if (i < 0 || i >= items.length) return null;
+              return items[i].values()['id'];
+            };
+            table.selectFirst = function() {
+              var items = table.items;
+              if (!items.length) return;
+              var first = items[0].values()['id'];
+              if (isMasked(items[0])) first = table.getSiblingId(first);
+              table.select([first]);
+            };
+            table.selectLast = function() {
+              var items = table.items;
+              if (!items.length) return;
+              var last = items[items.length - 1].values()['id'];
+              if (isMasked(items[items.length - 1]))
+                last = table.getSiblingId(last, 'previous');
+              table.select([last]);
+            };
+            table._scrollTo = function(id) { scrollToId(id); };
+
+            function scrollToId(id) {
+              var items = table.matchingItems;
+              for (var i = 0; i < items.length; i++) {
+                if (items[i].values()['id'] == id) {
+                  var y = top.offsetTop + i * rowHeight();
+                  if (y < window.scrollY
+                      || y > window.scrollY + window.innerHeight)
+                    window.scrollTo(0, y - window.innerHeight / 2);
+                  return;
+                }
+              }
+            }
+
+            // Render at most once per frame while scrolling
+            var pending = false;
+            window.addEventListener('scroll', function() {
+              if (pending) return;
+              pending = true;
+              window.requestAnimationFrame(function() {
+                pending = false;
+                render();
+              });
+            });
+            window.addEventListener('resize', render);
+            table.on('updated', render);
+
+            window.virtualTable = {render: render, scrollToId: scrollToId};
+            render();
+
+            // Report the number of rows to the callback function
+            return table.items.length;
+          }
+        """
+
+        js_scroll = """
+          function(id) {
+            if (window.virtualTable) virtualTable.scrollToId(id);
+          }
+        """
+
+        @connect
+        def on_gui_ready(sender, gui):
+            views = [gui.get_view(ClusterView),
+                     controller.supervisor.similarity_view]
+
+            def report(obj):
+                if obj:
+                    logger.debug('Virtualized table with %s rows.', obj)
+
+            for view in views:
+                get_bridge(view).define('virtualTable', js_install)
+                get_bridge(view).define('scrollToId', js_scroll)
+
+                @connect(sender=view)
+                def on_ready(sender):
+                    n = len(controller.supervisor.clustering.cluster_ids)
+                    if n >= self.min_rows:
+                        get_bridge(sender).call('virtualTable',
+                                                int(self.margin),
+                                                callback=report)
+
+            @connect(sender=controller.supervisor)
+            def on_select(sender, cluster_ids=None, **kwargs):
+                if not cluster_ids:
+                    return
+                for view, cluster_id in zip(views, (
+                        sender.selected_clusters[:1],
+                        sender.selected_similar[:1])):
+                    if cluster_id:
+                        get_bridge(view).call('scrollToId',
+                                              int(cluster_id[0]))
@@ -0,0 +1,166 @@
+"""
+Cache the waveforms shown in the waveform view on disk
+
+After the GUI is ready, the waveforms of each cluster are extracted
+from the raw data in the background, one cluster at a time and only
+while no new selection was made for `idle_delay` seconds. The spikes
+are those the waveform view selects (spread over the recording), on the
+best channels of the cluster as in the waveform view, stored in
+`.phy/waveform_cache/` in the data directory (see `plugin_waveforms`).
+The cache grows as clusters are extracted, up to `max_size_mb`, after
+which the least recently used waveforms are removed and the background
+extraction stops. The waveforms are stored in the data type of the raw
+data, unless `dtype` is set (e.g. float16 for half the size, at the cost
+of precision for large int16 values).
+
+Waveforms are then read from the cache, by the waveform view as well as
+by `ReclusterWaveforms`, and only the spikes that are not cached are
+extracted from the raw data. As they are stored by spike id, the cached
+waveforms remain valid after splits and merges. The background
+extraction can be paused with the action 'Pause waveform caching'.
+"""
+
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+from PyQt5.QtCore import QTimer
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_waveforms import WaveformStore  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+class WaveformCache(IPlugin):
+    # Data type of the stored waveforms (None: as extracted, lossless)
+    dtype = None
+
+    # Maximum size of the cache on disk (MB)
+    max_size_mb = 1000
+
+    # Seconds without a new selection before extracting in the background
+    idle_delay = 1.
+
+    # Interval between two clusters extracted in the background (ms)
+    interval = 100
+
+    def attach_to_controller(self, controller):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.store = None
+        self.paused = False
+        self.last_select = 0.
+        job = []  # Running extraction (cluster_id, spike_ids, channels)
+        queue = []  # Clusters to cache
+
+        if getattr(controller.model, 'spike_waveforms', None) is not None:
+            logger.debug('Waveforms are pre-extracted, no waveform cache.')
+            return
+        if getattr(controller.model, 'traces', None) is None:
+            logger.debug('No raw data, no waveform cache.')
+            return
+        model = controller.model
+        get_waveforms = model.get_waveforms
+
+        def get_cached_waveforms(spike_ids, channel_ids):
+            """Waveforms from the cache, or else from the raw data"""
+            if self.store is None or not self.store.count \
+                    or channel_ids is None:
+                return get_waveforms(spike_ids, channel_ids)
+            spike_ids = np.asarray(spike_ids)
+            found, cached = self.store.get(spike_ids, channel_ids)
+            if not found.any():
+                return get_waveforms(spike_ids, channel_ids)
+            if found.all():
+                return cached
+            missing = get_waveforms(spike_ids[~found], channel_ids)
+            out = np.empty((len(spike_ids),) + missing.shape[1:],
+                           dtype=missing.dtype)
+            out[found] = cached
+            out[~found] = missing
+            return out
+
+        model.get_waveforms = get_cached_waveforms
+
+        def next_job():
+            """Spikes and channels of the next cluster to extract"""
+            while queue:
+                cluster_id = queue.pop()
+                if cluster_id not in controller.supervisor.clustering\
+                        .spikes_per_cluster:
+                    continue  # Removed in the meantime
+                spike_ids = np.asarray(controller.selector(
+                    controller.n_spikes_waveforms, [cluster_id],
+                    subset_chunks=True))
+                channel_ids = np.asarray(controller.get_best_channels(
+                    cluster_id))
+                spike_ids = spike_ids[~self.store.contains(spike_ids,
+                                                           channel_ids)]
+                if not len(spike_ids):
+                    continue
+                return cluster_id, spike_ids, channel_ids
+
+        def tick():
+            if job:
+                if not job[0][0].done():
+                    return
+                future, (cluster_id, spike_ids, channel_ids) = job.pop()
+                try:
+                    data = future.result()
+                except Exception as e:
+                    logger.debug('Could not cache the waveforms of cluster '
+                                 '%i: %s', cluster_id, e)
+                    return
+                if not self.store.append(spike_ids, channel_ids, data):
+                    # Only extract the new clusters from now on
+                    logger.debug('Waveform cache full.')
+                    queue.clear()
+                if not queue:
+                    logger.debug('Cached the waveforms of %i spikes.',
+                                 self.store.count)
+            if self.paused or not queue or (
+                    time.monotonic() - self.last_select < self.idle_delay):
+                return
+            args = next_job()
+            if args is not None:
+                job.append((executor.submit(get_waveforms, *args[1:]), args))
+
+        @connect
+        def on_gui_ready(sender, gui):
+            self.store = WaveformStore(controller.dir_path, self.dtype,
+                                       self.max_size_mb * 10 ** 6)
+            # Largest clusters last, they are extracted first
+            spc = controller.supervisor.clustering.spikes_per_cluster
+            queue.extend(sorted(spc, key=lambda c: len(spc[c])))
+
+            self.timer = QTimer(gui)
+            self.timer.timeout.connect(tick)
+            self.timer.start(self.interval)
+
+            @connect(sender=controller.supervisor)
+            def on_select(sender, cluster_ids, **kwargs):
+                self.last_select = time.monotonic()
+
+            @connect(sender=controller.supervisor)
+            def on_cluster(sender, up):
+                # New clusters are cached next
+                queue.extend(up.added)
+
+            @controller.supervisor.actions.add(name='Pause waveform caching',
+                                               checkable=True)
+            def pause_waveform_caching(checked):
+                self.paused = checked
+                logger.info('Waveform caching %s (%i spikes cached).',
+                            'paused' if checked else 'resumed',
+                            self.store.count)
+
+            @connect(sender=gui)
+            def on_close(sender):
+                self.timer.stop()
+                executor.shutdown(wait=True)
+                self.store.flush()
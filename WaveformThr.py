@@ -2,15 +2,81 @@
 Show all non-noisy channels in waveform view
 
 Modified from ExampleNspikesViewsPlugin
+
+In the adaptive mode (default), the peak-to-peak amplitude of every
+template on every channel is computed once in a background thread and
+cached on disk (`.phy/template_ptp.npy` in the data directory). The
+channels of a cluster are then those on which the amplitude of its
+template exceeds `noise_factor` times the median amplitude across all
+channels (the noise level), at most `max_channels` of them, ordered by
+decreasing amplitude. Until the table is available, and if the adaptive
+mode is disabled, the 25 closest channels are shown.
 """
 
-from phy import IPlugin
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from phy import IPlugin, connect
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_templates import get_template_amplitudes  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+
+def select_channels(ptp, noise_factor, max_channels):
+    """Channels clearly above the noise level by decreasing amplitude"""
+    noise = np.median(ptp)
+    channels = np.nonzero(ptp > noise_factor * noise)[0]
+    channels = channels[np.argsort(ptp[channels])[::-1]][:max_channels]
+    if channels.size == 0:
+        channels = np.array([np.argmax(ptp)])
+    return channels
 
 
 class WaveformThr(IPlugin):
+    # Select channels adaptively per template
+    adaptive = True
+
+    # Minimum amplitude relative to the median amplitude of all channels
+    noise_factor = 3.
+
+    # Maximum number of channels per cluster
+    max_channels = 25
+
     def attach_to_controller(self, controller):
         controller.model.n_closest_channels = 25
 
         # Select the channels whose mean amplitude is greater than this
         # fraction of the peak amplitude on the best channel
         controller.model.amplitude_threshold = 0.00
+
+        if not self.adaptive:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        job = []
+        selected = dict()  # Channels per template
+
+        @connect
+        def on_controller_ready(sender):
+            job.append(executor.submit(get_template_amplitudes, controller))
+
+            get_best_channels = controller.get_best_channels
+
+            def get_adaptive_channels(cluster_id):
+                """Informative channels of a cluster"""
+                if not job[0].done() or job[0].exception():
+                    return get_best_channels(cluster_id)
+                template_id = controller.get_template_for_cluster(cluster_id)
+                if template_id not in selected:
+                    selected[template_id] = select_channels(
+                        job[0].result()[template_id], self.noise_factor,
+                        self.max_channels)
+                return selected[template_id]
+
+            controller.get_best_channels = get_adaptive_channels
@@ -30,20 +30,28 @@ are treated individually if they are separated by the delimiter.
 
 Configuration:
 
-On first use, a JSON file will be created in the Phy configuration
-directory, usually {HOME}/.phy/plugin_writecomments.json. The delimiter
+On first use, a section 'WriteComments' will be created in the plugin
+configuration file in the Phy configuration directory, usually
+{HOME}/.phy/plugins.json (see `plugin_config`). The delimiter
 and the short hand notation pairs can be adjusted there.
 
 Note:
 
 Only single-character, lower-case short hand notations are supported.
+The parsed comments of each cluster are kept until the cluster is
+relabeled or changed (see `plugin_generation`).
 """
 
-import json
 from phy import IPlugin, connect
-from phy.utils import phy_config_dir
 from pathlib import Path
 import logging
+import sys
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_config import load_config  # noqa: E402
+from plugin_generation import ClusterCache, get_state  # noqa: E402
 
 logger = logging.getLogger('phy')
 
@@ -51,8 +59,6 @@ logger = logging.getLogger('phy')
 class WriteComments(IPlugin):
     # Load config
     def __init__(self):
-        filepath = Path(phy_config_dir()) / 'plugin_writecomments.json'
-
         # Default config
         dflts = dict()
         dflts['delimiter'] = '_'  # Comment delimiter
@@ -63,23 +69,10 @@ class WriteComments(IPlugin):
             'n': 'noisefloor',
         }
 
-        # Create config file with defaults if it does not exist
-        if not filepath.exists():
-            logger.debug("Create default config at %s.", filepath)
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(dflts, f, ensure_ascii=False, indent=4)
+        data = load_config('WriteComments', dflts)
 
-        # Load config
-        logger.debug("Load %s for config.", filepath)
-        with open(filepath, 'r') as f:
-            try:
-                data = json.load(f)
-            except json.decoder.JSONDecodeError as e:
-                logger.warning("Error decoding JSON: %s", e)
-                data = dflts
-
-        self.delimiter = data.get('delimiter', dflts['delimiter'])
-        self.pairs = data.get('pairs', dflts['pairs'])
+        self.delimiter = data['delimiter']
+        self.pairs = data['pairs']
 
         # Allow lower case keys only
         for k in self.pairs.keys():
@@ -88,6 +81,7 @@ class WriteComments(IPlugin):
                 del self.pairs[k]
 
         self.pairs_inv = {v: k for k, v in self.pairs.items()}
+        self.comments = None  # Parsed comments per cluster
 
         logger.debug("Available short hand notations are %s.",
                      ', '.join(self.pairs.keys()))
@@ -96,17 +90,18 @@ class WriteComments(IPlugin):
         """Load selected comments a list of as sets"""
         cluster_ids = controller.supervisor.selected
         if 'comment' not in controller.supervisor.fields:
-            logger.debug('Comment field does not exist. Return empty list.')
-            return []
-        allcmt = controller.supervisor.get_labels('comment')
+            logger.debug('Comment field does not exist. Return no comments.')
+            return [set() for _ in cluster_ids]
+        if self.comments is None:
+            self.comments = ClusterCache(get_state(controller))
+
+        def parse(cid):
+            cmt = controller.supervisor.cluster_meta.get('comment', cid)
+            cmt = cmt.split(self.delimiter) if cmt else []
+            return frozenset(cmt).difference('')
 
         # Find shared comments (ignoring empty comments)
-        comments = []
-        for cid in cluster_ids:
-            cmt = allcmt[cid].split(self.delimiter) if allcmt[cid] else []
-            cmt = set(cmt).difference('')
-            comments.append(cmt)
-        return comments
+        return [set(self.comments.get(cid, parse)) for cid in cluster_ids]
 
     def split_comments(self, comments):
         """Split list of sets into notations and custom comments"""
@@ -0,0 +1,223 @@
+"""
+Headless batch curation of Kilosort/phy data directories (not a plugin)
+
+Runs a recipe of the curation actions of the plugins over one or more
+data directories without the GUI, e.g. overnight:
+
+    python batch_curate.py recipe.json DIR [DIR ...] [--processes N]
+
+The clusters are processed in parallel in a pool of processes. The
+result is saved as `spike_clusters.npy` and `cluster_<field>.tsv` in
+each directory (as when saving in phy). Use `--dry-run` to only report
+what would change.
+
+The recipe is a JSON list of steps, applied in order, e.g.
+
+    [{"op": "split_duplicates"},
+     {"op": "flag_isi", "max_fraction": 0.01}]
+
+The operations and their parameters (with defaults) are
+
+- split_short_isi (min_isi=0.0015): see `SplitShortISI`
+- split_duplicates (min_isi=0.0001): see `SplitDuplicates`
+- kmeans (n_clusters=2): K-means on the features, see `Recluster`
+- mahalanobis (threshold=14): split off outliers, see `Recluster`
+- flag_isi (min_isi=0.0015, max_fraction=0.01, field="comment",
+  value="isi"): label the clusters with too many ISI violations
+- quality (quality=1, min_isi=0.0015, max_isi_fraction=0.01,
+  min_spikes=100): assign the quality and the group 'good' to the
+  clusters that meet both criteria, see `AssignQuality`
+
+A step applies to all clusters that are not in the group 'noise', or to
+the clusters listed in "clusters". As in phy, split clusters get new
+ids and inherit the labels of their parent.
+"""
+
+import argparse
+import json
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import (short_isi_labels,  # noqa: E402
+                               isi_violation_fraction, kmeans_labels,
+                               mahalanobis_outlier_labels)
+from plugin_features import get_feature_store  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+DEFAULTS = {
+    'split_short_isi': dict(min_isi=.0015),
+    'split_duplicates': dict(min_isi=.0001),
+    'kmeans': dict(n_clusters=2),
+    'mahalanobis': dict(threshold=14),
+    'flag_isi': dict(min_isi=.0015, max_fraction=.01, field='comment',
+                     value='isi'),
+    'quality': dict(quality=1, min_isi=.0015, max_isi_fraction=.01,
+                    min_spikes=100),
+}
+SPLITS = ('split_short_isi', 'split_duplicates', 'kmeans', 'mahalanobis')
+
+
+def load_recipe(path):
+    """List of steps with the defaults filled in"""
+    with open(path, 'r') as f:
+        recipe = json.load(f)
+    steps = []
+    for step in recipe:
+        if step.get('op') not in DEFAULTS:
+            raise ValueError('Unknown operation `%s`.' % step.get('op'))
+        params = dict(DEFAULTS[step['op']])
+        params.update(step)
+        steps.append(params)
+    return steps
+
+
+def _split_labels(task):
+    """Split labels of one cluster (run in a worker process)"""
+    step, dir_path, spike_ids, spike_times = task
+    op = step['op']
+    if op in ('split_short_isi', 'split_duplicates'):
+        return short_isi_labels(spike_times, step['min_isi'])
+    # Features on the channels of the templates of the cluster
+    data, _ = get_feature_store(dir_path).aligned(spike_ids)
+    if op == 'kmeans':
+        return kmeans_labels(data, step['n_clusters'])
+    if op == 'mahalanobis':
+        return mahalanobis_outlier_labels(data, step['threshold'],
+                                          overwrite=True)
+
+
+class BatchCuration(object):
+    """Curation state of one data directory"""
+
+    def __init__(self, model):
+        self.model = model
+        self.spike_clusters = np.array(model.spike_clusters)
+        self.metadata = {field: dict(values)
+                         for field, values in model.metadata.items()}
+        self.n_splits = 0
+        self.n_labels = 0
+
+    def clusters(self, step):
+        """Spike ids per cluster the step applies to"""
+        order = np.argsort(self.spike_clusters, kind='stable')
+        cluster_ids, start = np.unique(self.spike_clusters[order],
+                                       return_index=True)
+        bounds = np.append(start, len(order))
+        if 'clusters' in step:
+            include = set(step['clusters'])
+        else:
+            groups = self.metadata.get('group', {})
+            include = {c for c in cluster_ids.tolist()
+                       if groups.get(c) != 'noise'}
+        return {c: order[bounds[i]:bounds[i + 1]]
+                for i, c in enumerate(cluster_ids.tolist()) if c in include}
+
+    def label(self, field, value, cluster_ids):
+        if cluster_ids:
+            values = self.metadata.setdefault(field, dict())
+            values.update({c: value for c in cluster_ids})
+            self.n_labels += len(cluster_ids)
+
+    def split(self, cluster_id, spike_ids, labels):
+        """Assign each sub-cluster to a new cluster"""
+        if labels is None or len(np.unique(labels)) < 2:
+            return
+        next_id = int(self.spike_clusters.max()) + 1
+        for i, label in enumerate(np.unique(labels)):
+            self.spike_clusters[spike_ids[labels == label]] = next_id + i
+            for values in self.metadata.values():
+                if cluster_id in values:
+                    values[next_id + i] = values[cluster_id]
+        for values in self.metadata.values():
+            values.pop(cluster_id, None)
+        self.n_splits += 1
+
+    def run(self, step, executor):
+        clusters = self.clusters(step)
+        spike_times = self.model.spike_times
+        op = step['op']
+        logger.info('%s: %i clusters.', op, len(clusters))
+
+        if op in SPLITS:
+            dir_path = self.model.dir_path
+            tasks = [(step, dir_path, s, spike_times[s])
+                     for s in clusters.values()]
+            for (cluster_id, spike_ids), labels in zip(
+                    clusters.items(), executor.map(_split_labels, tasks)):
+                self.split(cluster_id, spike_ids, labels)
+
+        elif op == 'flag_isi':
+            self.label(step['field'], step['value'], [
+                c for c, s in clusters.items()
+                if isi_violation_fraction(spike_times[s], step['min_isi'])
+                > step['max_fraction']])
+
+        elif op == 'quality':
+            selection = [
+                c for c, s in clusters.items()
+                if len(s) >= step['min_spikes']
+                and isi_violation_fraction(spike_times[s], step['min_isi'])
+                <= step['max_isi_fraction']]
+            self.label('quality', str(step['quality']), selection)
+            self.label('group', 'good', selection)
+
+    def save(self):
+        self.model.save_spike_clusters(self.spike_clusters)
+        for field, values in self.metadata.items():
+            self.model.save_metadata(field, values)
+
+
+def curate(dir_path, recipe, processes=None, dry_run=False):
+    """Apply the recipe to one data directory"""
+    from phylib.io.model import load_model  # Deferred import
+    dir_path = Path(dir_path)
+    if (dir_path / '.phy' / 'curation_journal').exists():
+        # See `CurationJournal`: a crashed session would be replayed on top
+        logger.error('Skip `%s`, it has a pending curation journal.',
+                     dir_path)
+        return
+
+    params_path = dir_path / 'params.py'
+    model = load_model(params_path)
+    state = BatchCuration(model)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for step in recipe:
+            state.run(step, executor)
+
+    logger.info('%s: %i splits, %i labels, %i clusters.', dir_path,
+                state.n_splits, state.n_labels,
+                len(np.unique(state.spike_clusters)))
+    if not dry_run:
+        state.save()
+    model.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('recipe', help='JSON file with the curation steps')
+    parser.add_argument('dirs', nargs='+', help='data directories')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='do not save the result')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    recipe = load_recipe(args.recipe)
+    for dir_path in args.dirs:
+        try:
+            curate(dir_path, recipe, args.processes, args.dry_run)
+        except Exception as e:
+            logger.exception('Curation of `%s` failed: %s', dir_path, e)
+
+
+if __name__ == '__main__':
+    main()
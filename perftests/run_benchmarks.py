@@ -0,0 +1,237 @@
+"""
+Benchmarks of the plugin actions on synthetic datasets
+
+    python perftests/run_benchmarks.py [--scale small medium ...]
+
+Synthetic datasets (see `synthetic.py`) are generated on first use in
+`--data` (by default in the temporary directory). For each scenario,
+the plugins are attached to a stub controller (see `stub.py`) and an
+action is timed (best of `--repeat` runs, each on a fresh clustering)
+and its peak memory allocation is measured (with tracemalloc).
+
+The results are compared to a baseline file (`--baseline`), the change
+of the time and of the peak memory is logged for each scenario. The run
+fails if a scenario is slower or allocates more memory than the
+baseline by more than `--tolerance`. Save the results of a run as new
+baseline with `--save-baseline`. Baselines are specific to a machine.
+
+This folder is ignored by phy when loading plugins (its name contains
+'test').
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+logger = logging.getLogger('phy')
+
+HERE = Path(__file__).resolve().parent
+
+
+# Scenarios: setup a session, return the timed function
+
+def _largest(controller, n=1):
+    spc = controller.supervisor.clustering.spikes_per_cluster
+    return sorted(spc, key=lambda c: -len(spc[c]))[:n]
+
+
+def kmeans(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run('K_means_clustering', 2)
+
+
+def kmeans_drift(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run(
+        'K_means_clustering_amplitude_drift', 2)
+
+
+def waveform_kmeans(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run('waveform_clustering', 2)
+
+
+def mahalanobis(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run(
+        'Split by Mahalanobis distance', 14)
+
+
+def short_isi(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run('Visualize short ISI')
+
+
+def duplicates(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run('Visualize duplicates')
+
+
+def selectnearest(controller, view, n=50):
+    sup = controller.supervisor
+    sup.select([max(sup.clustering.cluster_ids)])
+
+    def run():
+        for _ in range(n):
+            sup.actions.run('Select next lower cluster')
+    return run
+
+
+def selectallinchannel(controller, view):
+    controller.supervisor.select(_largest(controller))
+    return lambda: controller.supervisor.actions.run('Select all in channel')
+
+
+def jump_to_spike(controller, view, n=100):
+    controller.supervisor.select(_largest(controller, 5))
+
+    def run():
+        for _ in range(n):
+            view.actions.run('Jump to next spike')
+    return run
+
+
+def correlograms(controller, view, n=20):
+    cluster_ids = _largest(controller, n)
+
+    def run():
+        # Add the clusters one by one to the selection, as when browsing
+        for i in range(1, n + 1):
+            controller._get_correlograms(cluster_ids[:i], .001, .05)
+    return run
+
+
+def comments(controller, view):
+    sup = controller.supervisor
+    sup.select(_largest(controller, 10))
+
+    def run():
+        sup.actions.run('Add comment', 'as_test')
+        sup.actions.run('Add comment', '~test')
+        sup.actions.run('Add comment', '!')
+    return run
+
+
+SCENARIOS = {
+    'K_means_clustering': (['Recluster'], kmeans),
+    'K_means_clustering_amplitude_drift': (['Recluster'], kmeans_drift),
+    'waveform_clustering': (['ReclusterWaveforms'], waveform_kmeans),
+    'MahalanobisDist': (['Recluster'], mahalanobis),
+    'VisualizeShortISI': (['SplitShortISI'], short_isi),
+    'VisualizeDuplicates': (['SplitDuplicates'], duplicates),
+    'selectnearest': (['SelectionOptions'], selectnearest),
+    'selectallinchannel': (['SelectionOptions'], selectallinchannel),
+    '_jump_to_spike': (['JumpInTrace'], jump_to_spike),
+    'comments': (['WriteComments'], comments),
+    'correlograms': (['CorrelogramCache'], correlograms),
+}
+
+
+def run_scenario(model, name, repeat):
+    """Best time (s) and peak memory allocation (bytes) of a scenario"""
+    from phylib.utils.event import reset  # Deferred import
+    from stub import create_session  # Deferred import
+    plugins, setup = SCENARIOS[name]
+
+    def prepare():
+        reset()
+        gc.collect()
+        return setup(*create_session(model, plugins))
+
+    times = []
+    for _ in range(repeat):
+        func = prepare()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    func = prepare()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of the results with respect to the baseline"""
+    failed = []
+    for scale, scenarios in results.items():
+        for name, r in scenarios.items():
+            b = baseline.get(scale, {}).get(name)
+            if b is None:
+                continue
+            for key in ('time', 'memory'):
+                if r[key] > b[key] * (1 + tolerance):
+                    failed.append('%s/%s: %s %.4g > %.4g' % (
+                        scale, name, key, r[key], b[key]))
+    return failed
+
+
+def main(args=None):
+    from synthetic import SCALES, get_dataset  # Deferred import
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', nargs='+', default=['small'],
+                        choices=list(SCALES))
+    parser.add_argument('--scenario', nargs='+', default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--data', default=str(
+        Path(tempfile.gettempdir()) / 'phy_plugin_benchmarks'))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=str(HERE / 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=.3)
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Keep the plugin configuration of the user untouched
+    home = tempfile.mkdtemp(prefix='phy_benchmark_home_')
+    os.environ['HOME'] = os.environ['USERPROFILE'] = home
+    os.mkdir(os.path.join(home, '.phy'))  # Created by phy on startup
+
+    baseline_path = Path(args.baseline)
+    baseline = (json.loads(baseline_path.read_text())
+                if baseline_path.exists() else {})
+
+    from phylib.io.model import load_model  # Deferred import
+    results = dict()
+    for scale in args.scale:
+        model = load_model(get_dataset(args.data, scale) / 'params.py')
+        results[scale] = dict()
+        for name in args.scenario:
+            t, peak = run_scenario(model, name, args.repeat)
+            results[scale][name] = dict(time=t, memory=peak)
+            b = baseline.get(scale, {}).get(name)
+            change = '  (%+4.0f%% time, %+4.0f%% memory)' % (
+                100 * (t / b['time'] - 1),
+                100 * (peak / b['memory'] - 1)) if b else ''
+            logger.info('%-8s %-34s %10.1f ms %10.1f MB%s', scale, name,
+                        t * 1e3, peak / 1e6, change)
+        model.close()
+
+    if args.save_baseline:
+        for scale, scenarios in results.items():
+            baseline.setdefault(scale, {}).update(scenarios)
+        baseline_path.write_text(json.dumps(baseline, indent=4))
+        logger.info('Saved baseline to %s.', baseline_path)
+        return 0
+    if not baseline:
+        logger.info('No baseline to compare with.')
+        return 0
+
+    failed = compare(results, baseline, args.tolerance)
+    for line in failed:
+        logger.error('Regression %s', line)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(HERE))
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Stub controller, supervisor and views for running the plugins without GUI
+
+Only the subset of the phy API used by the plugins is implemented. The
+clustering and the cluster labels use the classes of phy, the data is
+loaded with the template model of phylib.
+"""
+
+import importlib.util
+import sys
+from functools import partial
+from pathlib import Path
+import numpy as np
+from phy.cluster._utils import UpdateInfo, create_cluster_meta
+from phy.cluster.clustering import Clustering
+from phy.cluster.views.trace import TraceView
+from phylib.utils import connect, emit
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_plugin(name):
+    """Plugin class from the plugin folder (module loaded only once)"""
+    if name not in sys.modules:
+        if str(PLUGIN_DIR) not in sys.path:
+            sys.path.append(str(PLUGIN_DIR))
+        spec = importlib.util.spec_from_file_location(
+            name, str(PLUGIN_DIR / (name + '.py')))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return getattr(sys.modules[name], name)
+
+
+class StubActions(object):
+    def __init__(self):
+        self.callbacks = dict()
+
+    def add(self, callback=None, name=None, **kwargs):
+        if callback is None:
+            return partial(self.add, name=name, **kwargs)
+        name = name or callback.__name__
+        self.callbacks[name] = callback
+        setattr(self, name.lower().replace(' ', '_'), callback)
+        return callback
+
+    def run(self, name, *args):
+        return self.callbacks[name](*args)
+
+
+class SupervisorActions(StubActions):
+    def __init__(self, supervisor):
+        super(SupervisorActions, self).__init__()
+        self.supervisor = supervisor
+
+    def split(self, spike_ids, spike_clusters_rel=0):
+        return self.supervisor.clustering.split(spike_ids,
+                                                spike_clusters_rel)
+
+    def merge(self, cluster_ids=None, to=None):
+        cluster_ids = cluster_ids or self.supervisor.selected
+        return self.supervisor.clustering.merge(cluster_ids, to=to)
+
+
+class StubSupervisor(object):
+    def __init__(self, controller, spike_clusters, cluster_groups=None):
+        self.controller = controller
+        self.clustering = Clustering(spike_clusters)
+        self.cluster_meta = create_cluster_meta(cluster_groups)
+        self.actions = SupervisorActions(self)
+        self.columns = ['id', 'ch', 'n_spikes']
+        self.similarity_view = None
+        self.selected_clusters = []
+        self.selected_similar = []
+
+        @connect(sender=self.clustering)
+        def on_cluster(sender, up):
+            # New clusters inherit the labels of their parents
+            if up.added:
+                self.cluster_meta.set_from_descendants(
+                    up.descendants, largest_old_cluster=up.largest_old_cluster)
+            emit('cluster', self, up)
+
+    @property
+    def selected(self):
+        return self.selected_clusters + self.selected_similar
+
+    @property
+    def fields(self):
+        return tuple(self.cluster_meta.fields)
+
+    def select(self, *cluster_ids):
+        if len(cluster_ids) == 1 and isinstance(cluster_ids[0],
+                                                (list, tuple)):
+            cluster_ids = cluster_ids[0]
+        self.selected_clusters = [int(c) for c in cluster_ids]
+        self.selected_similar = []
+        emit('select', self, self.selected)
+
+    def get_labels(self, field):
+        return {c: self.cluster_meta.get(field, c)
+                for c in self.clustering.cluster_ids}
+
+    def label(self, name, value, cluster_ids=None):
+        if cluster_ids is None:
+            cluster_ids = self.selected
+        if not hasattr(cluster_ids, '__len__'):
+            cluster_ids = [cluster_ids]
+        if name not in self.cluster_meta.fields:
+            self.cluster_meta.add_field(name)
+        self.cluster_meta.set(name, cluster_ids, value)
+        emit('cluster', self, UpdateInfo(
+            description='metadata_' + name, metadata_changed=cluster_ids,
+            metadata_value=value))
+
+    def get_cluster_info(self, cluster_id):
+        return dict(id=cluster_id,
+                    ch=self.controller.get_best_channel(cluster_id),
+                    group=self.cluster_meta.get('group', cluster_id),
+                    n_spikes=len(
+                        self.clustering.spikes_per_cluster[cluster_id]))
+
+    @property
+    def cluster_info(self):
+        return [self.get_cluster_info(c) for c in self.clustering.cluster_ids]
+
+
+class StubController(object):
+    n_spikes_waveforms = 100
+    n_spikes_correlograms = 100000
+    batch_size_waveforms = 10
+
+    def __init__(self, model):
+        self.model = model
+        self.dir_path = model.dir_path
+        self.supervisor = None  # Created after attaching the plugins
+        self.cluster_metrics = dict()
+        self.view_creator = dict()
+
+    def _spikes(self, cluster_id):
+        return self.supervisor.clustering.spikes_per_cluster[cluster_id]
+
+    def get_template_for_cluster(self, cluster_id):
+        templates = self.model.spike_templates[self._spikes(cluster_id)]
+        return int(np.bincount(templates).argmax())
+
+    def get_best_channels(self, cluster_id):
+        template = self.get_template_for_cluster(cluster_id)
+        return self.model.get_template(template).channel_ids
+
+    def get_best_channel(self, cluster_id):
+        return self.get_best_channels(cluster_id)[0]
+
+    def get_spike_times(self, cluster_id):
+        return self.model.spike_times[self._spikes(cluster_id)]
+
+    def selector(self, n, cluster_ids, **kwargs):
+        """Regular subselection of the spikes of each cluster"""
+        out = []
+        for cluster_id in cluster_ids:
+            spike_ids = self._spikes(cluster_id)
+            step = max(1, len(spike_ids) // n)
+            out.append(spike_ids[::step][:n])
+        return np.sort(np.concatenate(out)) if out else np.array([])
+
+
+class StubGUI(object):
+    def get_view(self, cls, **kwargs):
+        return None
+
+
+class StubTraceView(TraceView):
+    """Trace view with actions and position only"""
+
+    def __init__(self):
+        self.actions = StubActions()
+        self._time = 0.
+
+    @property
+    def time(self):
+        return self._time
+
+    def go_to(self, time):
+        self._time = time
+
+
+def create_session(model, plugins):
+    """Attach plugins to a stub controller as phy does on startup"""
+    controller = StubController(model)
+    for name in plugins:
+        load_plugin(name)().attach_to_controller(controller)
+    groups = {c: 'unsorted' for c in np.unique(model.spike_clusters).tolist()}
+    controller.supervisor = StubSupervisor(
+        controller, np.array(model.spike_clusters), groups)
+    emit('controller_ready', controller)
+
+    gui = StubGUI()
+    emit('gui_ready', controller, gui)
+    view = StubTraceView()
+    emit('view_attached', view, gui)
+    return controller, view
@@ -0,0 +1,145 @@
+"""
+Synthetic Kilosort-style datasets for the benchmarks
+
+The datasets are written in chunks, such that even the largest scale
+does not need to fit into memory. The spikes of all clusters form one
+Poisson process over the recording with cluster sizes spread over two
+orders of magnitude. The features of each cluster are scattered around
+a cluster-specific mean. The raw data file is created as a sparse file
+of zeros (only the file size is allocated).
+"""
+
+import logging
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+SCALES = {
+    'small': dict(n_spikes=10 ** 5, n_channels=64, n_clusters=100),
+    'medium': dict(n_spikes=10 ** 6, n_channels=384, n_clusters=1000),
+    'large': dict(n_spikes=10 ** 7, n_channels=1024, n_clusters=5000),
+    'huge': dict(n_spikes=10 ** 8, n_channels=4096, n_clusters=20000),
+}
+
+SAMPLE_RATE = 30000.
+N_SAMPLES = 82  # Samples per template
+N_PCS = 3
+N_LOCAL = 32  # Channels per template
+RATE = 5.  # Mean firing rate (Hz)
+CHUNK = 2 * 10 ** 5  # Spikes per chunk
+
+PARAMS = """dat_path = 'raw.dat'
+n_channels_dat = {n_channels}
+dtype = 'int16'
+offset = 0
+sample_rate = {sample_rate}
+hp_filtered = True
+"""
+
+
+def _save(path, shape, dtype):
+    return np.lib.format.open_memmap(str(path), 'w+', dtype, shape)
+
+
+def channel_positions(n_channels):
+    """Four-column probe with a pitch of 20 µm"""
+    ch = np.arange(n_channels)
+    return np.c_[(ch % 4) * 20., (ch // 4) * 20.]
+
+
+def local_channels(positions, peaks, n_local, chunk=256):
+    """Nearest channels around the peak channel of each template"""
+    out = np.empty((len(peaks), n_local), dtype=np.uint32)
+    for i in range(0, len(peaks), chunk):
+        p = positions[peaks[i:i + chunk]]
+        d = np.sum((p[:, None, :] - positions[None, :, :]) ** 2, axis=2)
+        out[i:i + chunk] = np.argsort(d, axis=1, kind='stable')[:, :n_local]
+    return out
+
+
+def generate(dir_path, n_spikes, n_channels, n_clusters, seed=0):
+    """Write a synthetic dataset to a directory"""
+    dir_path = Path(dir_path)
+    dir_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    n_local = min(N_LOCAL, n_channels)
+    duration = n_spikes / n_clusters / RATE
+    logger.info('Generate %i spikes, %i channels, %i clusters (%.0f s) in '
+                '%s.', n_spikes, n_channels, n_clusters, duration, dir_path)
+
+    # Probe and templates
+    positions = channel_positions(n_channels)
+    np.save(dir_path / 'channel_map.npy', np.arange(n_channels,
+                                                     dtype=np.int32))
+    np.save(dir_path / 'channel_positions.npy', positions)
+    peaks = rng.randint(0, n_channels, n_clusters)
+    channels = local_channels(positions, peaks, n_local)
+    np.save(dir_path / 'pc_feature_ind.npy', channels)
+    np.save(dir_path / 'template_ind.npy', channels.astype(np.float64))
+
+    t = np.linspace(-1, 1, N_SAMPLES)
+    shape = (-np.exp(-(t * 8) ** 2) + .3 * np.exp(-((t - .2) * 4) ** 2))
+    decay = np.exp(-np.arange(n_local) / 4.)
+    templates = _save(dir_path / 'templates.npy',
+                      (n_clusters, N_SAMPLES, n_local), np.float32)
+    for i in range(0, n_clusters, 1024):
+        n = len(templates[i:i + 1024])
+        templates[i:i + n] = (shape[None, :, None] * decay[None, None, :]
+                              * rng.uniform(.5, 2, (n, 1, 1)))
+    del templates
+    _save(dir_path / 'similar_templates.npy', (n_clusters, n_clusters),
+          np.float32)
+
+    # Cluster sizes spread over two orders of magnitude
+    weights = np.exp(rng.uniform(0, np.log(100), n_clusters))
+    weights /= weights.sum()
+    means = rng.normal(0, 1, (n_clusters, N_PCS, n_local)).astype(np.float32)
+
+    # Spikes, in chunks
+    files = dict(
+        spike_times=_save(dir_path / 'spike_times.npy', (n_spikes,),
+                          np.uint64),
+        spike_templates=_save(dir_path / 'spike_templates.npy', (n_spikes,),
+                              np.uint32),
+        spike_clusters=_save(dir_path / 'spike_clusters.npy', (n_spikes,),
+                             np.int32),
+        amplitudes=_save(dir_path / 'amplitudes.npy', (n_spikes,),
+                         np.float32),
+        pc_features=_save(dir_path / 'pc_features.npy',
+                          (n_spikes, N_PCS, n_local), np.float32),
+    )
+    t0 = 0.
+    for i in range(0, n_spikes, CHUNK):
+        n = min(CHUNK, n_spikes - i)
+        times = t0 + np.cumsum(rng.exponential(duration / n_spikes, n))
+        t0 = times[-1]
+        clusters = rng.choice(n_clusters, n, p=weights)
+        files['spike_times'][i:i + n] = (times * SAMPLE_RATE).astype(
+            np.uint64)
+        files['spike_templates'][i:i + n] = clusters
+        files['spike_clusters'][i:i + n] = clusters
+        files['amplitudes'][i:i + n] = rng.gamma(10, 2, n)
+        files['pc_features'][i:i + n] = means[clusters] + rng.normal(
+            0, .5, (n, N_PCS, n_local))
+    for f in files.values():
+        f.flush()
+    del files
+
+    # Raw data as a sparse file of zeros
+    n_samples = int((t0 + 1) * SAMPLE_RATE)
+    with open(dir_path / 'raw.dat', 'wb') as f:
+        f.truncate(n_samples * n_channels * 2)
+
+    with open(dir_path / 'params.py', 'w') as f:
+        f.write(PARAMS.format(n_channels=n_channels,
+                              sample_rate=SAMPLE_RATE))
+    return dir_path
+
+
+def get_dataset(root, scale):
+    """Directory of a dataset at a given scale, generated if needed"""
+    dir_path = Path(root) / scale
+    if not (dir_path / 'params.py').exists():
+        generate(dir_path, **SCALES[scale])
+    return dir_path
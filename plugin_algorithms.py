@@ -0,0 +1,209 @@
+"""
+Numeric core of the curation actions (not a plugin)
+
+These functions do not depend on the GUI. They are used by the plugins
+(`SplitShortISI`, `SplitDuplicates`, `Recluster`, `ReclusterWaveforms`,
+`OutlierThreshold`) as well as by the headless batch curation
+(`batch_curate.py`). Split labels follow the convention of the plugins:
+1 for the spikes that remain, 2 (or more) for the spikes that are split
+off.
+
+Features, waveforms and the intermediate matrices are computed in
+`DTYPE` (float32, half the memory of float64). Arrays already in this
+dtype are not copied, and the reshaped feature matrices are views.
+"""
+
+import numpy as np
+
+# Dtype of the numeric computations of the plugins
+DTYPE = np.float32
+
+
+def as_dtype(arr):
+    """Array in the compute dtype (not copied if already in it)"""
+    return np.asarray(arr, dtype=DTYPE)
+
+
+def short_isi_labels(spike_times, min_isi):
+    """
+    Label the spikes followed by another spike within `min_isi`
+    (seconds) with 2, all others with 1
+    """
+    labels = np.ones(len(spike_times), 'int64')
+    labels[:-1][np.diff(spike_times) < min_isi] = 2
+    return labels
+
+
+def isi_violation_fraction(spike_times, min_isi):
+    """Fraction of interspike intervals shorter than `min_isi`"""
+    if len(spike_times) < 2:
+        return 0.
+    return float(np.mean(np.diff(spike_times) < min_isi))
+
+
+def _kmeans_pp(data, k):
+    """
+    Initial centroids chosen by k-means++, in the dtype of the data
+    (scipy's own initialization computes the distances in float64)
+    """
+    centroids = np.empty((k, data.shape[1]), dtype=data.dtype)
+    centroids[0] = data[np.random.randint(len(data))]
+    norms = np.einsum('ij,ij->i', data, data)
+    d2 = np.full(len(data), np.inf, dtype=data.dtype)
+    for i in range(1, k):
+        # Squared distances to the last centroid, without a copy of the
+        # data: |x|^2 - 2 x.c + |c|^2
+        dist = data @ (-2 * centroids[i - 1])
+        dist += norms
+        dist += centroids[i - 1] @ centroids[i - 1]
+        np.minimum(d2, dist, out=d2)
+        cumulated = np.cumsum(np.maximum(d2, 0), dtype=np.float64)
+        j = np.searchsorted(cumulated, np.random.random_sample() *
+                            cumulated[-1], side='right')
+        centroids[i] = data[min(j, len(data) - 1)]
+    return centroids
+
+
+def kmeans_labels(data, n_clusters, minit='++'):
+    """K-means clustering of whitened data (one row per spike)"""
+    from scipy.cluster.vq import kmeans2, whiten  # Deferred import
+    data = whiten(as_dtype(data).reshape((data.shape[0], -1)))
+    if minit == '++' and len(data) >= n_clusters:
+        n_clusters, minit = _kmeans_pp(data, n_clusters), 'matrix'
+    _, labels = kmeans2(data, n_clusters, minit=minit)
+    return labels
+
+
+def _qr_r(X, chunk_size=16384):
+    """
+    R factor of the QR decomposition of `X` (at least as many rows as
+    columns), computed by blocks of rows to bound the work memory
+    """
+    from scipy.linalg import qr  # Deferred import
+    # NOTE: numpy.linalg computes in float64, scipy.linalg in the dtype
+    # of the data
+    d = X.shape[1]
+    R = X[:0]
+    for i in range(0, X.shape[0], chunk_size):
+        chunk = X[i:i + chunk_size]
+        # Decomposed in place (Fortran order)
+        block = np.empty((len(R) + len(chunk), d), dtype=X.dtype, order='F')
+        block[:len(R)] = R
+        block[len(R):] = chunk
+        _, R = qr(block, mode='raw', overwrite_a=True, check_finite=False)
+    return R
+
+
+def mahalanobis_distances(X, overwrite=False):
+    """
+    Squared Mahalanobis distance of each row of `X` to the mean of all
+    rows (computed via QR decomposition)
+
+    With `overwrite`, `X` is used as work array if it is already in the
+    compute dtype.
+    """
+    from scipy.linalg import solve_triangular  # Deferred import
+    n = X.shape[0]
+    C = as_dtype(X)
+    if (np.may_share_memory(C, X) and not overwrite or
+            not C.flags.c_contiguous or not C.flags.writeable):
+        C = np.array(C, order='C')
+    C -= C.mean(axis=0)
+    R = _qr_r(C)
+    diag = np.abs(np.diag(R))
+    if diag.min() <= diag.max() * max(C.shape) * np.finfo(DTYPE).eps:
+        # Rank deficient: least squares solution
+        ri = np.linalg.lstsq(R.T, C.T, rcond=None)[0]
+    else:
+        # Solve R.T @ ri = C.T in place of C (its transpose is F-ordered)
+        ri = solve_triangular(R, C.T, trans='T', overwrite_b=True,
+                              check_finite=False)
+    d = np.einsum('ij,ij->j', ri, ri)
+    d *= n - 1
+    return d
+
+
+def mahalanobis_outlier_labels(X, threshold, overwrite=False):
+    """
+    Label the rows of `X` with a Mahalanobis distance greater than
+    `threshold` (in STDs) with 2, all others with 1
+
+    Returns None if there are fewer rows than dimensions.
+    """
+    X = np.reshape(X, (X.shape[0], -1))
+    if X.shape[0] < X.shape[1]:
+        return None
+    labels = np.ones(X.shape[0], dtype=int)
+    labels[mahalanobis_distances(X, overwrite) > threshold ** 2] = 2
+    return labels
+
+
+def _window_kmeans(values, n_clusters):
+    """Centroids and labels of one window (None if degenerate)"""
+    from scipy.cluster.vq import kmeans2  # Deferred import
+    values = as_dtype(values).reshape((-1, 1))
+    if len(values) < n_clusters or np.ptp(values) == 0:
+        return None, None
+    centroids, labels = kmeans2(values, _kmeans_pp(values, n_clusters),
+                                minit='matrix')
+    return centroids[:, 0], labels
+
+
+def time_windows(spike_times, window, min_spikes):
+    """Spike index bounds of consecutive windows of `window` seconds"""
+    n = len(spike_times)
+    if n == 0:
+        return []
+    edges = np.arange(spike_times[0] + window, spike_times[-1], window)
+    bounds = [0]
+    for b in np.searchsorted(spike_times, edges).tolist():
+        # Windows with too few spikes are merged with the previous one
+        if b - bounds[-1] >= min_spikes and n - b >= min_spikes:
+            bounds.append(b)
+    bounds.append(n)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def windowed_kmeans_labels(spike_times, get_values, n_clusters, window,
+                           min_spikes=None, executor=None):
+    """
+    K-means clustering of one value per spike (e.g. the amplitude) in
+    consecutive time windows
+
+    The sub-clusters are linked across windows by matching their
+    centroids with the ones of the previous window, such that slow
+    changes (drift) are followed. `get_values(start, stop)` returns the
+    values of the spikes `start:stop` (sorted by time), only one window
+    is loaded at a time per worker. The windows are clustered in
+    parallel if an `executor` is given.
+    """
+    from scipy.optimize import linear_sum_assignment  # Deferred import
+    min_spikes = min_spikes or 20 * n_clusters
+    windows = time_windows(spike_times, window, min_spikes)
+
+    def cluster(bounds):
+        return _window_kmeans(get_values(*bounds), n_clusters)
+
+    results = (executor.map(cluster, windows) if executor is not None
+               else map(cluster, windows))
+
+    labels = np.zeros(len(spike_times), dtype=np.int32)
+    tracked = None  # Centroid of each sub-cluster in the previous window
+    for (start, stop), (centroids, window_labels) in zip(windows, results):
+        if centroids is None:
+            if tracked is not None:
+                values = np.asarray(get_values(start, stop)).ravel()
+                labels[start:stop] = np.argmin(
+                    np.abs(values[:, None] - tracked[None, :]), axis=1)
+            continue
+        if tracked is None:
+            # Sub-clusters numbered by increasing value
+            cols = np.argsort(np.argsort(centroids))
+        else:
+            rows, cols = linear_sum_assignment(
+                np.abs(centroids[:, None] - tracked[None, :]))
+            cols = cols[np.argsort(rows)]
+        labels[start:stop] = cols[window_labels]
+        tracked = np.empty(n_clusters)
+        tracked[cols] = centroids
+    return labels
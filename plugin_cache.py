@@ -0,0 +1,163 @@
+"""
+Persistent cache of arrays per data directory (not a plugin)
+
+Used by `plugin_spikes`, and usable by any plugin for results that are
+expensive to compute but deterministic for a dataset. The arrays are
+stored as .npy files in `.phy/plugin_cache/` in the data directory and
+read memory-mapped, each under a name and a key. Keys computed from the
+data the result depends on with `array_key` (e.g. from the spike
+clusters) make the entries of another clustering state unreachable.
+
+`index.json` records the size and last use of each entry. When the
+total size exceeds `BUDGET`, the least recently used entries are
+removed. The numbers of hits and misses are logged when phy exits.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+BUDGET = 2 * 10 ** 9  # Maximum total size of a cache (bytes)
+
+_lock = threading.Lock()
+_caches = dict()  # Cache per data directory
+
+
+def array_key(*values):
+    """Hash of the contents of arrays and other values"""
+    h = hashlib.blake2b(digest_size=10)
+    for value in values:
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            h.update(('%s%s' % (value.dtype.str, value.shape)).encode())
+            h.update(memoryview(value).cast('B'))
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+class ArrayCache(object):
+    """Named arrays on disk, with a size budget and LRU eviction"""
+
+    def __init__(self, dir_path, budget=BUDGET):
+        self.path = Path(dir_path) / '.phy' / 'plugin_cache'
+        self.budget = budget
+        self.hits = self.misses = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        try:
+            with open(self.path / 'index.json', 'r') as f:
+                self.entries = json.load(f)  # {filename: [size, last_use]}
+        except (OSError, ValueError):
+            self.entries = dict()
+        self.entries = {k: v for k, v in self.entries.items()
+                        if (self.path / k).exists()}
+
+    @property
+    def size(self):
+        return sum(size for size, _ in self.entries.values())
+
+    def _filename(self, name, key):
+        return '%s-%s.npy' % (name, key)
+
+    def get(self, name, key, mmap_mode='r'):
+        """Array stored under a name and a key, or None"""
+        filename = self._filename(name, key)
+        with self._lock:
+            if filename not in self.entries:
+                self.misses += 1
+                return None
+            try:
+                arr = np.load(self.path / filename, mmap_mode=mmap_mode)
+            except (OSError, ValueError) as e:
+                logger.debug('Discard cached %s: %s', filename, e)
+                self._remove(filename)
+                self.misses += 1
+                return None
+            self.entries[filename][1] = time.time()
+            self._dirty = True
+            self.hits += 1
+            return arr
+
+    def put(self, name, key, arr):
+        """Store an array under a name and a key"""
+        arr = np.asarray(arr)
+        if arr.nbytes > self.budget:
+            return
+        filename = self._filename(name, key)
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp = self.path / (filename + '.tmp')
+            try:
+                with open(tmp, 'wb') as f:
+                    np.save(f, arr)
+                os.replace(tmp, self.path / filename)
+            except OSError as e:
+                logger.debug('Could not cache %s: %s', filename, e)
+                return
+            self.entries[filename] = [(self.path / filename).stat().st_size,
+                                      time.time()]
+            self._dirty = True
+            self._evict()
+            self.flush()
+
+    def _remove(self, filename):
+        self.entries.pop(filename, None)
+        try:
+            os.remove(self.path / filename)
+        except OSError:
+            pass  # Still mapped (Windows) or already removed
+        self._dirty = True
+
+    def _evict(self):
+        """Remove the least recently used entries over the budget"""
+        size = self.size
+        for filename in sorted(self.entries, key=lambda k: self.entries[k][1]):
+            if size <= self.budget:
+                break
+            size -= self.entries[filename][0]
+            logger.debug('Evict %s from the plugin cache.', filename)
+            self._remove(filename)
+
+    def flush(self):
+        """Save the index"""
+        with self._lock:
+            if not self._dirty and (self.path / 'index.json').exists():
+                return
+            tmp = self.path / 'index.json.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(tmp, self.path / 'index.json')
+            except OSError as e:
+                logger.debug('Could not save the plugin cache index: %s', e)
+            self._dirty = False
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=len(self.entries), size=self.size)
+
+
+def get_cache(dir_path):
+    """Array cache of a data directory (opened once)"""
+    dir_path = Path(dir_path)
+    with _lock:
+        if dir_path not in _caches:
+            _caches[dir_path] = cache = ArrayCache(dir_path)
+
+            @atexit.register
+            def close():
+                if cache.entries:
+                    cache.flush()
+                logger.debug('Plugin cache of %s: %s.', dir_path,
+                             ', '.join('%i %s' % (v, k)
+                                       for k, v in cache.stats().items()))
+        return _caches[dir_path]
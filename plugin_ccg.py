@@ -0,0 +1,164 @@
+"""
+Cross-correlograms with a cache per pair of clusters (not a plugin)
+
+Used by `CorrelogramCache`. The results are the same as those of
+`phylib.stats.ccg.correlograms`. The spike trains of the clusters are
+merged into one sorted train, in which each spike is compared with the
+following spikes within the window, counting all pairs of clusters at
+once. The counts of each (ordered) pair of clusters are cached. As phy
+never reuses a cluster id for different spikes, cached pairs stay valid
+after splits and merges, and are reused after undo and redo. When only
+some clusters of a selection are new, only the spikes of these clusters
+are compared with the spikes of the whole selection.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+
+def _half_ccg_counts(samples, labels, n_clusters, bin_samples, n_bins, idx,
+                     direction=1, skip=None):
+    """
+    Counts of the spike pairs of a merged spike train between the spikes
+    `idx` and the following (or preceding, with `direction=-1`) spikes,
+    shape (n_clusters, n_clusters, n_bins // 2 + 1)
+
+    The counts are those of the pairs (earlier spike, later spike). Pairs
+    with a spike in `skip` (boolean mask of the merged train) among the
+    other spikes are not counted.
+    """
+    counts = np.zeros((n_clusters, n_clusters, n_bins // 2 + 1),
+                      dtype=np.int64)
+    n = len(samples)
+    shift = 1
+    while len(idx):
+        other = idx + direction * shift
+        valid = (other >= 0) & (other < n)
+        idx, other = idx[valid], other[valid]
+        bins = np.abs(samples[other] - samples[idx]) // bin_samples
+        in_window = bins <= n_bins / 2.  # Spikes with partners left
+        idx, other, bins = idx[in_window], other[in_window], bins[in_window]
+        first, second = (idx, other) if direction > 0 else (other, idx)
+        if skip is not None:
+            keep = ~skip[other]
+            first, second, bins = first[keep], second[keep], bins[keep]
+        counts += np.bincount(np.ravel_multi_index(
+            (labels[first], labels[second], bins), counts.shape),
+            minlength=counts.size).reshape(counts.shape)
+        shift += 1
+    return counts
+
+
+def ccg_counts(trains, sample_rate, bin_size, window_size, executor=None,
+               n_chunks=1, rows=None):
+    """
+    One-sided correlograms of all pairs of spike trains
+
+    Parameters
+    ----------
+    trains : list of arrays
+        Sorted spike times (seconds) of each cluster
+    executor : Executor
+        If given, the merged train is processed in `n_chunks` parts in
+        parallel
+    rows : list
+        If given, only the pairs with one of these clusters (indices in
+        `trains`) are counted, the other counts are zero
+
+    Returns
+    -------
+    counts : array, shape (n_clusters, n_clusters, n_bins // 2 + 1)
+    """
+    n_clusters = len(trains)
+    bin_samples = int(sample_rate * bin_size)
+    n_bins = 2 * int(.5 * window_size / bin_size) + 1
+
+    # Merge the sorted spike trains (the stable sort merges sorted runs)
+    times = np.concatenate([np.asarray(t, dtype=np.float64) for t in trains]
+                           + [np.array([])])
+    labels = np.repeat(np.arange(n_clusters), [len(t) for t in trains])
+    order = np.argsort(times, kind='stable')
+    samples = (times[order] * sample_rate).astype(np.int64)
+    labels = labels[order]
+
+    args = (samples, labels, n_clusters, bin_samples, n_bins)
+    parallel = executor is not None and n_chunks > 1
+    n_parts = n_chunks if parallel else 1
+    if rows is None:
+        # Each spike with the following ones
+        parts = [(idx, 1, None) for idx in
+                 np.array_split(np.arange(len(samples)), n_parts)]
+    else:
+        # The spikes of the rows with the following spikes, and with the
+        # preceding spikes of the other clusters (counted only once)
+        in_rows = np.isin(labels, rows)
+        spikes = np.flatnonzero(in_rows)
+        parts = [(idx, direction, skip) for idx in
+                 np.array_split(spikes, n_parts)
+                 for direction, skip in ((1, None), (-1, in_rows))]
+    if parallel:
+        return sum(executor.map(lambda p: _half_ccg_counts(*args, *p),
+                                parts))
+    return sum(_half_ccg_counts(*args, *p) for p in parts)
+
+
+def symmetrize(counts):
+    """Full correlograms from one-sided ones (as phylib)"""
+    counts = counts.copy()
+    counts[..., 0] = np.maximum(counts[..., 0], counts[..., 0].T)
+    sym = np.transpose(counts[..., 1:][..., ::-1], (1, 0, 2))
+    return np.dstack((sym, counts))
+
+
+class CCGCache(object):
+    """Least recently used one-sided correlograms per pair of clusters"""
+
+    def __init__(self, max_pairs=100000):
+        self.max_pairs = max_pairs
+        self.pairs = OrderedDict()  # {(a, b, bin_size, window): counts}
+        self._lock = threading.Lock()
+
+    def get(self, cluster_ids, params):
+        """
+        Cached counts of the pairs of clusters, and the clusters with
+        missing pairs
+
+        The rows and columns of the missing clusters are zero, the counts
+        are None if no cluster is complete.
+        """
+        with self._lock:
+            complete = []
+            missing = []
+            for a in cluster_ids:
+                if all((a, b) + params in self.pairs and
+                       (b, a) + params in self.pairs
+                       for b in complete + [a]):
+                    complete.append(a)
+                else:
+                    missing.append(a)
+            if not complete:
+                return None, missing
+            keys = [(a, b) + params for a in complete for b in complete]
+            for k in keys:
+                self.pairs.move_to_end(k)
+            first = self.pairs[keys[0]]
+            n = len(cluster_ids)
+            counts = np.zeros((n, n) + first.shape, dtype=first.dtype)
+            index = [cluster_ids.index(c) for c in complete]
+            counts[np.ix_(index, index)] = np.array(
+                [self.pairs[k] for k in keys]).reshape(
+                    (len(complete), len(complete), -1))
+            return counts, missing
+
+    def put(self, cluster_ids, params, counts):
+        with self._lock:
+            for i, a in enumerate(cluster_ids):
+                for j, b in enumerate(cluster_ids):
+                    self.pairs[(a, b) + params] = counts[i, j]
+                    self.pairs.move_to_end((a, b) + params)
+            while len(self.pairs) > self.max_pairs:
+                self.pairs.popitem(last=False)
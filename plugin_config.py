@@ -0,0 +1,136 @@
+"""
+Shared configuration store of the plugins (not a plugin)
+
+The settings of all plugins are kept in one JSON file in the Phy
+configuration directory, usually {HOME}/.phy/plugins.json, with one
+section per plugin. The file is read only once and shared by all
+plugins.
+
+If a section does not exist yet, it is migrated from the previous
+per-plugin file ({HOME}/.phy/plugin_<name>.json) if present, or created
+from the defaults. Each value is validated against the type of its
+default value and replaced by the default if invalid.
+"""
+
+import copy
+import json
+import logging
+import os
+from pathlib import Path
+from phy.utils import phy_config_dir
+
+logger = logging.getLogger('phy')
+
+FILENAME = 'plugins.json'
+
+_store = None  # Content of the configuration file
+
+
+def _path():
+    return Path(phy_config_dir()) / FILENAME
+
+
+def _read():
+    """Read the configuration file (once)"""
+    global _store
+    if _store is not None:
+        return _store
+
+    path = _path()
+    logger.debug("Load %s for config.", path)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            _store = json.load(f)
+    except FileNotFoundError:
+        _store = dict()
+    except json.decoder.JSONDecodeError as e:
+        logger.warning("Error decoding JSON: %s", e)
+        _store = dict()
+
+    if not isinstance(_store, dict):
+        logger.warning("Invalid config in %s. Using defaults.", path)
+        _store = dict()
+    return _store
+
+
+def _write():
+    """Write the configuration file (replacing it atomically)"""
+    path = _path()
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(_store, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, path)
+
+
+def _migrate(name):
+    """Read the previous per-plugin configuration file if present"""
+    path = Path(phy_config_dir()) / ('plugin_%s.json' % name.lower())
+    if not path.exists():
+        return None
+    logger.info("Migrate config from %s to %s.", path, _path())
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.decoder.JSONDecodeError as e:
+            logger.warning("Error decoding JSON: %s", e)
+            return None
+
+
+def _valid(value, default):
+    """Check that a value is of the type of its default"""
+    if isinstance(default, bool):
+        return isinstance(value, bool)
+    if isinstance(default, (int, float)):
+        return (isinstance(value, (int, float))
+                and not isinstance(value, bool))
+    return isinstance(value, type(default))
+
+
+def validate(name, config, defaults):
+    """Replace missing or invalid values by their defaults"""
+    if not _valid(config, defaults):
+        logger.warning("Invalid config for %s. Using defaults.", name)
+        return copy.deepcopy(defaults)
+    if not isinstance(defaults, dict):
+        return config
+
+    config = dict(config)
+    for key, default in defaults.items():
+        if key not in config:
+            config[key] = copy.deepcopy(default)
+        elif not _valid(config[key], default):
+            logger.warning("Invalid value for %s '%s': %s. Setting to %s "
+                           "(default).", name, key, config[key], default)
+            config[key] = copy.deepcopy(default)
+    return config
+
+
+def load_config(name, defaults):
+    """
+    Return the configuration section of a plugin
+
+    Parameters
+    ----------
+    name : str
+        Name of the plugin
+    defaults : dict or list
+        Default configuration, also defining the expected types
+    """
+    store = _read()
+    if name not in store:
+        config = _migrate(name)
+        if config is None:
+            logger.debug("Create default config for %s in %s.", name,
+                         _path())
+            config = copy.deepcopy(defaults)
+        store[name] = config
+        _write()
+
+    store[name] = validate(name, store[name], defaults)
+    return copy.deepcopy(store[name])
+
+
+def save_config(name, config):
+    """Store the configuration section of a plugin"""
+    _read()[name] = copy.deepcopy(config)
+    _write()
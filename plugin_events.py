@@ -0,0 +1,126 @@
+"""
+Shared helpers for event markers (not a plugin)
+
+Used by `EventMarker` and `EventResponse`. See `EventMarker` for the
+expected file formats.
+"""
+
+import logging
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+
+def _load_file(dir_path, name, **kwargs):
+    """Load `name`.npy (memory-mapped) or `name`.txt from a directory"""
+    filename = dir_path / (name + '.npy')
+    if filename.exists():
+        logger.debug('Load `%s`.', filename)
+        return np.atleast_1d(np.load(filename, mmap_mode='r'))
+    filename = dir_path / (name + '.txt')
+    logger.debug('Load `%s`.', filename)
+    return np.atleast_1d(np.genfromtxt(filename, usecols=0, **kwargs))
+
+
+def load_events(dir_path, sample_rate):
+    """
+    Load the event markers and names (if present)
+
+    The events are kept in their original unit and data type (possibly
+    as a memory-mapped array). Multiplying with `scale` yields seconds.
+    If the events are not in ascending order, `times` holds a sorted
+    copy and `order` the original index of each of its entries.
+    """
+    events = _load_file(dir_path, 'eventmarkers', dtype=None)
+    if np.issubdtype(events.dtype, np.integer):
+        logger.debug('Converting input from samples to seconds.')
+        scale = 1. / sample_rate
+    else:
+        scale = 1.
+
+    # Sorted events are required for the binary search
+    if events.size > 1 and np.any(events[1:] < events[:-1]):
+        logger.debug('Sorting %i event markers.', events.size)
+        order = np.argsort(events, kind='stable')
+        times = events[order]
+    else:
+        order = None
+        times = events
+
+    try:
+        names = _load_file(dir_path, 'eventmarkernames', dtype=str)
+    except (FileNotFoundError, OSError):
+        logger.info('Event marker names file not found (optional): `%s`. '
+                    'Fall back to numbering.',
+                    dir_path / 'eventmarkernames.txt')
+        names = None
+
+    return dict(events=events, times=times, order=order, scale=scale,
+                names=names)
+
+
+def visible_events(times, scale, t0, t1, max_n):
+    """
+    Indices into `times` of the events between `t0` and `t1` (seconds),
+    decimated to at most `max_n` events
+    """
+    i0, i1 = np.searchsorted(times, [t0 / scale, t1 / scale])
+    step = max(1, -(-(i1 - i0) // max_n))
+    return np.arange(i0, i1, step)
+
+
+def _window_edges(spike_times, events, window):
+    """
+    Indices into the sorted `spike_times` of the window start, the event
+    and the window end for each event (one binary search pass)
+    """
+    edges = events[:, np.newaxis] + np.array([window[0], 0, window[1]])
+    return np.searchsorted(spike_times, edges.ravel()).reshape(-1, 3)
+
+
+def align_spikes(spike_times, events, window):
+    """
+    Spike times relative to each event within `window` (seconds)
+
+    Returns the relative times and the index of the corresponding event
+    for each spike. A spike may appear for multiple events if the
+    windows overlap.
+    """
+    edges = _window_edges(spike_times, events, window)
+    counts = edges[:, 2] - edges[:, 0]
+    event_idx = np.repeat(np.arange(events.size), counts)
+
+    # Index of each spike: the window start of its event plus its rank
+    # within the window
+    offsets = np.cumsum(counts) - counts
+    spike_idx = (np.arange(counts.sum())
+                 + np.repeat(edges[:, 0] - offsets, counts))
+    return spike_times[spike_idx] - events[event_idx], event_idx
+
+
+def response_strength(spike_times, events, window):
+    """
+    Response index of a spike train to the events
+
+    Compares the firing rate after the events (up to `window[1]`) with
+    the rate before the events (from `window[0]`). The index ranges
+    from -1 (silenced) to 1 (only firing after the events).
+    """
+    if events.size == 0:
+        return 0.
+    edges = _window_edges(spike_times, events, window)
+    rate_pre = (edges[:, 1] - edges[:, 0]).sum() / -window[0]
+    rate_post = (edges[:, 2] - edges[:, 1]).sum() / window[1]
+    total = rate_pre + rate_post
+    return (rate_post - rate_pre) / total if total > 0 else 0.
+
+
+def response_strengths(spike_times, spike_clusters, events, window):
+    """Response index of all clusters at once"""
+    # Group the spikes by cluster, keeping them sorted by time
+    order = np.argsort(spike_clusters, kind='stable')
+    clusters, starts = np.unique(spike_clusters[order], return_index=True)
+    stops = np.append(starts[1:], order.size)
+    times = spike_times[order]
+    return {int(c): response_strength(times[i0:i1], events, window)
+            for c, i0, i1 in zip(clusters, starts, stops)}
@@ -0,0 +1,99 @@
+"""
+Shared access to the PC features of the spikes (not a plugin)
+
+Used by `Recluster` and `batch_curate.py`. `pc_features.npy` is memory
+mapped and only the rows of the requested spikes are read, in order of
+the spike ids and in chunks. The features of each spike are computed on
+the channels of its template (`pc_feature_ind.npy`). To compare spikes
+of different templates, the features are aligned onto a common set of
+channels, with zeros on the channels a template does not cover.
+"""
+
+import logging
+import sys
+import threading
+from pathlib import Path
+import numpy as np
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_algorithms import DTYPE  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+_lock = threading.Lock()
+_stores = dict()  # Feature store per data directory
+
+
+class FeatureStore(object):
+    """Memory-mapped PC features of a data directory"""
+    chunk_size = 65536
+
+    def __init__(self, dir_path):
+        dir_path = Path(dir_path)
+        self.features = np.load(dir_path / 'pc_features.npy', mmap_mode='r')
+        self.channels = np.load(dir_path / 'pc_feature_ind.npy')
+        self.spike_templates = np.load(dir_path / 'spike_templates.npy',
+                                       mmap_mode='r')
+
+    def gather(self, spike_ids):
+        """Features of some spikes, shape (n_spikes, n_pcs, n_channels)"""
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        order = np.argsort(spike_ids, kind='stable')
+        sorted_ids = spike_ids[order]
+        out = np.empty((len(spike_ids),) + self.features.shape[1:],
+                       dtype=self.features.dtype)
+        for i in range(0, len(spike_ids), self.chunk_size):
+            out[order[i:i + self.chunk_size]] = self.features[
+                sorted_ids[i:i + self.chunk_size]]
+        return out
+
+    def spike_channels(self, spike_ids):
+        """Channels of the features of each spike"""
+        templates = np.asarray(self.spike_templates[spike_ids]).ravel()
+        return self.channels[templates]
+
+    def aligned(self, spike_ids, channel_ids=None):
+        """
+        Features of some spikes on common channels
+
+        Parameters
+        ----------
+        spike_ids : array
+        channel_ids : array
+            Common channels, by default all the channels of the
+            templates of the spikes
+
+        Returns
+        -------
+        features : array, shape (n_spikes, n_pcs, n_channels)
+        channel_ids : array
+        """
+        data = self.gather(spike_ids)
+        cols = self.spike_channels(spike_ids)
+        if channel_ids is None:
+            channel_ids = np.unique(cols[cols >= 0])
+        channel_ids = np.asarray(channel_ids, dtype=np.int64)
+
+        lookup = -np.ones(max(cols.max(initial=0),
+                              channel_ids.max(initial=0)) + 1, dtype=np.int64)
+        lookup[channel_ids] = np.arange(len(channel_ids))
+        pos = np.where(cols >= 0, lookup[cols], -1)
+
+        # Allocated in the returned layout, such that the flattened
+        # features of each spike (rows of the feature matrix) are a view
+        out = np.zeros((data.shape[0], data.shape[1], len(channel_ids)),
+                       dtype=DTYPE)
+        rows, k = np.nonzero(pos >= 0)
+        out[rows, :, pos[rows, k]] = data[rows, :, k]
+        return out, channel_ids
+
+
+def get_feature_store(dir_path):
+    """Feature store of a data directory (opened once)"""
+    dir_path = Path(dir_path)
+    with _lock:
+        if dir_path not in _stores:
+            _stores[dir_path] = FeatureStore(dir_path)
+        return _stores[dir_path]
@@ -0,0 +1,141 @@
+"""
+Generation counter of the clustering for the caches of the plugins (not
+a plugin)
+
+Used by `JumpInTrace`, `MarkChannel`, `WriteComments` and
+`AmplitudeDensity`. The clustering state connects once to the cluster
+events of the supervisor (splits, merges, label changes, and their undo
+and redo) and increments its generation number at each event, recording
+which clusters were created, deleted or relabeled. A cache stores the
+generation it was computed at:
+
+- if the generation did not change, the cache is valid (O(1) check),
+- otherwise `changes_since` tells which clusters to invalidate.
+
+Only the last `max_history` events are kept. Caches older than that
+have to be invalidated entirely (`changes_since` returns None).
+`ClusterCache` implements this for values computed per cluster.
+"""
+
+import logging
+import threading
+from collections import deque
+from phy import connect
+
+logger = logging.getLogger('phy')
+
+_lock = threading.Lock()
+
+
+class Changes(object):
+    """Clusters changed since a generation"""
+
+    def __init__(self):
+        self.created = set()
+        self.deleted = set()
+        self.relabeled = set()
+        self.fields = set()  # Names of the changed labels
+
+    def clusters(self, spikes=True, labels=True):
+        """Changed clusters, by change of spikes and/or of labels"""
+        out = set()
+        if spikes:
+            out |= self.created | self.deleted
+        if labels:
+            out |= self.relabeled
+        return out
+
+
+class ClusteringState(object):
+    # Number of cluster events kept to compute the changes
+    max_history = 1000
+
+    def __init__(self, supervisor):
+        self.generation = 0
+        self.history = deque(maxlen=self.max_history)
+
+        @connect(sender=supervisor)
+        def on_cluster(sender, up):
+            field = None
+            if up.description.startswith('metadata_'):
+                field = up.description[len('metadata_'):]
+            self.history.append((
+                set(up.added), set(up.deleted),
+                set(up.metadata_changed or ()), field))
+            self.generation += 1
+
+    def changes_since(self, generation):
+        """Changes since a generation, or None if no longer known"""
+        n = self.generation - generation
+        if n > len(self.history) or n < 0:
+            return None
+        changes = Changes()
+        for added, deleted, relabeled, field in list(self.history)[
+                len(self.history) - n:]:
+            changes.created |= added
+            changes.deleted |= deleted
+            changes.relabeled |= relabeled
+            if field:
+                changes.fields.add(field)
+        return changes
+
+    def changed(self, generation, cluster_ids, spikes=True, labels=True):
+        """Whether any of the clusters changed since a generation"""
+        if generation == self.generation:
+            return False
+        changes = self.changes_since(generation)
+        return changes is None or bool(
+            changes.clusters(spikes, labels) & set(cluster_ids))
+
+
+class ClusterCache(object):
+    """Values computed per cluster, invalidated when the cluster changes"""
+
+    def __init__(self, state, spikes=True, labels=True):
+        self.state = state
+        self.spikes = spikes
+        self.labels = labels
+        self.generation = state.generation
+        self.values = dict()
+
+    def _sync(self):
+        if self.generation == self.state.generation:
+            return
+        changes = self.state.changes_since(self.generation)
+        if changes is None:
+            self.values.clear()
+        else:
+            for cluster_id in changes.clusters(self.spikes, self.labels):
+                self.values.pop(cluster_id, None)
+        self.generation = self.state.generation
+
+    def get(self, cluster_id, compute):
+        """Cached value of a cluster, or `compute(cluster_id)`"""
+        self._sync()
+        if cluster_id not in self.values:
+            self.values[cluster_id] = compute(cluster_id)
+        return self.values[cluster_id]
+
+    def peek(self, cluster_id):
+        """Cached value of a cluster, or None"""
+        self._sync()
+        return self.values.get(cluster_id)
+
+    def put(self, cluster_id, value, generation):
+        """
+        Store a value computed at an earlier generation (e.g. in a
+        background thread), unless the cluster changed since
+        """
+        self._sync()
+        if not self.state.changed(generation, [cluster_id], self.spikes,
+                                  self.labels):
+            self.values[cluster_id] = value
+
+
+def get_state(controller):
+    """Clustering state of the supervisor (created on first use)"""
+    supervisor = controller.supervisor
+    with _lock:
+        if getattr(supervisor, '_clustering_state', None) is None:
+            supervisor._clustering_state = ClusteringState(supervisor)
+        return supervisor._clustering_state
@@ -0,0 +1,108 @@
+"""
+Shared bridge for the JavaScript calls of the plugins (not a plugin)
+
+Used by `MarkChannel`, `SortClusterView` and `VirtualTable` to update
+the cluster view and the similarity view. Instead of sending generated
+code for each update, the plugins define JavaScript functions once per
+page and call them with JSON data. All calls made during one iteration
+of the event loop are sent to the page with a single `eval_js`. A
+repeated call of the same function replaces the pending one (only the
+latest data is sent). The round-trip times are logged in debug mode.
+"""
+
+import json
+import logging
+import time
+from phy import connect
+from PyQt5.QtCore import QTimer
+
+logger = logging.getLogger('phy')
+
+_js_run = """
+  (function() {
+    if (!window.phyBridge) {
+      window.phyBridge = {fn: {}, run: function(calls) {
+        var out = [];
+        for (var i = 0; i < calls.length; i++) {
+          var f = phyBridge.fn[calls[i][0]];
+          out.push(f ? f(calls[i][1]) : null);
+        }
+        return out;
+      }};
+    }
+    %s
+    return phyBridge.run(%s);
+  })();
+"""
+
+
+class JSBridge(object):
+    """Batched calls of JavaScript functions in an HTML view"""
+
+    def __init__(self, view):
+        self.view = view
+        self.functions = dict()  # JavaScript source per function name
+        self.installed = set()  # Functions defined in the current page
+        self.pending = dict()  # {name: (data, callback)}
+        self.scheduled = False
+        self.n_calls = 0
+        self.n_round_trips = 0
+        self.total_time = 0.
+
+        @connect(sender=view)
+        def on_ready(sender):
+            # The page was (re)loaded
+            self.installed.clear()
+
+    def define(self, name, source):
+        """Define a JavaScript function `function(data) {...}`"""
+        if self.functions.get(name) != source:
+            self.functions[name] = source
+            self.installed.discard(name)
+
+    def call(self, name, data=None, callback=None):
+        """Call a function with JSON data in the next batch"""
+        self.pending.pop(name, None)  # Latest call wins, runs last
+        self.pending[name] = (data, callback)
+        if not self.scheduled:
+            self.scheduled = True
+            QTimer.singleShot(0, self.flush)
+
+    def flush(self):
+        """Send all pending calls in one round trip"""
+        self.scheduled = False
+        if not self.pending:
+            return
+        calls, self.pending = self.pending, dict()
+        defs = ''.join('phyBridge.fn[%s] = %s;\n' % (json.dumps(name),
+                                                     self.functions[name])
+                       for name in calls
+                       if name in self.functions
+                       and name not in self.installed)
+        self.installed.update(calls)
+        payload = json.dumps([[name, data]
+                              for name, (data, _) in calls.items()])
+        t0 = time.perf_counter()
+
+        def done(results):
+            dt = time.perf_counter() - t0
+            self.n_calls += len(calls)
+            self.n_round_trips += 1
+            self.total_time += dt
+            logger.debug('JS bridge: %i call(s) in %.1f ms (mean %.1f ms '
+                         'over %i round trips).', len(calls), dt * 1e3,
+                         self.total_time / self.n_round_trips * 1e3,
+                         self.n_round_trips)
+            for (_, callback), result in zip(calls.values(),
+                                             results or [None] * len(calls)):
+                if callback is not None:
+                    callback(result)
+
+        self.view.eval_js(_js_run % (defs, payload), callback=done)
+
+
+def get_bridge(view):
+    """JavaScript bridge of a view (created on first use)"""
+    if getattr(view, '_js_bridge', None) is None:
+        view._js_bridge = JSBridge(view)
+    return view._js_bridge
@@ -0,0 +1,103 @@
+"""
+Shared scheduling of the selection handlers of the plugins (not a plugin)
+
+Used by `MarkChannel` and `TraceMarkChannel`. Holding a key to step
+through the clusters (e.g. with `SelectionOptions`) emits many selection
+events in a short time, of which only the last one matters. Handlers
+registered with `on_select` are called like regular `on_select` handlers
+
+- immediately, if they are cheap (default), or
+- if deferrable, once no new selection was made for `settle_delay` ms,
+  with the latest selection only.
+
+A deferrable handler may also be a generator function: it is then
+resumed at each iteration of the event loop (yielding between parts of
+its work) and abandoned as soon as a newer selection supersedes it.
+"""
+
+import logging
+import time
+from phy import connect
+from PyQt5.QtCore import QTimer
+
+logger = logging.getLogger('phy')
+
+
+class SelectionScheduler(object):
+    # Time without a new selection before the deferred handlers run (ms)
+    settle_delay = 150
+
+    # Maximum time spent in generator handlers per event loop iteration
+    # (seconds)
+    time_slice = .01
+
+    def __init__(self, supervisor):
+        self.generation = 0  # Incremented with each selection
+        self.cheap = []
+        self.deferred = []
+        self.latest = None  # Arguments of the latest selection
+        self.running = []  # Generators of the current selection
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._run_deferred)
+
+        @connect(sender=supervisor)
+        def on_select(sender, cluster_ids=None, **kwargs):
+            self.generation += 1
+            if self.running:
+                logger.debug('Cancel %i handler(s) of a superseded '
+                             'selection.', len(self.running))
+                for gen in self.running:
+                    gen.close()
+                self.running = []
+            self.latest = (sender, cluster_ids, kwargs)
+            for handler in self.cheap:
+                handler(sender, cluster_ids=cluster_ids, **kwargs)
+            if self.deferred:
+                self.timer.start(self.settle_delay)  # Restart the delay
+
+    def on_select(self, handler=None, deferrable=False):
+        """Register a selection handler (usable as a decorator)"""
+        if handler is None:
+            return lambda h: self.on_select(h, deferrable=deferrable)
+        (self.deferred if deferrable else self.cheap).append(handler)
+        return handler
+
+    def is_current(self, generation):
+        """Whether no selection was made since `generation`"""
+        return generation == self.generation
+
+    def _run_deferred(self):
+        sender, cluster_ids, kwargs = self.latest
+        for handler in self.deferred:
+            out = handler(sender, cluster_ids=cluster_ids, **kwargs)
+            if hasattr(out, 'send'):
+                self.running.append(out)
+        if self.running:
+            self._step(self.generation)
+
+    def _step(self, generation):
+        """Resume the generator handlers for one time slice"""
+        if not self.is_current(generation):
+            return
+        t0 = time.perf_counter()
+        while self.running and time.perf_counter() - t0 < self.time_slice:
+            gen = self.running[0]
+            try:
+                next(gen)
+            except StopIteration:
+                self.running.pop(0)
+            except Exception as e:
+                logger.error('Selection handler failed: %s', e)
+                self.running.pop(0)
+        if self.running:
+            QTimer.singleShot(0, lambda: self._step(generation))
+
+
+def get_scheduler(controller):
+    """Selection scheduler of the supervisor (created on first use)"""
+    supervisor = controller.supervisor
+    if getattr(supervisor, '_selection_scheduler', None) is None:
+        supervisor._selection_scheduler = SelectionScheduler(supervisor)
+    return supervisor._selection_scheduler
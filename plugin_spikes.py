@@ -0,0 +1,99 @@
+"""
+Shared index of the spikes of each cluster (not a plugin)
+
+Used by `SplitShortISI`, `SplitDuplicates` and `Recluster`. The spike
+ids of all clusters are obtained from a single argsort of the spike
+clusters when first needed. Afterwards, only the clusters changed by a
+split, merge, undo or redo are updated. Amplitudes are only loaded when
+requested. The sort order of the spikes by cluster is kept in the plugin
+cache (see `plugin_cache`) for the next sessions.
+"""
+
+import logging
+import sys
+import threading
+from pathlib import Path
+import numpy as np
+from phy import connect
+
+# Shared helper modules (once, plugins may be discovered again)
+if str(Path(__file__).parent) not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from plugin_cache import array_key, get_cache  # noqa: E402
+
+logger = logging.getLogger('phy')
+
+_lock = threading.Lock()
+
+
+class SpikeIndex(object):
+    """Spike ids per cluster, sorted by spike id (and thus by time)"""
+
+    def __init__(self, spike_clusters, spike_times, order=None):
+        self.spike_times = spike_times
+        if order is None:
+            order = np.argsort(spike_clusters, kind='stable')
+        self.order = order
+        sorted_clusters = spike_clusters[order]
+        start = np.flatnonzero(np.diff(sorted_clusters)) + 1
+        start = np.append(0, start) if len(order) else start
+        cluster_ids = sorted_clusters[start]
+        bounds = np.append(start, len(order))
+        self.clusters = {c: order[bounds[i]:bounds[i + 1]]
+                         for i, c in enumerate(cluster_ids.tolist())}
+
+    def spike_ids(self, cluster_id):
+        return self.clusters.get(cluster_id, np.array([], dtype=np.int64))
+
+    def spikes_in_clusters(self, cluster_ids):
+        """Sorted spike ids of several clusters"""
+        return np.sort(np.concatenate(
+            [self.spike_ids(c) for c in cluster_ids] + [[]]).astype(np.int64))
+
+    def spikes(self, cluster_id):
+        """Spike ids and spike times of a cluster"""
+        spike_ids = self.spike_ids(cluster_id)
+        return spike_ids, self.spike_times[spike_ids]
+
+    def update(self, up, spike_clusters):
+        """Patch the index after a change of the clustering"""
+        if not up.added and not up.deleted:
+            return
+        # The spikes of the new clusters are among those of the removed
+        # clusters and those reassigned
+        spike_ids = [self.clusters.pop(c, []) for c in up.deleted]
+        spike_ids.append(np.asarray(up.spike_ids, dtype=np.int64))
+        spike_ids = np.unique(np.concatenate(spike_ids).astype(np.int64))
+        clusters = spike_clusters[spike_ids]
+        for cluster_id in up.added:
+            self.clusters[cluster_id] = spike_ids[clusters == cluster_id]
+
+
+def get_spike_index(controller):
+    """Spike index of the current clustering (built on first use)"""
+    supervisor = controller.supervisor
+    with _lock:
+        if getattr(supervisor, '_spike_index', None) is None:
+            spike_clusters = supervisor.clustering.spike_clusters
+            cache = get_cache(controller.dir_path)
+            key = array_key(spike_clusters)
+            order = cache.get('spike_order', key)
+            index = SpikeIndex(spike_clusters, controller.model.spike_times,
+                               order)
+            if order is None:
+                cache.put('spike_order', key, index.order)
+            supervisor._spike_index = index
+
+            @connect(sender=supervisor)
+            def on_cluster(sender, up):
+                index.update(up, supervisor.clustering.spike_clusters)
+
+        return supervisor._spike_index
+
+
+def get_amplitudes(controller, spike_ids):
+    """Template amplitudes of some spikes, as in the amplitude view"""
+    getter = getattr(controller, 'get_spike_template_amplitudes', None)
+    if getter is not None:
+        return getter(spike_ids)
+    return controller.model.amplitudes[spike_ids]
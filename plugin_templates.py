@@ -0,0 +1,84 @@
+"""
+Shared helpers for template amplitudes (not a plugin)
+
+Used by `WaveformThr` and `MEAColumns`. The peak-to-peak amplitude of
+every template on every channel is computed once per dataset and cached
+in `.phy/template_ptp.npy` in the data directory.
+"""
+
+import logging
+import threading
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+_lock = threading.Lock()
+_tables = dict()  # Amplitude table per data directory
+
+
+def template_amplitudes(model, chunk_size=256):
+    """
+    Peak-to-peak amplitude of each template on each channel
+
+    Returns an array of shape (n_templates, n_channels). Dense templates
+    are unwhitened first.
+    """
+    templates = model.sparse_templates
+    n_templates = templates.data.shape[0]
+    wmi = getattr(model, 'wmi', None)
+    if wmi is not None:
+        wmi = np.asarray(wmi, dtype=np.float32)
+
+    ptp = np.zeros((n_templates, model.n_channels), dtype=np.float32)
+    for i in range(0, n_templates, chunk_size):
+        data = np.asarray(templates.data[i:i + chunk_size], dtype=np.float32)
+        if templates.cols is None and wmi is not None:
+            data = data @ wmi
+        amp = data.max(axis=1) - data.min(axis=1)
+        if templates.cols is None:
+            ptp[i:i + chunk_size] = amp
+        else:
+            # Scatter the sparse channels into the full channel space
+            # Channel indices may be stored as floats (-1 for none)
+            cols = np.asarray(templates.cols[i:i + chunk_size],
+                              dtype=np.int64)
+            rows, idx = np.nonzero(cols >= 0)
+            ptp[rows + i, cols[rows, idx]] = amp[rows, idx]
+    return ptp
+
+
+def _load_or_compute(model, dir_path):
+    """Amplitude table from disk if up to date, or computed and saved"""
+    path = dir_path / '.phy' / 'template_ptp.npy'
+    templates = dir_path / 'templates.npy'
+    mtime = templates.stat().st_mtime if templates.exists() else 0
+    shape = (model.sparse_templates.data.shape[0], model.n_channels)
+    if path.exists() and path.stat().st_mtime >= mtime:
+        ptp = np.load(path, mmap_mode='r')
+        if ptp.shape == shape:
+            logger.debug('Load template amplitudes from `%s`.', path)
+            return ptp
+
+    logger.debug('Compute amplitudes of %i templates on %i channels.',
+                 *shape)
+    ptp = template_amplitudes(model)
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_name('template_ptp.tmp.npy')
+    np.save(tmp, ptp)
+    tmp.replace(path)
+    return ptp
+
+
+def get_template_amplitudes(controller):
+    """
+    Amplitude table of the templates, shape (n_templates, n_channels)
+
+    Computed only once per session, also if requested from several
+    threads at the same time.
+    """
+    dir_path = Path(controller.dir_path)
+    with _lock:
+        if dir_path not in _tables:
+            _tables[dir_path] = _load_or_compute(controller.model, dir_path)
+        return _tables[dir_path]
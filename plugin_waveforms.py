@@ -0,0 +1,249 @@
+"""
+On-disk store of spike waveforms (not a plugin)
+
+Used by `WaveformCache`. The waveforms of a subset of the spikes are
+kept in `.phy/waveform_cache/` in the data directory, in segments of
+spikes extracted together (one cluster) on the same channels:
+
+- `<segment>.npy`: waveforms, shape (n_spikes, n_samples, n_channels)
+- `<segment>-ids.npy`: spike id of each row
+- `meta.json`: channels, size and last use of each segment, data type
+  and the spike times file they belong to
+
+The store grows by one segment per extraction. When its total size
+exceeds `budget` bytes, the least recently used segments are removed.
+The waveforms are memory-mapped. As they are stored by spike id, they
+remain valid after splits and merges. A spike extracted again (on the
+channels of its new cluster) is read from the newest segment.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+logger = logging.getLogger('phy')
+
+
+class WaveformStore(object):
+    """Memory-mapped waveforms of a subset of the spikes"""
+
+    def __init__(self, dir_path, dtype=None, budget=10 ** 9):
+        self.path = Path(dir_path) / '.phy' / 'waveform_cache'
+        spike_times = Path(dir_path) / 'spike_times.npy'
+        self.key = (spike_times.stat().st_mtime if spike_times.exists()
+                    else 0)
+        # Data type of the waveforms extracted from the raw data if None
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.budget = budget
+        self.segments = dict()  # {name: {channels, size, last_use}}
+        self._arrays = dict()  # {name: (spike_ids, waveforms)}
+        self._next = 0
+        self._lock = threading.Lock()
+        self._sorted_ids = np.array([], dtype=np.int64)
+        self._index = np.zeros((0, 2), dtype=np.int64)  # Segment, row
+        self._names = []
+        self._open()
+
+    @property
+    def count(self):
+        """Number of stored spikes"""
+        return len(self._sorted_ids)
+
+    @property
+    def size(self):
+        return sum(seg['size'] for seg in self.segments.values())
+
+    def _open(self):
+        """Open the existing store, if it is valid"""
+        try:
+            with open(self.path / 'meta.json', 'r') as f:
+                meta = json.load(f)
+            if meta['key'] != self.key or (
+                    self.dtype is not None and meta['dtype'] is not None
+                    and meta['dtype'] != self.dtype.str):
+                raise ValueError('outdated')
+            self.segments = meta['segments']
+            self._next = meta['next']
+            if meta['dtype'] is not None:
+                self.dtype = np.dtype(meta['dtype'])
+            for name in self.segments:
+                self._load(name)
+        except (OSError, ValueError, KeyError) as e:
+            if self.path.exists():
+                logger.debug('Discard waveform cache (%s).', e)
+                shutil.rmtree(self.path, ignore_errors=True)
+            self.segments = dict()
+            self._arrays = dict()
+            return
+        self._reindex()
+        logger.debug('Open waveform cache with %i spikes.', self.count)
+
+    def _load(self, name):
+        self._arrays[name] = (
+            np.load(self.path / (name + '-ids.npy')),
+            np.load(self.path / (name + '.npy'), mmap_mode='r'))
+
+    def _reindex(self):
+        """Sorted spike ids and their segment and row (newest segment)"""
+        names = list(self.segments)
+        if not names:
+            ids = np.zeros(0, dtype=np.int64)
+            index = np.zeros((0, 2), dtype=np.int64)
+        else:
+            ids = np.concatenate([self._arrays[n][0] for n in names])
+            index = np.concatenate([
+                np.c_[np.full(len(self._arrays[n][0]), i),
+                      np.arange(len(self._arrays[n][0]))]
+                for i, n in enumerate(names)]).astype(np.int64)
+            order = np.argsort(ids, kind='stable')
+            ids, index = ids[order], index[order]
+            # Keep the last segment of the spikes stored several times
+            last = np.r_[ids[1:] != ids[:-1], True]
+            ids, index = ids[last], index[last]
+        with self._lock:
+            self._sorted_ids, self._index, self._names = ids, index, names
+
+    def _write_meta(self):
+        tmp = self.path / 'meta.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(key=self.key, next=self._next,
+                           dtype=None if self.dtype is None
+                           else self.dtype.str,
+                           segments=self.segments), f)
+        os.replace(tmp, self.path / 'meta.json')
+
+    def _lookup(self, spike_ids):
+        """Mask of the stored spikes, and their segment and row"""
+        with self._lock:
+            sorted_ids, index, names = (self._sorted_ids, self._index,
+                                        self._names)
+        if not len(sorted_ids):
+            return (np.zeros(len(spike_ids), dtype=bool),
+                    index, names)
+        pos = np.searchsorted(sorted_ids, spike_ids)
+        pos = np.clip(pos, 0, len(sorted_ids) - 1)
+        found = sorted_ids[pos] == spike_ids
+        return found, index[pos[found]], names
+
+    def _columns(self, name, channel_ids):
+        """Columns of some channels in a segment, or None if incomplete"""
+        channels = self.segments.get(name, {}).get('channels', ())
+        if not set(channel_ids) <= set(channels):
+            return None
+        return [channels.index(c) for c in channel_ids]
+
+    def contains(self, spike_ids, channel_ids=None):
+        """Whether each spike is in the store (on all these channels)"""
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        found, index, names = self._lookup(spike_ids)
+        if channel_ids is not None and found.any():
+            channel_ids = [int(c) for c in channel_ids]
+            complete = np.array([
+                self._columns(names[i], channel_ids) is not None
+                for i in range(len(names))], dtype=bool)
+            found[found] = complete[index[:, 0]]
+        return found
+
+    def append(self, spike_ids, channel_ids, waveforms):
+        """
+        Add the waveforms of some spikes on some channels
+
+        Returns False if older segments were removed to stay within the
+        budget.
+        """
+        if self.dtype is None:
+            self.dtype = np.asarray(waveforms).dtype
+        waveforms = np.asarray(waveforms, dtype=self.dtype)
+        if waveforms.nbytes > self.budget:
+            return False
+        self.path.mkdir(parents=True, exist_ok=True)
+        name = 'segment_%i' % self._next
+        self._next += 1
+        np.save(self.path / (name + '-ids.npy'),
+                np.asarray(spike_ids, dtype=np.int64))
+        np.save(self.path / (name + '.npy'), waveforms)
+        self.segments[name] = dict(
+            channels=[int(c) for c in channel_ids], size=waveforms.nbytes,
+            last_use=time.time())
+        self._load(name)
+        evicted = self._evict()
+        self._write_meta()
+        self._reindex()
+        return not evicted
+
+    def _evict(self):
+        """Remove the least recently used segments over the budget"""
+        size = self.size
+        evicted = False
+        for name in sorted(self.segments,
+                           key=lambda n: self.segments[n]['last_use']):
+            if size <= self.budget:
+                break
+            size -= self.segments.pop(name)['size']
+            self._arrays.pop(name, None)
+            for filename in (name + '.npy', name + '-ids.npy'):
+                try:
+                    os.remove(self.path / filename)
+                except OSError:
+                    pass  # Still mapped (Windows)
+            evicted = True
+        if evicted:
+            logger.debug('Waveform cache full, removed the least recently '
+                         'used waveforms.')
+        return evicted
+
+    def get(self, spike_ids, channel_ids):
+        """
+        Stored waveforms of some spikes on some channels
+
+        Returns a mask of the spikes found (with all channels) and their
+        waveforms, shape (n_found, n_samples, n_channels).
+        """
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        channel_ids = [int(c) for c in channel_ids]
+        found, index, names = self._lookup(spike_ids)
+        if not found.any():
+            return found, None
+
+        complete = np.zeros(len(index), dtype=bool)
+        parts = []
+        now = time.time()
+        for i in np.unique(index[:, 0]):
+            name = names[i]
+            arrays = self._arrays.get(name)
+            cols = self._columns(name, channel_ids)
+            if cols is None or arrays is None:
+                continue
+            sel = np.flatnonzero(index[:, 0] == i)
+            rows = index[sel, 1]
+            order = np.argsort(rows)
+            waveforms = arrays[1]
+            data = np.empty((len(rows),) + waveforms.shape[1:2] +
+                            (len(cols),), dtype=waveforms.dtype)
+            data[order] = waveforms[rows[order]][:, :, cols]
+            parts.append((sel, data))
+            complete[sel] = True
+            self.segments.get(name, {})['last_use'] = now
+        if not parts:
+            found[:] = False
+            return found, None
+
+        # Waveforms in the order of the found spikes
+        n_samples = parts[0][1].shape[1]
+        dtype = parts[0][1].dtype
+        out = np.empty((len(index), n_samples, len(channel_ids)),
+                       dtype=np.float32 if dtype.kind == 'f' else dtype)
+        for sel, data in parts:
+            out[sel] = data
+        found[found] = complete
+        return found, out[complete]
+
+    def flush(self):
+        """Save the last use of the segments"""
+        if self.segments:
+            self._write_meta()